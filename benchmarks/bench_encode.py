@@ -0,0 +1,126 @@
+from __future__ import print_function
+import argparse
+import time
+import numpy as np
+import cv2
+import benchutil
+import fixtures
+import ImageDecoder
+import ImageEncoder
+import MarkRenderer
+
+'''
+Encode time, bytes and fidelity of each upload output type across ImageEncoder formats, and encoder pool throughput.
+
+    python benchmarks/bench_encode.py --repeat 10 --image streetview.jpg
+'''
+
+# (format, settings) of each configuration compared; JPEG is skipped for outputs with alpha
+CONFIGURATIONS = [
+    ('png', {'png_compression': 1}),
+    ('png', {'png_compression': 3}),
+    ('png', {'png_compression': 6}),
+    ('png', {'png_compression': 9}),
+    ('webp', {'webp_quality': 101}),
+    ('webp', {'webp_quality': 90}),
+    ('webp', {'webp_quality': 75}),
+    ('jpeg', {'jpeg_quality': 90}),
+    ('jpeg', {'jpeg_quality': 75})
+]
+
+
+def _outputs(img):
+    """
+    Returns {output type: BGR(A) image} shaped as the tasks produce them from an RGB frame.
+    """
+    height, width = img.shape[:2]
+    x1, y1, x2, y2 = width // 4, height // 4, 3 * width // 4, 3 * height // 4
+
+    bgr = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+    crop = np.ascontiguousarray(bgr[y1:y2, x1:x2])
+
+    # An elliptic cut-out, with the background transparent as CropPool leaves it
+    cut_out = cv2.cvtColor(crop, cv2.COLOR_BGR2BGRA)
+    mask = np.zeros(crop.shape[:2], np.uint8)
+    cv2.ellipse(mask, (crop.shape[1] // 2, crop.shape[0] // 2), (crop.shape[1] // 3, crop.shape[0] // 3),
+                0, 0, 360, 1, -1)
+    cut_out[mask == 0] = [255, 0, 0, 0]
+
+    renderer = MarkRenderer.MarkRenderer(img)
+    mark = renderer.draw({'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2}, np.empty(renderer.shape, np.uint8))
+
+    return {'mark': mark, 'crop': crop, 'crop_transparent': cut_out}
+
+
+def _psnr(img, data):
+    decoded = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED).astype(np.float64)
+
+    # WebP drops the colour of fully transparent pixels, so only visible pixels count
+    visible = img[..., 3] > 0 if img.shape[2] == 4 else np.ones(img.shape[:2], bool)
+    mse = np.mean((decoded[visible] - img[visible]) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+
+def _settings(fmt, settings):
+    return ' '.join([fmt] + ['{}={}'.format(k, v) for k, v in sorted(settings.items())])
+
+
+def _throughput(encoder, images):
+    start = time.time()
+    for img in images:
+        encoder.encode(img)
+    inline = time.time() - start
+
+    start = time.time()
+    for _ in ImageEncoder.encode_all(encoder, images):
+        pass
+    pooled = time.time() - start
+
+    return '%.1f' % (len(images) / inline), '%.1f' % (len(images) / pooled)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=640)
+    parser.add_argument('--image', help='encode crops of this frame rather than a synthetic one')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--batch', type=int, default=32, help='images per output type in the pool comparison')
+    args = parser.parse_args()
+
+    if args.image:
+        with open(args.image, 'rb') as f:
+            img = ImageDecoder.decode(f.read())
+    else:
+        img = fixtures.frame(args.size, args.size)
+
+    outputs = _outputs(img)
+    rows = []
+    throughput = []
+
+    for output in ('mark', 'crop', 'crop_transparent'):
+        src = outputs[output]
+
+        for fmt, settings in CONFIGURATIONS:
+            if fmt == 'jpeg' and ImageEncoder.OUTPUTS[output]:
+                continue
+
+            encoder = ImageEncoder.Encoder(output, fmt=fmt, **settings)
+            data = encoder.encode(src)
+
+            t = benchutil.time_call(lambda: encoder.encode(src), repeat=args.repeat)
+            rows.append((output, _settings(fmt, settings), '{}x{}'.format(src.shape[1], src.shape[0]), len(data),
+                         '%.3f' % (t['median'] * 1000), '%.3f' % (t['best'] * 1000), '%.1f' % _psnr(src, data)))
+
+        # The pool needs one image per encode in flight, as the tasks give it
+        encoder = ImageEncoder.Encoder(output)
+        images = [src.copy() for _ in range(args.batch)]
+        throughput.append((output, encoder.fmt) + _throughput(encoder, images))
+
+    benchutil.print_table(('output', 'encoding', 'size', 'bytes', 'median ms', 'best ms', 'psnr dB'), rows)
+    print()
+    benchutil.print_table(('output', 'encoding', 'inline images/s',
+                           'pool images/s ({} threads)'.format(ImageEncoder.pool_size())), throughput)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+from __future__ import print_function
+import argparse
+import time
+import numpy as np
+import cv2
+import benchutil
+import fixtures
+import GrabCut
+import MaskMaker
+
+'''
+Speed and accuracy of ROI-restricted GrabCut against full-frame GrabCut, on synthetic frames.
+Accuracy is the IoU of each landmark's foreground mask with the full-frame result.
+
+    python benchmarks/bench_grabcut_roi.py --frames 5 --margins 0.1 0.25 0.5 1.0
+'''
+
+
+def _fixture_set(n, size):
+    fixture_set = []
+
+    for seed in range(n):
+        sm = fixtures.saliency_map(size, size, regions=8, seed=seed)
+        img = cv2.cvtColor(fixtures.frame(size, size, regions=8, seed=seed), cv2.COLOR_RGB2BGR)
+        rects = [(b['x1'], b['y1'], b['x2'], b['y2']) for b in MaskMaker.make_bounding_boxes(sm)
+                 if b['x2'] - b['x1'] > 1 and b['y2'] - b['y1'] > 1]
+        fixture_set.append((img, rects))
+
+    return fixture_set
+
+
+def _iou(a, b):
+    union = np.count_nonzero(a | b)
+    return np.count_nonzero(a & b) / float(union) if union else 1.0
+
+
+def _segment_all(fixture_set, **kwargs):
+    start = time.time()
+    masks = [GrabCut.segment_rect(img, rect, **kwargs) for img, rects in fixture_set for rect in rects]
+    return masks, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=5)
+    parser.add_argument('--size', type=int, default=640)
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--margins', type=float, nargs='+', default=[0.1, 0.25, 0.5, 1.0])
+    parser.add_argument('--convergence', type=float, default=0.001)
+    args = parser.parse_args()
+
+    fixture_set = _fixture_set(args.frames, args.size)
+    full, full_time = _segment_all(fixture_set, roi=False, iterations=args.iterations, convergence=0)
+
+    rows = [('full', '-', len(full), '%.1f' % (full_time * 1000), '1.00x', '1.000')]
+
+    for convergence in (0, args.convergence):
+        for margin in args.margins:
+            masks, t = _segment_all(fixture_set, roi=True, margin=margin, iterations=args.iterations,
+                                    convergence=convergence)
+            ious = [_iou(a, b) for a, b in zip(full, masks)]
+            rows.append(('roi margin=%.2f' % margin, convergence, len(masks), '%.1f' % (t * 1000),
+                         '%.2fx' % (full_time / t), '%.3f' % np.mean(ious)))
+
+    benchutil.print_table(('mode', 'convergence', 'landmarks', 'total ms', 'speedup', 'mean IoU'), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import sys
+import cv2
+import numpy as np
+import benchutil
+import fixtures
+import GrabCut
+import ImageDecoder
+import MarkRenderer
+import MaskMaker
+import OptimisticSearch
+import SaliencyScorer
+
+'''
+Micro-benchmarks of the vision kernels on synthetic fixtures: per-call time and peak RSS growth, checked against
+benchmarks/baseline.json (re-record it on the machine that runs the check).
+
+    python benchmarks/bench_kernels.py --check --tolerance 0.25
+'''
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+SIZES = [(320, 320), (640, 640), (640, 1280)]  # (height, width)
+REGION_COUNTS = [4, 16]
+BEARINGS = 16
+
+# Peak RSS growth, in KB, below which a case's memory is not compared
+RSS_FLOOR_KB = 1024
+
+
+def _largest_region_mask(sm):
+    markers = MaskMaker.segment(sm)
+    regions = MaskMaker.regions_from_markers(markers, sm)
+    label = regions['label'][np.argmax(regions['area'])]
+    return (markers == label).astype(np.uint8)
+
+
+def _cases(sizes, region_counts):
+    """
+    Yields (name, params, fn) for every kernel and fixture. Fixtures are built before any timing.
+    """
+    for height, width in sizes:
+        for regions in region_counts:
+            params = {'height': height, 'width': width, 'regions': regions}
+            suffix = '{}x{}/r{}'.format(width, height, regions)
+
+            sm = fixtures.saliency_map(height, width, regions)
+            img = fixtures.frame(height, width, regions)
+            bgr = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+            boxes = MaskMaker.make_bounding_boxes(sm)
+            rects = SaliencyScorer.rects_array(boxes)
+            mask = _largest_region_mask(sm)
+            degs = np.linspace(-40, 40, BEARINGS)
+            jpeg = cv2.imencode('.jpg', bgr)[1].tobytes()
+
+            yield 'make_bounding_boxes/' + suffix, params, \
+                lambda sm=sm: MaskMaker.make_bounding_boxes(sm)
+
+            yield 'decode_frame/' + suffix, params, \
+                lambda jpeg=jpeg: ImageDecoder.decode(jpeg)
+
+            yield 'decode_frame_for_mark/' + suffix, params, \
+                lambda jpeg=jpeg: ImageDecoder.decode_reduced(jpeg, MarkRenderer.MAX_OUTPUT_SIZE)
+
+            yield 'crop_image_with_saliency_mask/' + suffix, params, \
+                lambda bgr=bgr, mask=mask: GrabCut.crop_image_with_saliency_mask(bgr, mask)
+
+            yield 'cut_out/' + suffix, dict(params, rects=len(boxes)), \
+                lambda bgr=bgr, boxes=boxes: [GrabCut.cut_out(bgr, (b['x1'], b['y1'], b['x2'], b['y2']))
+                                              for b in boxes if b['x2'] - b['x1'] > 1 and b['y2'] - b['y1'] > 1]
+
+            yield 'get_salient_area_at_degrees/' + suffix, dict(params, bearings=BEARINGS), \
+                lambda img=img, sm=sm, degs=degs: [OptimisticSearch.get_salient_area_at_degrees(img, sm, d)
+                                                   for d in degs]
+
+            yield 'score/' + suffix, dict(params, rects=len(boxes)), \
+                lambda sm=sm, rects=rects: SaliencyScorer.SaliencyScorer(sm).scores(rects)
+
+            yield 'mark/' + suffix, dict(params, rects=len(boxes)), \
+                lambda img=img, boxes=boxes: list(MarkRenderer.MarkRenderer(img).render_all(boxes))
+
+
+def run(pattern=None, repeat=5, rss=True, sizes=SIZES, region_counts=REGION_COUNTS):
+    results = {}
+
+    for name, params, fn in _cases(sizes, region_counts):
+        if pattern and pattern not in name:
+            continue
+
+        fn()  # warm up caches and lazy initialisation
+
+        results[name] = {
+            'params': params,
+            'seconds': benchutil.time_call(fn, repeat=repeat),
+            'peak_rss_delta_kb': benchutil.peak_rss_delta_kb(fn) if rss else None
+        }
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns (name, metric, baseline value, current value) for every regression beyond `tolerance` (a fraction).
+    Cases missing from either side are not compared.
+    """
+    regressions = []
+
+    for name, current in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+
+        metrics = [('median seconds', base['seconds']['median'], current['seconds']['median'])]
+        if (base.get('peak_rss_delta_kb') or 0) >= RSS_FLOOR_KB and current.get('peak_rss_delta_kb') is not None:
+            metrics.append(('peak RSS +KB', base['peak_rss_delta_kb'], current['peak_rss_delta_kb']))
+
+        for metric, before, after in metrics:
+            if before and after > before * (1 + tolerance):
+                regressions.append((name, metric, before, after))
+
+    return regressions
+
+
+def _environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'machine': platform.machine(),
+        'platform': platform.platform()
+    }
+
+
+def _load(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def _save(path, results):
+    with open(path, 'w') as f:
+        json.dump({'environment': _environment(), 'results': results}, f, indent=2, sort_keys=True,
+                  separators=(',', ': '))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filter', help='only run cases whose name contains this')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--no-rss', action='store_true', help='skip the forked peak RSS measurements')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='write results to the baseline file')
+    parser.add_argument('--check', action='store_true', help='compare against the baseline, fail on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = run(args.filter, args.repeat, not args.no_rss)
+
+    rows = []
+    for name, r in sorted(results.items()):
+        rows.append((
+            name,
+            '%.2f' % (r['seconds']['best'] * 1000),
+            '%.2f' % (r['seconds']['median'] * 1000),
+            r['peak_rss_delta_kb'] if r['peak_rss_delta_kb'] is not None else '-'
+        ))
+
+    benchutil.print_table(('case', 'best ms', 'median ms', 'peak RSS +KB'), rows)
+
+    if args.output:
+        _save(args.output, results)
+
+    if args.save_baseline:
+        _save(args.baseline, results)
+        print('\nSaved baseline to {}'.format(args.baseline))
+
+    if args.check:
+        if not os.path.exists(args.baseline):
+            print('\nNo baseline at {}; record one with --save-baseline'.format(args.baseline))
+            sys.exit(2)
+
+        regressions = compare(results, _load(args.baseline), args.tolerance)
+
+        if regressions:
+            print('\nRegressions beyond {:.0%}:'.format(args.tolerance))
+            benchutil.print_table(('case', 'metric', 'baseline', 'current'), regressions)
+            sys.exit(1)
+
+        print('\nNo regressions beyond {:.0%}'.format(args.tolerance))
+
+
+if __name__ == '__main__':
+    main()
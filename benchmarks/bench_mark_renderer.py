@@ -0,0 +1,82 @@
+from __future__ import print_function
+import argparse
+import time
+from io import BytesIO
+import numpy as np
+import benchutil
+import fixtures
+import MarkRenderer
+
+'''
+Landmarks marked per second and peak RSS growth of MarkRenderer, against the former matplotlib rendering path.
+
+    python benchmarks/bench_mark_renderer.py --marks 1000
+'''
+
+
+def _rects(n, width, height, seed=0):
+    rng = np.random.RandomState(seed)
+    rects = []
+    for _ in range(n):
+        x1, x2 = sorted(rng.randint(0, width, 2))
+        y1, y2 = sorted(rng.randint(0, height, 2))
+        rects.append({'x1': x1, 'x2': x2, 'y1': y1, 'y2': y2})
+    return rects
+
+
+def _mark_matplotlib(img, rects):
+    # The rendering LandmarkMarker used before MarkRenderer, figures included (they were never closed)
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.patches as patches
+
+    plt.rcParams['figure.max_open_warning'] = 0
+
+    for r in rects:
+        fig, ax = plt.subplots(figsize=(8, 8), dpi=72)
+        ax.axis('off')
+        ax.imshow(img)
+        ax.add_patch(patches.Rectangle((r['x1'], r['y1']), r['x2'] - r['x1'], r['y2'] - r['y1'],
+                                       linewidth=2, edgecolor='r', facecolor='none'))
+        fig.savefig(BytesIO(), format='png', bbox_inches='tight', pad_inches=0)
+
+
+def _mark_renderer(img, rects, fmt):
+    renderer = MarkRenderer.MarkRenderer(img, fmt=fmt)
+    for _ in renderer.render_all(rects):
+        pass
+
+
+def _run(name, fn, args):
+    start = time.time()
+    fn(*args)
+    elapsed = time.time() - start
+    rss = benchutil.peak_rss_delta_kb(fn, *args)
+    n = len(args[1])
+    return name, n, '%.1f' % (n / elapsed), rss
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--marks', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=640)
+    parser.add_argument('--skip-matplotlib', action='store_true')
+    args = parser.parse_args()
+
+    img = fixtures.frame(args.size, args.size)
+    rects = _rects(args.marks, args.size, args.size)
+    rows = []
+
+    if not args.skip_matplotlib:
+        # matplotlib is slow enough that a tenth of the marks gives a stable rate
+        rows.append(_run('matplotlib', _mark_matplotlib, (img, rects[:max(args.marks // 10, 1)])))
+
+    for fmt in ('png', 'jpeg'):
+        rows.append(_run('renderer-' + fmt, _mark_renderer, (img, rects, fmt)))
+
+    benchutil.print_table(('path', 'marks', 'marks/s', 'peak rss delta KB'), rows)
+
+
+if __name__ == '__main__':
+    main()
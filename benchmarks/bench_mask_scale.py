@@ -0,0 +1,82 @@
+from __future__ import print_function
+import argparse
+import time
+import numpy as np
+import cv2
+import benchutil
+import fixtures
+import MaskMaker
+
+'''
+Speed and box accuracy (mean IoU) of coarse-to-fine segmentation against full resolution, on synthetic maps.
+
+    python benchmarks/bench_mask_scale.py --maps 10 --sizes 640 1280 --scales 2 3 4 --smooth 5
+'''
+
+
+def _box_iou(a, b):
+    # Box bounds are inclusive
+    w = min(a['x2'], b['x2']) - max(a['x1'], b['x1']) + 1
+    h = min(a['y2'], b['y2']) - max(a['y1'], b['y1']) + 1
+
+    if w <= 0 or h <= 0:
+        return 0.0
+
+    inter = w * h
+    area = lambda r: (r['x2'] - r['x1'] + 1) * (r['y2'] - r['y1'] + 1)
+
+    return inter / float(area(a) + area(b) - inter)
+
+
+def _match(reference, boxes):
+    """
+    Returns (mean IoU of the best match of each reference box, missed reference boxes, unmatched boxes).
+    """
+    ious = [max([_box_iou(r, b) for b in boxes] or [0.0]) for r in reference]
+    extra = sum(1 for b in boxes if not any(_box_iou(r, b) > 0 for r in reference))
+
+    return (np.mean(ious) if ious else 1.0), sum(1 for iou in ious if iou == 0), extra
+
+
+def _segment_all(maps, **kwargs):
+    start = time.time()
+    boxes = [MaskMaker.make_bounding_boxes(sm, **kwargs) for sm in maps]
+    return boxes, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--maps', type=int, default=10)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[640, 1280])
+    parser.add_argument('--regions', type=int, default=8)
+    parser.add_argument('--scales', type=float, nargs='+', default=[2, 3, 4])
+    parser.add_argument('--smooth', type=float, default=0, help='sigma of a Gaussian blur applied to the maps')
+    args = parser.parse_args()
+
+    rows = []
+
+    for size in args.sizes:
+        maps = [fixtures.saliency_map(size, size, args.regions, seed) for seed in range(args.maps)]
+
+        if args.smooth:
+            maps = [cv2.GaussianBlur(sm, (0, 0), args.smooth) for sm in maps]
+
+        # Warm up, then time full resolution as the reference
+        _segment_all(maps[:1], scale=1)
+        full, full_time = _segment_all(maps, scale=1)
+        rows.append((size, 1, '-', '%.1f' % (full_time * 1000 / len(maps)), '1.00x', '1.000', 0, 0))
+
+        for scale in args.scales:
+            for refine in (False, True):
+                boxes, t = _segment_all(maps, scale=scale, refine=refine)
+
+                matches = [_match(r, b) for r, b in zip(full, boxes)]
+                rows.append((size, scale, 'yes' if refine else 'no', '%.1f' % (t * 1000 / len(maps)),
+                             '%.2fx' % (full_time / t), '%.3f' % np.mean([m[0] for m in matches]),
+                             sum(m[1] for m in matches), sum(m[2] for m in matches)))
+
+    benchutil.print_table(('size', 'scale', 'refine', 'ms / map', 'speedup', 'box IoU', 'missed', 'extra'), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+from __future__ import print_function
+import argparse
+import numpy as np
+import benchutil
+import fixtures
+import MaskMaker
+
+'''
+Time and peak memory of tiled panorama segmentation against segmenting the whole map, by tile width and workers.
+
+    python benchmarks/bench_panorama.py --height 1024 --width 2048 --tile-widths 512 1024 --workers 1 2 4
+'''
+
+
+def _unroll(boxes, shift, width):
+    return sorted(((b['x1'] - shift) % width, b['y1'], (b['x1'] - shift) % width + b['x2'] - b['x1'], b['y2'])
+                  for b in boxes)
+
+
+def _peak_mb(fn):
+    return '%.1f' % (benchutil.peak_rss_delta_kb(fn) / 1024.0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--height', type=int, default=1024)
+    parser.add_argument('--width', type=int, default=2048)
+    parser.add_argument('--regions', type=int, default=24)
+    parser.add_argument('--tile-widths', type=int, nargs='+', default=[256, 512, 1024])
+    parser.add_argument('--overlap', type=int, default=128)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    sm = fixtures.saliency_map(args.height, args.width, args.regions)
+    shift = args.width // 2
+    panorama = np.roll(sm, shift, axis=1)
+
+    reference = _unroll(MaskMaker.make_bounding_boxes(sm), 0, args.width)
+    whole = benchutil.time_call(lambda: MaskMaker.make_regions(sm), repeat=args.repeat)
+
+    rows = [('whole map', '-', '%.1f' % (whole['median'] * 1000), '1.00x', _peak_mb(lambda: MaskMaker.make_regions(sm)),
+             len(reference), len(reference))]
+
+    for tile_width in args.tile_widths:
+        for workers in args.workers:
+            segment = lambda: MaskMaker.make_panorama_regions(panorama, tile_width, args.overlap, workers)
+
+            boxes = _unroll(MaskMaker.regions_to_bounding_boxes(segment()), shift, args.width)
+            t = benchutil.time_call(segment, repeat=args.repeat)
+
+            rows.append((tile_width, workers, '%.1f' % (t['median'] * 1000), '%.2fx' % (whole['median'] / t['median']),
+                         _peak_mb(segment), len(boxes), len(set(boxes) & set(reference))))
+
+    benchutil.print_table(('tile width', 'workers', 'median ms', 'speedup', 'peak MB', 'boxes', 'same boxes'), rows)
+
+
+if __name__ == '__main__':
+    main()
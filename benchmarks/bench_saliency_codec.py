@@ -0,0 +1,40 @@
+from __future__ import print_function
+import argparse
+import benchutil
+import fixtures
+import SaliencyCodec
+
+'''
+Compares saliency map decode time, document size and peak memory across SaliencyCodec formats.
+
+    python benchmarks/bench_saliency_codec.py --size 640 --repeat 20
+'''
+
+
+def _decode(doc, fmt):
+    SaliencyCodec.decode(doc, fmt=fmt).sum()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=640)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    sm = fixtures.saliency_map(args.size, args.size)
+    rows = []
+
+    for fmt in ('json', 'png', 'npy', 'raw'):
+        doc = SaliencyCodec.encode(sm, fmt)
+        assert (SaliencyCodec.decode(doc) == sm).all()
+
+        t = benchutil.time_call(lambda: _decode(doc, fmt), repeat=args.repeat)
+        rss = benchutil.peak_rss_delta_kb(_decode, doc, fmt)
+
+        rows.append((fmt, len(doc), '%.3f' % (t['median'] * 1000), '%.3f' % (t['best'] * 1000), rss))
+
+    benchutil.print_table(('format', 'bytes', 'median ms', 'best ms', 'peak rss delta KB'), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import benchutil
+
+'''
+Worker cold-start time, and the import time of each task module, per package, in fresh interpreters.
+
+    python benchmarks/bench_startup.py --repeat 5
+'''
+
+MATRIX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'matrixmaster')
+TASK_MODULES = ['MaskTask', 'ScoreTask', 'LandmarkMarker', 'CropTask', 'FusedTask']
+
+# Loads the worker as a module, not as __main__, so it doesn't start polling, then imports each task module.
+# Reports the duration of each phase on stderr, after the import time lines of its imports.
+CHILD = r'''
+import sys
+import time
+
+if not getattr(sys, '_xoptions', {}).get('importtime'):
+    try:
+        import __builtin__ as builtins
+    except ImportError:
+        import builtins
+
+    _import = builtins.__import__
+    _children = [0]
+
+    def _timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+        if name in sys.modules and not fromlist:
+            return _import(name, globals, locals, fromlist, level)
+
+        known = set(sys.modules)
+        _children.append(0)
+        start = time.time()
+
+        try:
+            return _import(name, globals, locals, fromlist, level)
+        finally:
+            cumulative = int((time.time() - start) * 1e6)
+            children = _children.pop()
+            new = [m for m in sys.modules if m not in known and sys.modules[m] is not None]
+
+            if new:
+                _children[-1] += cumulative
+                label = name if name in new else min(new, key=len)
+                sys.stderr.write('import time: %9d | %10d | %s%s\n' % (
+                    cumulative - children, cumulative, '  ' * (len(_children) - 1), label))
+
+    builtins.__import__ = _timed_import
+
+if sys.version_info[0] >= 3:
+    import importlib.util
+
+    def load_worker(path):
+        spec = importlib.util.spec_from_file_location('worker', path)
+        spec.loader.exec_module(importlib.util.module_from_spec(spec))
+else:
+    import imp
+
+    def load_worker(path):
+        imp.load_source('worker', path)
+
+
+def phase(name, start):
+    sys.stderr.write('startup phase: %s %d\n' % (name, (time.time() - start) * 1e6))
+
+
+sys.path.insert(0, sys.argv[1])
+sys.stderr.write('startup phase: begin 0\n')
+
+start = time.time()
+load_worker(sys.argv[2])
+phase('worker', start)
+
+for name in sys.argv[3:]:
+    start = time.time()
+    __import__(name)
+    phase(name, start)
+'''
+
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)')
+PHASE_LINE = re.compile(r'^startup phase: (\S+) (\d+)')
+
+
+def _parse(stderr):
+    """
+    Returns [(phase, seconds, [(module, self seconds, cumulative seconds, depth)])], in phase order.
+    """
+    phases = []
+    imports = []
+
+    for line in stderr.splitlines():
+        m = PHASE_LINE.match(line)
+        if m:
+            if m.group(1) != 'begin':
+                phases.append((m.group(1), int(m.group(2)) / 1e6, imports))
+            imports = []
+            continue
+
+        m = IMPORT_LINE.match(line)
+        if m:
+            imports.append((m.group(4), int(m.group(1)) / 1e6, int(m.group(2)) / 1e6, len(m.group(3)) // 2))
+
+    return phases
+
+
+def run_once(tasks):
+    args = [sys.executable]
+    if sys.version_info >= (3, 7):
+        args += ['-X', 'importtime']
+
+    p = subprocess.Popen(args + ['-c', CHILD, MATRIX_DIR, os.path.join(MATRIX_DIR, '__main__.py')] + tasks,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    stderr = p.communicate()[1]
+
+    if p.returncode:
+        raise RuntimeError('Loading the worker failed:\n' + stderr)
+
+    return _parse(stderr)
+
+
+def packages(imports):
+    """
+    Returns {top-level package: [self seconds, modules]} of the imports of a phase.
+    """
+    totals = {}
+
+    for module, self_seconds, _, _ in imports:
+        package = totals.setdefault(module.split('.')[0], [0.0, 0])
+        package[0] += self_seconds
+        package[1] += 1
+
+    return totals
+
+
+def run(tasks, repeat=3):
+    """
+    Returns the fastest of `repeat` runs, as {phase: {'seconds', 'modules', 'packages', 'imports'}}, with the phase
+    order under 'order'.
+    """
+    runs = [run_once(tasks) for _ in range(repeat)]
+    best = min(runs, key=lambda phases: sum(seconds for _, seconds, _ in phases))
+
+    results = {'order': [name for name, _, _ in best]}
+    for name, seconds, imports in best:
+        results[name] = {
+            'seconds': seconds,
+            'modules': len(imports),
+            'packages': dict((p, {'seconds': s, 'modules': n}) for p, (s, n) in packages(imports).items()),
+            'imports': [{'module': m, 'self': s, 'cumulative': c, 'depth': d} for m, s, c, d in imports]
+        }
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', nargs='*', default=TASK_MODULES, help='task modules to import after the worker')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--top', type=int, default=10, help='packages to list per phase')
+    parser.add_argument('--output', help='write results to this JSON file')
+    args = parser.parse_args()
+
+    results = run(args.tasks, args.repeat)
+    phases = results['order']
+
+    benchutil.print_table(('phase', 'ms', 'modules imported'), [
+        (name, '%.1f' % (results[name]['seconds'] * 1000), results[name]['modules']) for name in phases
+    ])
+
+    rows = []
+    for name in phases:
+        heaviest = sorted(results[name]['packages'].items(), key=lambda p: -p[1]['seconds'])[:args.top]
+        rows.extend((name, package, '%.1f' % (p['seconds'] * 1000), p['modules']) for package, p in heaviest)
+
+    print()
+    benchutil.print_table(('phase', 'package', 'self ms', 'modules'), rows)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'environment': {'python': platform.python_version(), 'platform': platform.platform()},
+                'results': results
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
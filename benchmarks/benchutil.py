@@ -0,0 +1,65 @@
+from __future__ import print_function
+import gc
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+# Benchmarks import the worker modules the same way the worker does (flat, from the app directory)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'matrixmaster'))
+
+
+def time_call(fn, repeat=5, number=1):
+    """
+    Runs `fn` `number` times per sample, `repeat` samples. Returns per-call seconds as {'best', 'median'}.
+    """
+    samples = []
+
+    for _ in range(repeat):
+        gc.collect()
+        start = time.time()
+        for _ in range(number):
+            fn()
+        samples.append((time.time() - start) / number)
+
+    samples.sort()
+
+    return {'best': samples[0], 'median': samples[len(samples) // 2]}
+
+
+def peak_rss_kb():
+    # ru_maxrss is in KB on Linux, bytes on OSX
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def _measure_in_child(queue, fn, args):
+    gc.collect()
+    before = peak_rss_kb()
+    fn(*args)
+    queue.put(peak_rss_kb() - before)
+
+
+def peak_rss_delta_kb(fn, *args):
+    """
+    Runs `fn(*args)` in a forked child and returns how much it grew the child's peak RSS, in KB.
+    Forking keeps earlier measurements from masking later ones, since peak RSS never goes down.
+    """
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_measure_in_child, args=(queue, fn, args))
+    p.start()
+    delta = queue.get()
+    p.join()
+
+    return delta
+
+
+def print_table(headers, rows):
+    widths = [max(len(str(h)), *[len(str(r[i])) for r in rows]) if rows else len(str(h))
+              for i, h in enumerate(headers)]
+    fmt = '  '.join('{:<%d}' % w for w in widths)
+
+    print(fmt.format(*headers))
+    for r in rows:
+        print(fmt.format(*r))
@@ -0,0 +1,37 @@
+import numpy as np
+
+'''
+Deterministic synthetic inputs for benchmarks.
+Saliency maps are sums of Gaussian blobs, which gives the smooth, multi-region maps the saliency service produces.
+'''
+
+
+def saliency_map(height=640, width=640, regions=8, seed=0):
+    rng = np.random.RandomState(seed)
+    ys, xs = np.mgrid[0:height, 0:width]
+    sm = np.zeros((height, width), np.float64)
+
+    for _ in range(regions):
+        cy, cx = rng.uniform(0, height), rng.uniform(0, width)
+        sy, sx = rng.uniform(0.02, 0.08) * height, rng.uniform(0.02, 0.08) * width
+        sm += rng.uniform(0.5, 1.0) * np.exp(-(((ys - cy) / sy) ** 2 + ((xs - cx) / sx) ** 2) / 2.0)
+
+    sm += rng.uniform(0, 0.05, sm.shape)
+
+    return (255 * sm / sm.max()).astype(np.uint8)
+
+
+def frame(height=640, width=640, regions=8, seed=0):
+    """
+    RGB frame with a textured background and solid, brightly coloured objects where the matching saliency map
+    (same arguments) is high.
+    """
+    rng = np.random.RandomState(seed + 1)
+    img = rng.randint(60, 120, (height, width, 3)).astype(np.uint8)
+    sm = saliency_map(height, width, regions, seed)
+
+    for i, level in enumerate(np.linspace(0.5, 0.9, 3)):
+        colour = rng.randint(150, 256, 3).astype(np.uint8)
+        img[sm > level * 255] = colour
+
+    return img
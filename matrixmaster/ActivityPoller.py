@@ -0,0 +1,148 @@
+import datetime
+import json
+import socket
+import threading
+import time
+import traceback
+from pythoncore.AWS import AWSClient
+import Config
+
+'''
+Polls Step Functions for the tasks of the worker's activities, under the Scheduler.
+A poller claims a slot before it polls, and the task's CPU is only charged once the poll returns one.
+'''
+
+# Period of the CloudWatch metrics of Step Functions, in seconds
+METRIC_PERIOD = 60
+
+
+def activity_backlog(cloudwatch, arn, window):
+    """
+    Returns the number of tasks of activity `arn` scheduled but not started over the last `window` seconds.
+    """
+    end = datetime.datetime.utcnow()
+    start = end - datetime.timedelta(seconds=max(int(window) // METRIC_PERIOD, 1) * METRIC_PERIOD)
+    counts = {}
+
+    for metric in ('ActivitiesScheduled', 'ActivitiesStarted'):
+        data = cloudwatch.get_metric_statistics(
+            Namespace='AWS/States',
+            MetricName=metric,
+            Dimensions=[{'Name': 'ActivityArn', 'Value': arn}],
+            StartTime=start,
+            EndTime=end,
+            Period=METRIC_PERIOD,
+            Statistics=['Sum']
+        )
+        counts[metric] = sum(point['Sum'] for point in data['Datapoints'])
+
+    return max(int(counts['ActivitiesScheduled'] - counts['ActivitiesStarted']), 0)
+
+
+class ActivityPoller(object):
+    def __init__(self, scheduler, activities, processes=None, client=None, cloudwatch=None):
+        """
+        `activities` is a list of (name, activity ARN, handler (task_input, task_token, claimed_at)), `name` being the
+        activity's name in `scheduler`, and `claimed_at` the time the task was claimed, which deadlines count from.
+        With HandlerProcesses `processes`, tasks run on its processes by activity name, and are heartbeated meanwhile;
+        otherwise their handlers run on the poller threads. The Step Functions and CloudWatch clients default to
+        AWSClient's.
+        """
+        self.scheduler = scheduler
+        self.activities = activities
+        self.processes = processes
+        self.worker_name = socket.gethostname()
+        self.backoff = Config.get_float('MATRIX_POLL_BACKOFF', 5)
+        self.heartbeat_interval = Config.get_float('MATRIX_HEARTBEAT_INTERVAL', 60)
+
+        self._client = client
+        self._cloudwatch = cloudwatch
+        self._stopped = threading.Event()
+
+    def start(self):
+        """
+        Starts the pollers and the backlog updates, and blocks until stop().
+        """
+        self._client = self._client or AWSClient.get_client('stepfunctions')
+        self._cloudwatch = self._cloudwatch or AWSClient.get_client('cloudwatch')
+
+        threads = [self._start_thread(self._update_backlog)]
+        for name, arn, handler in self.activities:
+            threads.extend(self._start_thread(self._poll, name, arn, handler)
+                           for _ in range(self.scheduler.max_slots(name)))
+
+        for t in threads:
+            t.join()
+
+    def stop(self):
+        """
+        Stops polling once the pollers' current polls and tasks are done. Pollers waiting for a slot stay blocked.
+        """
+        self._stopped.set()
+
+    @staticmethod
+    def _start_thread(target, *args):
+        t = threading.Thread(target=target, args=args)
+        t.daemon = True
+        t.start()
+        return t
+
+    def _poll(self, name, arn, handler):
+        while not self._stopped.is_set():
+            self.scheduler.acquire(name)
+            token = None
+            started = None
+            failed = False
+
+            try:
+                task = self._client.get_activity_task(activityArn=arn, workerName=self.worker_name)
+                token = task.get('taskToken')
+
+                # A long poll that ends without a task returns no token
+                if token:
+                    self.scheduler.start(name)
+                    started = time.time()
+                    self._run(name, handler, json.loads(task['input']), token, started)
+
+            except Exception as e:
+                traceback.print_exc()
+
+                # A claimed task whose handler failed is reported, so Step Functions doesn't wait for its timeout
+                if token:
+                    self._send_failure(token, e)
+
+                # Only failed polls are backed off from
+                failed = not token
+
+            finally:
+                self.scheduler.release(name, started)
+
+            if failed:
+                self._stopped.wait(self.backoff)
+
+    def _run(self, name, handler, task_input, token, started):
+        if self.processes is None:
+            handler(task_input, token, started)
+        else:
+            self.processes.run(name, task_input, token, started,
+                               heartbeat=lambda: self._client.send_task_heartbeat(taskToken=token),
+                               interval=self.heartbeat_interval)
+
+    def _send_failure(self, token, error):
+        try:
+            self._client.send_task_failure(taskToken=token, error='MATRIX MASTER ERROR', cause=str(error))
+        except Exception:
+            traceback.print_exc()
+
+    def _update_backlog(self):
+        interval = Config.get_float('MATRIX_BACKLOG_INTERVAL', 60)
+        window = Config.get_float('MATRIX_BACKLOG_WINDOW', 300)
+
+        while not self._stopped.is_set():
+            for name, arn, _ in self.activities:
+                try:
+                    self.scheduler.set_backlog(name, activity_backlog(self._cloudwatch, arn, window))
+                except Exception:
+                    traceback.print_exc()
+
+            self._stopped.wait(interval)
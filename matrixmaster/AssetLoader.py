@@ -0,0 +1,460 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+from pythoncore import Constants
+from pythoncore.AWS import AWSClient
+import Config
+import ImageDecoder
+import Instrumentation
+import SaliencyCodec
+
+'''
+Loads and decodes the per-hit S3 assets (Street View frames and saliency maps) shared by the pipeline stages.
+Decoded arrays are cached by (bucket, key, ETag), in memory and optionally on disk; they are shared, so read-only.
+'''
+
+STREETVIEW_IMAGE = 'STREETVIEW_IMAGES'
+SALIENCY_MAP = 'SALIENCY_MAPS'
+
+# Assets of one landmark position of a hit. Assets that were not requested are None.
+# image_size is the (width, height) of the full frame, which `image` is smaller than when decoded at reduced scale.
+HitAssets = namedtuple('HitAssets', ['position', 'image', 'saliency_matrix', 'image_size'])
+
+
+class ArrayCache(object):
+    def __init__(self, max_bytes, disk_dir=None, max_disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+        if disk_dir and not os.path.isdir(disk_dir):
+            os.makedirs(disk_dir)
+
+    def get(self, key):
+        with self._lock:
+            arr = self._entries.pop(key, None)
+
+            if arr is not None:
+                # Re-insert as most recently used
+                self._entries[key] = arr
+                self.hits += 1
+                return arr
+
+        arr = self._read_disk(key)
+
+        with self._lock:
+            if arr is None:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+
+        if arr is not None:
+            self._put_memory(key, arr)
+
+        return arr
+
+    def put(self, key, arr):
+        self._put_memory(key, arr)
+        self._write_disk(key, arr)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'disk_evictions': self.disk_evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes
+            }
+
+    def _put_memory(self, key, arr):
+        # Entries larger than the whole budget would only flush everything else out
+        if arr.nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+
+            self._entries[key] = arr
+            self._bytes += arr.nbytes
+
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def _disk_path(self, key):
+        digest = hashlib.sha1('\0'.join(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.disk_dir, digest + '.npy')
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+
+        path = self._disk_path(key)
+
+        try:
+            arr = np.load(path, allow_pickle=False)
+        except (IOError, OSError, ValueError):
+            return None
+
+        # Touch, so pruning evicts least recently used files first
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        arr.flags.writeable = False
+        return arr
+
+    def _write_disk(self, key, arr):
+        if not self.disk_dir:
+            return
+
+        # Write to a temp file and rename, so concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, arr, allow_pickle=False)
+            os.rename(tmp_path, self._disk_path(key))
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        self._prune_disk()
+
+    def _prune_disk(self):
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith('.npy'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.disk_dir, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, name))
+
+        total = sum(f[1] for f in files)
+
+        for _, size, name in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.disk_dir, name))
+            except OSError:
+                continue
+            total -= size
+            with self._lock:
+                self.disk_evictions += 1
+
+
+cache = ArrayCache(
+    Config.get_int('MATRIX_ASSET_CACHE_BYTES', 256 * 1024 * 1024),
+    disk_dir=Config.get_str('MATRIX_ASSET_CACHE_DIR'),
+    max_disk_bytes=Config.get_int('MATRIX_ASSET_DISK_CACHE_BYTES', 2 * 1024 * 1024 * 1024)
+)
+
+# Compressed frames, as uint8 arrays of their bytes
+encoded_cache = ArrayCache(Config.get_int('MATRIX_ENCODED_CACHE_BYTES', 64 * 1024 * 1024))
+
+
+def streetview_image_key(hit_id, position):
+    return "{}_{}.jpg".format(hit_id, position)
+
+
+def saliency_map_key(hit_id, position=None):
+    # Saliency maps predating per-position frames are keyed by hit only
+    if position is None:
+        return "{}.json".format(hit_id)
+
+    return "{}_{}.json".format(hit_id, position)
+
+
+def decode_image(data, key=None, order=ImageDecoder.RGB):
+    return ImageDecoder.decode(data, order)
+
+
+def _cache_key(bucket, key, etag, variant=None):
+    return (bucket, key, etag, variant) if variant else (bucket, key, etag)
+
+
+def _head(bucket, key, client, metrics):
+    with metrics.span('s3_head'):
+        return client.head_object(Bucket=bucket, Key=key)['ETag']
+
+
+def fetch(bucket, key, etag=None, client=None, metrics=None, keep=False):
+    """
+    Returns (bytes, ETag) of the S3 object at bucket/key. With `keep`, the bytes are kept in the encoded cache, and
+    served from it while the object's ETag is `etag`.
+    """
+    client = client or AWSClient.get_client('s3')
+    metrics = metrics or Instrumentation.current()
+
+    if keep and etag is not None:
+        encoded = encoded_cache.get(_cache_key(bucket, key, etag))
+
+        if encoded is not None:
+            metrics.count('encoded_cache_hits')
+            return encoded.tobytes(), etag
+
+    with metrics.span('s3_get'):
+        response = client.get_object(Bucket=bucket, Key=key)
+        data = response['Body'].read()
+
+    metrics.count('assets_downloaded')
+    metrics.count('bytes_downloaded', len(data))
+
+    if keep:
+        encoded_cache.put(_cache_key(bucket, key, response['ETag']), np.frombuffer(data, np.uint8))
+
+    return data, response['ETag']
+
+
+def load(bucket, key, decoder, etag=None, client=None, metrics=None, variant=None, keep_encoded=False):
+    """
+    Returns the decoded asset at bucket/key, from cache if the S3 object is unchanged.
+    `decoder` takes (bytes, key) and returns a NumPy array. If `etag` is not known, it is fetched with a HEAD request.
+    Decodings of one object other than the default one name a `variant`, under which they are cached. Objects decoded
+    in several variants should `keep_encoded`, so each variant is decoded from the same download.
+    Requests, decoding and bytes downloaded are recorded to `metrics` (default: this thread's task metrics).
+    """
+    client = client or AWSClient.get_client('s3')
+    metrics = metrics or Instrumentation.current()
+
+    if etag is None:
+        etag = _head(bucket, key, client, metrics)
+
+    arr = cache.get(_cache_key(bucket, key, etag, variant))
+
+    if arr is not None:
+        metrics.count('asset_cache_hits')
+        return arr
+
+    data, etag = fetch(bucket, key, etag, client, metrics, keep_encoded)
+
+    with metrics.span('decode'):
+        arr = decoder(data, key)
+    arr.flags.writeable = False
+
+    cache.put(_cache_key(bucket, key, etag, variant), arr)
+
+    return arr
+
+
+def get_streetview_image(hit_id, position, etag=None, client=None, metrics=None, order=ImageDecoder.RGB,
+                         min_size=None):
+    """
+    Returns the Street View frame for a hit and position, as a read-only HxWx3 uint8 array in `order` (RGB or BGR).
+    With `min_size` (width, height) the frame may be decoded at reduced scale; see get_streetview_frame.
+    """
+    return get_streetview_frame(hit_id, position, etag, client, metrics, order, min_size)[0]
+
+
+def get_streetview_frame(hit_id, position, etag=None, client=None, metrics=None, order=ImageDecoder.RGB,
+                         min_size=None):
+    """
+    Returns (frame, (width, height) of the full frame) for a hit and position, the frame as get_streetview_image.
+    With `min_size`, the frame is decoded at the smallest scale that keeps it at least that size, and rects in full
+    frame pixels must be scaled by its size over the full frame's.
+    """
+    bucket = Constants.S3_BUCKETS['STREETVIEW_IMAGES']
+    key = streetview_image_key(hit_id, position)
+
+    # Full frames in RGB are the default decoding
+    full_variant = None if order == ImageDecoder.RGB else order
+
+    if min_size is None:
+        arr = load(bucket, key, lambda data, key: decode_image(data, key, order), etag, client, metrics,
+                   variant=full_variant, keep_encoded=True)
+        return arr, (arr.shape[1], arr.shape[0])
+
+    client = client or AWSClient.get_client('s3')
+    metrics = metrics or Instrumentation.current()
+
+    if etag is None:
+        etag = _head(bucket, key, client, metrics)
+
+    # A full frame another stage already decoded serves as well
+    full = cache.get(_cache_key(bucket, key, etag, full_variant))
+    if full is not None:
+        metrics.count('asset_cache_hits')
+        return full, (full.shape[1], full.shape[0])
+
+    arr = load(bucket, key, lambda data, key: ImageDecoder.decode_reduced(data, min_size, order)[0], etag, client,
+               metrics, variant='{}@{}x{}'.format(order, *min_size), keep_encoded=True)
+
+    return arr, get_streetview_size(hit_id, position, etag, client, metrics)
+
+
+def get_streetview_size(hit_id, position, etag=None, client=None, metrics=None):
+    """
+    Returns the (width, height) of the Street View frame for a hit and position, read from the frame's header: from
+    the cached frame, or else from the first MATRIX_FRAME_HEADER_BYTES of it, fetched with a ranged GET.
+    """
+    bucket = Constants.S3_BUCKETS['STREETVIEW_IMAGES']
+    key = streetview_image_key(hit_id, position)
+    client = client or AWSClient.get_client('s3')
+    metrics = metrics or Instrumentation.current()
+
+    if etag is None:
+        etag = _head(bucket, key, client, metrics)
+
+    size_key = _cache_key(bucket, key, etag, 'size')
+    size = cache.get(size_key)
+
+    if size is not None:
+        metrics.count('asset_cache_hits')
+        return int(size[0]), int(size[1])
+
+    encoded = encoded_cache.get(_cache_key(bucket, key, etag))
+
+    if encoded is not None:
+        size = ImageDecoder.image_size(encoded.tobytes())
+    else:
+        with metrics.span('s3_get_range'):
+            response = client.get_object(Bucket=bucket, Key=key, Range='bytes=0-{}'.format(
+                Config.get_int('MATRIX_FRAME_HEADER_BYTES', 16 * 1024) - 1))
+            data = response['Body'].read()
+
+        metrics.count('bytes_downloaded', len(data))
+
+        try:
+            size = ImageDecoder.image_size(data)
+        except IOError:
+            # The header is longer than the range
+            size = ImageDecoder.image_size(fetch(bucket, key, etag, client, metrics, keep=True)[0])
+
+    cache.put(size_key, np.array(size))
+
+    return size
+
+
+def get_saliency_matrix(hit_id, position=None, etag=None, client=None, metrics=None):
+    """
+    Returns the saliency map for a hit and position, as a read-only HxW uint8 array.
+    """
+    return load(Constants.S3_BUCKETS['SALIENCY_MAPS'], saliency_map_key(hit_id, position),
+                SaliencyCodec.decode, etag=etag, client=client, metrics=metrics)
+
+
+def stats():
+    return cache.stats()
+
+
+def list_hit_objects(bucket, hit_id, client=None, metrics=None):
+    """
+    Returns {key: ETag} of all per-position objects of a hit in a bucket, using one ListObjectsV2 by prefix
+    instead of a HEAD request per position.
+    """
+    client = client or AWSClient.get_client('s3')
+    metrics = metrics or Instrumentation.current()
+    paginator = client.get_paginator('list_objects_v2')
+    etags = {}
+
+    with metrics.span('s3_list'):
+        for page in paginator.paginate(Bucket=bucket, Prefix="{}_".format(hit_id)):
+            for obj in page.get('Contents', []):
+                etags[obj['Key']] = obj['ETag']
+
+    return etags
+
+
+def iter_hit_assets(hit_id, positions, require=STREETVIEW_IMAGE, images=True, saliency_maps=True,
+                    max_workers=None, client=None, image_order=ImageDecoder.RGB, image_min_size=None, listings=None,
+                    image_sizes_only=False):
+    """
+    Downloads and decodes the assets of all `positions` of a hit concurrently, yielding a HitAssets per position
+    in completion order, so callers can start CPU work on the first frame while the others are still in flight.
+
+    Only positions whose `require` asset (STREETVIEW_IMAGE or SALIENCY_MAP) exists are yielded.
+    Saliency maps are the per-position maps; load legacy per-hit maps with get_saliency_matrix(hit_id).
+    Frames are decoded in `image_order`, at reduced scale with `image_min_size`, as get_streetview_frame. With
+    `image_sizes_only`, only the frames' sizes are read, from their headers, and `image` is None.
+    `listings` ({STREETVIEW_IMAGE or SALIENCY_MAP: list_hit_objects()}) are listings the caller already made.
+    """
+    if not positions:
+        return
+
+    client = client or AWSClient.get_client('s3')
+    max_workers = max_workers or Config.get_int('MATRIX_PREFETCH_WORKERS', 8)
+
+    # Downloads run on pool threads, so hand them the caller's task metrics
+    metrics = Instrumentation.current()
+
+    buckets = set([require])
+    if images:
+        buckets.add(STREETVIEW_IMAGE)
+    if saliency_maps:
+        buckets.add(SALIENCY_MAP)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        etags = dict(listings or {})
+        pending_listings = dict((b, executor.submit(list_hit_objects, Constants.S3_BUCKETS[b], hit_id, client, metrics))
+                                for b in buckets if b not in etags)
+        etags.update((b, f.result()) for b, f in pending_listings.items())
+
+        required_keys = {
+            STREETVIEW_IMAGE: streetview_image_key,
+            SALIENCY_MAP: saliency_map_key
+        }
+        present = [p for p in positions if required_keys[require](hit_id, p) in etags[require]]
+
+        # One download per asset, so a position's frame and saliency map are fetched in parallel too.
+        # An asset missing from the listing falls back to a HEAD, which raises if it does not exist.
+        futures = {}
+        for p in present:
+            if images and image_sizes_only:
+                etag = etags[STREETVIEW_IMAGE].get(streetview_image_key(hit_id, p))
+                futures[executor.submit(get_streetview_size, hit_id, p, etag, client, metrics)] = (p, 'image_size')
+            elif images:
+                etag = etags[STREETVIEW_IMAGE].get(streetview_image_key(hit_id, p))
+                futures[executor.submit(get_streetview_frame, hit_id, p, etag, client, metrics, image_order,
+                                        image_min_size)] = (p, 'image')
+
+            if saliency_maps:
+                etag = etags[SALIENCY_MAP].get(saliency_map_key(hit_id, p))
+                futures[executor.submit(get_saliency_matrix, hit_id, p, etag, client, metrics)] = \
+                    (p, 'saliency_matrix')
+
+        pending = dict((p, HitAssets(p, None, None, None)) for p in present)
+        remaining = dict((p, int(images) + int(saliency_maps)) for p in present)
+
+        for future in as_completed(futures):
+            p, field = futures[future]
+
+            if field == 'image':
+                image, image_size = future.result()
+                pending[p] = pending[p]._replace(image=image, image_size=image_size)
+            else:
+                pending[p] = pending[p]._replace(**{field: future.result()})
+
+            remaining[p] -= 1
+
+            if remaining[p] == 0:
+                yield pending.pop(p)
@@ -0,0 +1,388 @@
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+import cv2
+from pythoncore import Constants
+from pythoncore.AWS import AWSClient
+from pythoncore.Model import TorchbearerDB
+import AssetLoader
+import LandmarkStore
+import LocalMirror
+import MaskSegmentations
+import ResultCache
+import SaliencyScorer
+import Scheduler
+import ScoreTask
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # Parquet output is optional
+    pyarrow = None
+
+'''
+Re-runs the mask and score stages over historical hits, outside Step Functions, from S3 or a local mirror.
+
+    python matrixmaster/Backfill.py --range 1000 2000 --output results.jsonl
+'''
+
+MASK = 'mask'
+SCORE = 'score'
+DB = 'db'
+
+COLUMNS = ['hit_id', 'position', 'landmark_id', 'stored', 'x1', 'y1', 'x2', 'y2', 'visual_saliency_score']
+
+
+def _row(hit_id, position, landmark_id, stored, rect, visual_saliency_score):
+    rect = rect or {}
+    return {
+        'hit_id': hit_id,
+        'position': position,
+        'landmark_id': str(landmark_id),
+        'stored': stored,
+        'x1': rect.get('x1'),
+        'y1': rect.get('y1'),
+        'x2': rect.get('x2'),
+        'y2': rect.get('y2'),
+        'visual_saliency_score': visual_saliency_score
+    }
+
+
+class Backfiller(object):
+    def __init__(self, stages, write_db, mirror=None):
+        self.stages = stages
+        self.write_db = write_db
+        self.client = LocalMirror.LocalMirror(mirror) if mirror else AWSClient.get_client('s3')
+
+    def process(self, hit_id):
+        """
+        Runs the stages over all positions of a hit, and returns its landmarks as rows. With DB output, the landmarks
+        are written first: the mask stage's replace those of the position's previous segmentation, as MaskTask's do,
+        and the scores of the stored ones are updated.
+        """
+        # Stored landmarks are read for scoring, and written to with DB output
+        session = TorchbearerDB.Session() if SCORE in self.stages or self.write_db else None
+
+        try:
+            rows = []
+            candidates = []
+            updates = []
+            stale = []
+
+            # Frames are only needed for their size, to find rects of stored landmarks that have none
+            for assets in AssetLoader.iter_hit_assets(
+                    hit_id, Constants.LANDMARK_POSITIONS.values(), require=AssetLoader.SALIENCY_MAP,
+                    images=SCORE in self.stages, client=self.client, image_sizes_only=True):
+                boxes = None
+                new = []
+
+                if MASK in self.stages:
+                    key, boxes = ResultCache.bounding_boxes(assets.saliency_matrix)
+                    new = [(ResultCache.landmark_id(hit_id, assets.position, key, i), box)
+                           for i, box in enumerate(boxes)]
+
+                    # Deleted before the stored landmarks are loaded, so the replaced ones are not scored
+                    if self.write_db:
+                        stale.extend(MaskSegmentations.replace(session, hit_id, assets.position, key, len(boxes)))
+
+                new_scores = [None] * len(new)
+
+                if SCORE in self.stages:
+                    new, new_scores = self._score(session, hit_id, assets, boxes, new, rows, updates)
+
+                for (landmark_id, box), visual_saliency_score in zip(new, new_scores):
+                    rows.append(_row(hit_id, assets.position, landmark_id, False, box, visual_saliency_score))
+
+                    if self.write_db:
+                        candidates.append(LandmarkStore.landmark_mapping(
+                            rect=box,
+                            landmark_id=landmark_id,
+                            hit_id=hit_id,
+                            position=assets.position,
+                            status="UNKNOWN",
+                            visual_saliency_score=visual_saliency_score
+                        ))
+
+            if self.write_db:
+                LandmarkStore.insert_landmarks(session, candidates, skip_existing=True)
+                LandmarkStore.update_landmarks(session, updates)
+                session.commit()
+
+                # Images of the deleted landmarks are removed once nothing references them
+                try:
+                    MaskSegmentations.delete_images(stale)
+                except Exception:
+                    traceback.print_exc()
+
+            return rows
+
+        except Exception:
+            if session is not None:
+                session.rollback()
+            raise
+
+        finally:
+            if session is not None:
+                session.close()
+
+    @staticmethod
+    def _score(session, hit_id, assets, boxes, new, rows, updates):
+        """
+        Scores the stored landmarks of the position, adding their rows and updates, and the `new` (id, box) landmarks
+        of the map's `boxes`. Returns the new landmarks not stored yet, and their scores.
+        """
+        sm = assets.saliency_matrix
+        landmarks = LandmarkStore.load_for_scoring(session, hit_id, assets.position)
+
+        # Landmarks of an earlier run over the same map are stored already, and scored as such
+        stored_ids = set(str(landmark.landmark_id) for landmark in landmarks)
+        new = [(landmark_id, box) for landmark_id, box in new if str(landmark_id) not in stored_ids]
+
+        # The search reuses the mask stage's boxes, or segments the map when it did not run
+        rects, scores, position_updates = ScoreTask.score_landmarks(
+            SaliencyScorer.SaliencyScorer(sm), landmarks, assets.image_size,
+            lambda level: boxes if boxes is not None else ResultCache.bounding_boxes(sm)[1],
+            new_rects=[box for _, box in new])
+        updates.extend(position_updates)
+
+        for i, landmark in enumerate(landmarks):
+            rows.append(_row(hit_id, assets.position, landmark.landmark_id, True, rects[i], scores[i]))
+
+        return new, scores[len(landmarks):]
+
+
+# The Backfiller of this pool process
+_backfiller = None
+
+
+def _init_process(stages, write_db, mirror):
+    global _backfiller
+
+    # OpenCV's own threads would compete with the pool processes
+    cv2.setNumThreads(0)
+    _backfiller = Backfiller(stages, write_db, mirror)
+
+
+def _process(hit_id):
+    """
+    Returns (hit_id, rows, None), or (hit_id, None, error) when the hit failed.
+    """
+    try:
+        return hit_id, _backfiller.process(hit_id), None
+    except Exception:
+        return hit_id, None, traceback.format_exc()
+
+
+class Checkpoint(object):
+    """
+    Append-only file of completed hit ids.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = set(line.strip() for line in f if line.strip())
+
+        self._file = open(path, 'a')
+
+    def __contains__(self, hit_id):
+        return str(hit_id) in self.done
+
+    def add(self, hit_ids):
+        for hit_id in hit_ids:
+            self._file.write('{}\n'.format(hit_id))
+            self.done.add(str(hit_id))
+
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class DBWriter(object):
+    """
+    Pool processes write each hit to the DB; it is durable when they return it.
+    """
+    def write(self, hit_id, rows):
+        return [hit_id]
+
+    def close(self):
+        return []
+
+
+class JsonLinesWriter(object):
+    def __init__(self, path):
+        self._file = open(path, 'a')
+
+    def write(self, hit_id, rows):
+        """
+        Writes the rows of a hit, and returns the hits now durable.
+        """
+        for row in rows:
+            self._file.write(json.dumps(row, sort_keys=True) + '\n')
+
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        return [hit_id]
+
+    def close(self):
+        self._file.close()
+        return []
+
+
+class ParquetWriter(object):
+    def __init__(self, path, batch_size):
+        if pyarrow is None:
+            raise ValueError("Parquet output requires pyarrow")
+
+        self.path = path
+        self.batch_size = batch_size
+        self._hits = []
+        self._rows = []
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def write(self, hit_id, rows):
+        self._hits.append(hit_id)
+        self._rows.extend(rows)
+
+        return self.close() if len(self._hits) >= self.batch_size else []
+
+    def close(self):
+        """
+        Writes the buffered hits as one Parquet file, and returns them.
+        """
+        hits, rows = self._hits, self._rows
+        self._hits, self._rows = [], []
+
+        if rows:
+            table = pyarrow.Table.from_arrays([pyarrow.array([r[c] for r in rows]) for c in COLUMNS], COLUMNS)
+            name = 'part-{}-{}.parquet'.format(int(time.time() * 1000), os.getpid())
+            pyarrow.parquet.write_table(table, os.path.join(self.path, name))
+
+        return hits
+
+
+def _writer(output, batch_size):
+    if output == DB:
+        return DBWriter()
+
+    if output.endswith('.parquet'):
+        return ParquetWriter(output, batch_size)
+
+    return JsonLinesWriter(output)
+
+
+def _report(done, failed, total, start):
+    seconds = time.time() - start
+    print("Backfilled {}/{} hits ({} failed) in {:.0f}s, {:.2f} hits/s".format(
+        done, total, failed, seconds, done / seconds if seconds else 0.0))
+    sys.stdout.flush()
+
+
+def run(hit_ids, stages, output, mirror=None, processes=None, checkpoint_path=None, batch_size=100,
+        report_interval=10):
+    """
+    Backfills `hit_ids`, skipping those in the checkpoint. Returns the ids of the hits that failed.
+    """
+    checkpoint = Checkpoint(checkpoint_path or ('backfill' if output == DB else output) + '.checkpoint')
+    pending = [h for h in hit_ids if h not in checkpoint]
+    print("{} hits to backfill, {} already done".format(len(pending), len(hit_ids) - len(pending)))
+
+    writer = _writer(output, batch_size)
+    processes = processes or int(Scheduler.available_cpus())
+    init_args = (stages, output == DB, mirror)
+
+    # With one process, hits run here, which keeps tracebacks and debuggers simple
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, _init_process, init_args)
+        results = pool.imap_unordered(_process, pending)
+    else:
+        _init_process(*init_args)
+        results = (_process(h) for h in pending)
+
+    start = last_report = time.time()
+    done = 0
+    failed = []
+
+    try:
+        for hit_id, rows, error in results:
+            if error is None:
+                checkpoint.add(writer.write(hit_id, rows))
+                done += 1
+            else:
+                print("Hit {} failed:\n{}".format(hit_id, error))
+                failed.append(hit_id)
+
+            if time.time() - last_report >= report_interval:
+                _report(done, len(failed), len(pending), start)
+                last_report = time.time()
+
+        checkpoint.add(writer.close())
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    finally:
+        if pool is not None:
+            pool.terminate()
+        checkpoint.close()
+
+    _report(done, len(failed), len(pending), start)
+
+    return failed
+
+
+def _hit_id(value):
+    value = value.strip()
+    return int(value) if value.isdigit() else value
+
+
+def _hit_ids(args):
+    if args.range:
+        return list(range(args.range[0], args.range[1]))
+
+    if args.hits_file:
+        f = sys.stdin if args.hits_file == '-' else open(args.hits_file)
+        with f:
+            return [_hit_id(line) for line in f if line.strip()]
+
+    return [_hit_id(h) for h in args.hits]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-run the mask and score stages over historical hits.')
+    hits = parser.add_mutually_exclusive_group(required=True)
+    hits.add_argument('--hits', nargs='+', help='hit ids')
+    hits.add_argument('--range', nargs=2, type=int, metavar=('START', 'END'), help='hit ids START to END - 1')
+    hits.add_argument('--hits-file', help='file of hit ids, one per line; - for stdin')
+    parser.add_argument('--stages', nargs='+', choices=[MASK, SCORE], default=[MASK, SCORE])
+    parser.add_argument('--output', required=True, help="'db', or a .jsonl file or .parquet directory")
+    parser.add_argument('--mirror', help='read assets from this local mirror of the S3 buckets')
+    parser.add_argument('--processes', type=int, help='pool processes (default: cores available)')
+    parser.add_argument('--checkpoint', help='checkpoint file (default: OUTPUT.checkpoint)')
+    parser.add_argument('--batch-size', type=int, default=100, help='hits per Parquet file')
+    parser.add_argument('--report-interval', type=float, default=10, help='seconds between progress reports')
+    args = parser.parse_args()
+
+    failed = run(_hit_ids(args), args.stages, args.output, args.mirror, args.processes, args.checkpoint,
+                 args.batch_size, args.report_interval)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
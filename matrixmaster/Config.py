@@ -0,0 +1,37 @@
+import os
+
+'''
+Worker settings read from the environment.
+All settings are optional; a missing or empty variable falls back to the given default.
+'''
+
+
+def get_str(name, default=None):
+    value = os.environ.get(name)
+    return value if value else default
+
+
+def get_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def get_float(name, default):
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+
+def get_bool(name, default=False):
+    value = os.environ.get(name)
+
+    if not value:
+        return default
+
+    return value.lower() not in ('0', 'false', 'no', 'off')
+
+
+def fused_pipeline():
+    """
+    Returns whether mask, score and mark run as one fused task on the mask activity (see FusedTask).
+    """
+    return get_bool('MATRIX_FUSED_PIPELINE', False)
@@ -1,137 +1,222 @@
-import json
-import uuid
-from io import BytesIO
 import traceback
-import numpy as np
-from PIL import Image
 from pythoncore import Task, Constants
-from pythoncore.AWS import AWSClient
-from pythoncore.Model import TorchbearerDB, Landmark
-from matplotlib import pyplot as plt
+from pythoncore.Model import TorchbearerDB
 import os
+import numpy as np
 import GrabCut
 import MaskMaker
+import AssetLoader
+import Deadline
+import Degradations
+import ImageDecoder
+import ImageEncoder
+import LandmarkStore
+import MaskSegmentations
+import ResultCache
+import SaliencyScorer
+import UploadQueue
+import Instrumentation
 
 
 class CropFromSaliencyTask(Task.Task):
-    def __init__(self, ep_id, hit_id, task_token):
+    def __init__(self, ep_id, hit_id, task_token, claimed_at=None):
         super(CropFromSaliencyTask, self).__init__(ep_id, hit_id, task_token)
+        self.claimed_at = claimed_at
 
     def run(self):
+        metrics = Instrumentation.start('crop_from_saliency', self.ep_id, self.hit_id)
+        budget = Deadline.Budget('crop_from_saliency', metrics, started=self.claimed_at)
+
         # Create DB session
         session = TorchbearerDB.Session()
 
-        try:
-            for position in Constants.LANDMARK_POSITIONS.values():
-                if AWSClient.s3_key_exists(Constants.S3_BUCKETS['STREETVIEW_IMAGES'],
-                                           "{}_{}.jpg".format(self.hit_id, position)):
-                    # Load saliency mask and image from S3
-                    sm = self._get_saliency_matrix()
-                    img = self._get_streetview_image(position)
-
-                    if os.environ.get('debug'):
-                        plt.imshow(img, alpha=1)
-                        plt.imshow(sm, alpha=0.6)
-                        plt.show()
-
-                    # Compute sum of saliency mask
-                    image_saliency_sum = sm.sum()
-
-                    # Get list of individual salient regions
-                    masks = MaskMaker.get_masks_from_saliency_map(sm)
-
-                    for mask in masks:
-                        candidate = GrabCut.crop_image_with_saliency_mask(img, mask)
-
-                        # Tack a GUID onto candidate dict
-                        candidate['id'] = uuid.uuid1()
-
-                        candidate['position'] = position
-
-                        # Compute visual saliency score
-                        r = candidate['rect']
-                        region_saliency_sum = sm[r['y1']:r['y2'], r['x1']:r['x2']].sum()
-                        candidate['visual_saliency_score'] = region_saliency_sum / float(image_saliency_sum)
+        # Cropped images are uploaded in the background while the next candidates are segmented
+        uploads = UploadQueue.batch()
 
-                        # candidate["image"].show()
-                        # candidate["image_transparent"].show()
+        # Cropped image, and its cut-out with transparent background
+        encoders = ImageEncoder.Encoder('crop'), ImageEncoder.Encoder('crop_transparent')
 
-                        # Put cropped images into S3
-                        self._put_cropped_images(candidate)
-
-                        # Insert candidate landmark into DB
-                        self._insert_candidate_landmark(candidate, session)
-
-            # Commit DB inserts
-            session.commit()
+        try:
+            # Position => candidate landmarks, and the key their ids derive from
+            candidates = {}
+            ids_keys = {}
+
+            # Saliency map is per hit, not per position, so its integral image is built once and every candidate is
+            # scored from it
+            sm = AssetLoader.get_saliency_matrix(self.hit_id)
+
+            with metrics.span('integral_image'):
+                scorer = SaliencyScorer.SaliencyScorer(sm)
+
+            for assets in metrics.timed('load_assets', AssetLoader.iter_hit_assets(
+                    self.hit_id, Constants.LANDMARK_POSITIONS.values(), saliency_maps=False)):
+                position = assets.position
+                img = assets.image
+                metrics.count('positions')
+
+                if os.environ.get('debug'):
+                    from matplotlib import pyplot as plt
+                    plt.imshow(img, alpha=1)
+                    plt.imshow(sm, alpha=0.6)
+                    plt.show()
+
+                # Short of time, the map is segmented at a lower resolution, which finds different regions
+                level = budget.level()
+                scale = Deadline.mask_scale(level, MaskMaker.parameters()['scale'])
+
+                # Landmark ids derive from the segmentation's input and settings only, those of full output at any
+                # level, so a retry, a run at another level, or a change of the frame, GrabCut or encoding settings
+                # gets the same ids and replaces the landmarks of the run before
+                ids_key = ResultCache.result_key('crop_from_saliency', [sm], {'mask': MaskMaker.parameters()})
+
+                # Cut-outs are cached by everything they are computed from, so a retry over the same inputs reuses them
+                key = ResultCache.result_key('crop_from_saliency_cut_outs', [sm, img], {
+                    'mask': MaskMaker.parameters(),
+                    'grabcut': GrabCut.parameters(),
+                    'encoding': [encoder.parameters() for encoder in encoders]
+                })
+                crops = self._crops(key, img, sm, encoders, scale, level, budget, metrics)
+
+                metrics.count('regions', len(crops))
+                candidates[position] = []
+                ids_keys[position] = ids_key
+
+                for i, (rect, image_bytes, transparent_bytes, crop_level) in enumerate(crops):
+                    candidate = {
+                        'id': ResultCache.landmark_id(self.hit_id, position, ids_key, i),
+                        'position': position,
+                        'rect': rect,
+                        'visual_saliency_score': float(scorer.score(rect))
+                    }
+
+                    budget.record(candidate['id'], crop_level)
+
+                    # Put cropped images into S3
+                    self._put_cropped_images(candidate['id'], image_bytes, transparent_bytes, encoders, uploads,
+                                             metrics)
+
+                    # Queue candidate landmark for the DB
+                    candidates[position].append(self._candidate_landmark_mapping(candidate))
+
+            # Wait until all cropped images are stored, before landmarks referencing them are committed
+            with metrics.span('upload_wait'):
+                uploads.flush(UploadQueue.flush_timeout())
+
+            metrics.count('bytes_uploaded', uploads.bytes)
+
+            # The candidates replace the landmarks of the segmentation this stage recorded for their position last, so a
+            # re-run leaves no duplicates behind, while landmarks other services stored are kept. Record which of them
+            # got degraded cut-outs, and commit.
+            stale = []
+            with metrics.span('db_commit'):
+                for position, mappings in candidates.items():
+                    stale.extend(MaskSegmentations.replace(
+                        session, self.hit_id, position, ids_keys[position], len(mappings),
+                        model=MaskSegmentations.CropFromSaliencySegmentation))
+                    LandmarkStore.upsert_landmarks(session, mappings)
+
+                Degradations.store(session, 'crop_from_saliency', budget.levels)
+                session.commit()
+
+            metrics.count('landmarks', sum(len(mappings) for mappings in candidates.values()))
+            metrics.count('landmarks_deleted', len(stale))
+
+            # Images of the deleted landmarks are removed once nothing references them
+            try:
+                with metrics.span('s3_delete'):
+                    MaskSegmentations.delete_images(stale)
+            except Exception:
+                traceback.print_exc()
 
             # Send success!
             self.send_success()
 
         except Exception as e:
             traceback.print_exc()
+            metrics.error(e)
             session.rollback()
+            uploads.cancel()
             self.send_failure('MATRIX MASTER ERROR', e.message)
 
-    def _get_saliency_matrix(self):
-        client = AWSClient.get_client('s3')
-        response = client.get_object(
-            Bucket=Constants.S3_BUCKETS['SALIENCY_MAPS'],
-            Key="{0}.json".format(self.hit_id)
-        )
-        data = json.load(response['Body'])
-        return np.array(data["saliencyMatrix"], np.uint8)
-
-    def _get_streetview_image(self, position):
-        client = AWSClient.get_client('s3')
-        response = client.get_object(
-            Bucket=Constants.S3_BUCKETS['STREETVIEW_IMAGES'],
-            Key="{}_{}.jpg".format(self.hit_id, position)
-        )
-        img = Image.open(response['Body'])
-        # img.show()
-        return np.array(img)
+        finally:
+            metrics.finish()
 
     @staticmethod
-    def _put_cropped_images(candidate):
-        img_file = BytesIO()
-        transparent_img_file = BytesIO()
-        candidate['image'].save(img_file, 'PNG')
-        candidate['image_transparent'].save(transparent_img_file, 'PNG')
-        img_file.seek(0)
-        transparent_img_file.seek(0)
-
-        client = AWSClient.get_client('s3')
-
-        # Put cropped image
-        client.put_object(
-            Body=img_file,
-            ContentType='image/png',
-            Bucket=Constants.S3_BUCKETS['CROPPED_IMAGES'],
-            Key="{0}.png".format(candidate['id'])
-        )
-
-        # Put transparent cropped image
-        client.put_object(
-            Body=transparent_img_file,
-            ContentType='image/png',
-            Bucket=Constants.S3_BUCKETS['TRANSPARENT_CROPPED_IMAGES'],
-            Key="{0}.png".format(candidate['id'])
-        )
+    def _crops(key, img, sm, encoders, scale, level, budget, metrics=Instrumentation.NULL):
+        """
+        Returns (rect, image, transparent image, level) of the GrabCut cut-out of each salient region of `sm` from
+        `img`, with the images encoded by `encoders`, from the result cache when they were computed before.
+        `sm` is segmented at `scale`, output of `level`. Regions are cut out most salient first, each with the GrabCut
+        iterations `budget` still affords.
+        """
+        cached = ResultCache.get(key)
+
+        if cached is not None:
+            metrics.count('result_cache_hits')
+            doc, blobs = cached
+            return [(rect, blobs[2 * i], blobs[2 * i + 1], Deadline.FULL) for i, rect in enumerate(doc['rects'])]
+
+        # Get list of individual salient regions
+        with metrics.span('segment'):
+            regions, masks = MaskMaker.make_region_masks(sm, scale)
+
+        iterations = GrabCut.parameters()['iterations']
+        rects = [None] * len(masks)
+        levels = [None] * len(masks)
+        encodes = [None] * len(masks)
+
+        # Cut-outs are encoded on the encoder pool while the next regions are segmented
+        for i in np.argsort(-regions['saliency'], kind='mergesort'):
+            levels[i] = Deadline.worst(level, budget.level())
+
+            with metrics.span('grabcut'):
+                candidate = GrabCut.crop_image_with_saliency_mask(
+                    img, masks[i], iterations=Deadline.grabcut_iterations(levels[i], iterations))
+
+            rects[i] = dict((k, int(v)) for k, v in candidate['rect'].items())
+            encodes[i] = [ImageEncoder.submit(encoder, np.asarray(candidate[name]), order=ImageDecoder.RGB)
+                          for encoder, name in zip(encoders, ('image', 'image_transparent'))]
+
+        with metrics.span('encode_wait'):
+            blobs = [[encode.result() for encode in pair] for pair in encodes]
+
+        # Degraded cut-outs are not cached, so a later run with time to spare does them in full
+        if all(crop_level == Deadline.FULL for crop_level in levels):
+            ResultCache.put(key, {'rects': rects}, [blob for pair in blobs for blob in pair])
+
+        return [(rect, pair[0], pair[1], crop_level) for rect, pair, crop_level in zip(rects, blobs, levels)]
 
-    def _insert_candidate_landmark(self, candidate, session):
-        landmark = Landmark.Landmark(
+    @staticmethod
+    def _put_cropped_images(landmark_id, image_bytes, transparent_bytes, encoders, uploads,
+                            metrics=Instrumentation.NULL):
+        with metrics.span('upload_enqueue'):
+            # Put cropped image
+            uploads.put(
+                Constants.S3_BUCKETS['CROPPED_IMAGES'],
+                ImageEncoder.s3_key(landmark_id),
+                image_bytes,
+                content_type=encoders[0].content_type
+            )
+
+            # Put transparent cropped image
+            uploads.put(
+                Constants.S3_BUCKETS['TRANSPARENT_CROPPED_IMAGES'],
+                ImageEncoder.s3_key(landmark_id),
+                transparent_bytes,
+                content_type=encoders[1].content_type
+            )
+
+    def _candidate_landmark_mapping(self, candidate):
+        return LandmarkStore.landmark_mapping(
+            rect=candidate['rect'],
             landmark_id=candidate['id'],
             hit_id=self.hit_id,
             visual_saliency_score=candidate['visual_saliency_score'],
             position=candidate['position']
         )
-        landmark.set_rect(candidate['rect'])
-
-        session.add(landmark)
 
 
 if __name__ == '__main__':
     # Test
-    x = MaskTask(21, '123456gh')
+    x = CropFromSaliencyTask(21, 6, '123456gh')
     x.run()
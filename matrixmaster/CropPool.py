@@ -0,0 +1,181 @@
+import multiprocessing
+import os
+import tempfile
+import threading
+import numpy as np
+import Config
+import GrabCut
+
+'''
+Runs the per-landmark GrabCut cut-outs of a frame on a pool of worker processes.
+The frame is written once to shared memory (/dev/shm) and mapped read-only by the workers; jobs only carry its path.
+'''
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Pool => number of batches in flight on it
+_batches = {}
+
+# Worker-side cache of the most recently mapped frame, by path and file identity, as temp file names get reused
+_frame_key = None
+_frame = None
+
+
+def pool_size():
+    workers = Config.get_int('MATRIX_CROP_WORKERS', 0)
+
+    if workers > 0:
+        return workers
+
+    # Split the cores between the crop activities that may run at once
+    return max(multiprocessing.cpu_count() // max(Config.get_int('MATRIX_CROP_CONCURRENCY', 2), 1), 1)
+
+
+class CropPoolError(Exception):
+    pass
+
+
+def start():
+    """
+    Creates the pool of worker processes, unless cut-outs run inline. Call before starting other threads.
+    """
+    if pool_size() > 1:
+        get_pool()
+
+
+def get_pool():
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = multiprocessing.Pool(pool_size())
+
+    return _pool
+
+
+def _acquire_pool():
+    """
+    Returns the current pool, counting a batch in flight on it until _release_pool.
+    """
+    pool = get_pool()
+
+    with _pool_lock:
+        _batches[pool] = _batches.get(pool, 0) + 1
+
+    return pool
+
+
+def _release_pool(pool, failed=False):
+    """
+    Ends a batch on `pool`. A `failed` batch replaces the pool, if it is still the current one. A replaced pool is
+    terminated by the last batch that leaves it.
+    """
+    global _pool
+
+    with _pool_lock:
+        _batches[pool] -= 1
+
+        if failed and _pool is pool:
+            _pool = multiprocessing.Pool(pool_size())
+
+        drained = _pool is not pool and not _batches[pool]
+
+        if drained:
+            del _batches[pool]
+
+    if drained:
+        pool.terminate()
+
+
+def _shared_memory_dir():
+    return Config.get_str('MATRIX_SHARED_MEMORY_DIR', '/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+
+class SharedFrame(object):
+    """
+    Context manager writing a frame to shared memory for the pool workers, and removing it on exit. Without a pool
+    (MATRIX_CROP_WORKERS=1) nothing is written, and cut-outs run inline.
+    """
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.path = None
+
+    def __enter__(self):
+        if pool_size() == 1:
+            return self
+
+        fd, self.path = tempfile.mkstemp(dir=_shared_memory_dir(), prefix='matrix-frame-', suffix='.npy')
+
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.ascontiguousarray(self.frame), allow_pickle=False)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # Workers keep their mapping until they map the next frame, so the file can go right away
+        if self.path is not None:
+            os.remove(self.path)
+
+    def cut_out_all(self, rects, iterations=None):
+        """
+        Cuts out every landmark rect of the frame, with `iterations` GrabCut iterations (default: the configured ones).
+        Returns the BGRA crops in the order of `rects`.
+        """
+        if not rects:
+            return []
+
+        if self.path is None:
+            return [cut_out(self.frame, rect, iterations) for rect in rects]
+
+        pool = _acquire_pool()
+        failed = False
+
+        try:
+            result = pool.map_async(_cut_out_job, [(self.path, tuple(rect), iterations) for rect in rects])
+            return result.get(Config.get_float('MATRIX_CROP_TIMEOUT', 300))
+        except multiprocessing.TimeoutError:
+            # The pool never returns the results of a job whose worker died, so its workers can't be trusted either
+            failed = True
+            raise CropPoolError("{} cut-outs timed out on the crop pool".format(len(rects)))
+        finally:
+            _release_pool(pool, failed)
+
+
+def cut_out(frame, rect, iterations=None):
+    """
+    Segments the landmark within `rect` ((x1, y1, x2, y2)) of a BGR frame with GrabCut.
+    Returns the landmark's crop as a BGRA array, with non-foreground pixels transparent.
+    """
+    # GrabCut's temporaries come from the worker's scratch buffers, and only the crop is allocated
+    return GrabCut.cut_out(frame, rect, iterations=iterations)
+
+
+def _open_frame(path):
+    global _frame_key, _frame
+
+    st = os.stat(path)
+    key = (path, st.st_ino, st.st_size, st.st_mtime)
+
+    if key != _frame_key:
+        _frame = np.load(path, mmap_mode='r')
+        _frame_key = key
+
+    return _frame
+
+
+def _cut_out_job(args):
+    path, rect, iterations = args
+    return cut_out(_open_frame(path), rect, iterations)
+
+
+def cut_out_all(frame, rects):
+    """
+    Cuts out every landmark rect of a BGR frame. Returns the BGRA crops in the order of `rects`.
+    """
+    if not rects:
+        return []
+
+    with SharedFrame(frame) as shared:
+        return shared.cut_out_all(rects)
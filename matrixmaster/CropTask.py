@@ -1,114 +1,153 @@
 from pythoncore import Task, Constants
-from pythoncore.AWS import AWSClient
 from pythoncore.Model import TorchbearerDB
 from pythoncore.Model.Landmark import Landmark
 from pythoncore.Model.Hit import Hit
-from PIL import Image
-from io import StringIO
 import traceback
-import cv2
-import numpy as np
 import os
-from matplotlib import pyplot as plt
+import AssetLoader
+import CropPool
+import Deadline
+import Degradations
+import GrabCut
+import ImageDecoder
+import ImageEncoder
+import UploadQueue
+import Instrumentation
 
 
 class CropTask(Task.Task):
-    def __init__(self, ep_id, hit_id, task_token):
+    def __init__(self, ep_id, hit_id, task_token, claimed_at=None):
         super(CropTask, self).__init__(ep_id, hit_id, task_token)
+        self.claimed_at = claimed_at
 
     def run(self):
+        metrics = Instrumentation.start('crop', self.ep_id, self.hit_id)
+        budget = Deadline.Budget('crop', metrics, started=self.claimed_at)
+
         # Create DB session
         session = TorchbearerDB.Session()
 
+        # Cropped images are uploaded in the background while the next landmarks are segmented
+        uploads = UploadQueue.batch()
+
+        encoder = ImageEncoder.Encoder('crop_transparent')
+
         try:
             hit = session.query(Hit).filter_by(hit_id=self.hit_id).one()
             hit.set_start_time_for_task("crop")
 
             # Load from S3, across all positions available for corresponding ExecutionPoint
-            for position in Constants.LANDMARK_POSITIONS.values():
-                if AWSClient.s3_key_exists(Constants.S3_BUCKETS['STREETVIEW_IMAGES'],
-                                           "{}_{}.jpg".format(self.hit_id, position)):
-
-                    img = self._get_streetview_image(position)
-
-                    # Load all Landmarks for this hit, position
-                    for landmark in session.query(Landmark).filter_by(hit_id=self.hit_id, position=position).all():
-                        # Crop image according to Landmark rect
-                        rect = landmark.get_rect()
-                        rect = (rect['x1'], rect['y1'], rect['x2'], rect['y2'])
-
-                        # Perform image segmentation to extract foreground object
-                        arr = np.asarray(img)
-                        cv_img = cv2.cvtColor(arr, cv2.COLOR_RGB2BGR)
-
-                        mask = np.zeros(cv_img.shape[:2], np.uint8)
-                        bgdModel = np.zeros((1, 65), np.float64)
-                        fgdModel = np.zeros((1, 65), np.float64)
-
-                        cv2.grabCut(cv_img, mask, rect, bgdModel, fgdModel, 5, cv2.GC_INIT_WITH_RECT)
-
-                        # If mask==2 or mask== 1, mask2 get 0, other wise it gets 1 as 'uint8' type.
-                        mask2 = np.where((mask == 2) | (mask == 0), 0, 1).astype('uint8')
-
-                        # Project image into RGBA space
-                        cv_img = cv2.cvtColor(cv_img, cv2.COLOR_BGR2BGRA)
-
-                        # Set alpha based on segment_mask.
-                        # Set red channel to 100% for viewers that don't support alpha channel.
-                        cv_img[mask2 == 0] = [255, 0, 0, 0]
-
-                        # Convert cv2 img back to PIL img
-                        img = Image.fromarray(cv_img)
-
-                        # Crop cut image down to landmark rect
-                        img = img.crop(rect)
-
-                        if os.environ.get('debug'):
-                            plt.imshow(img)
-                            plt.show()
-
-                        # Put cropped images into S3
-                        self._put_cropped_image(img, landmark.landmark_id)
+            for assets in metrics.timed('load_assets', AssetLoader.iter_hit_assets(
+                    self.hit_id, Constants.LANDMARK_POSITIONS.values(), saliency_maps=False,
+                    image_order=ImageDecoder.BGR)):
+                position = assets.position
+                # Decoded in BGR, for OpenCV
+                cv_frame = assets.image
+                metrics.count('positions')
+
+                # Load all Landmarks for this hit, position
+                with metrics.span('db_load'):
+                    landmarks = session.query(Landmark).filter_by(hit_id=self.hit_id, position=position).all()
+
+                # Crop image according to Landmark rects
+                rects = []
+                for landmark in landmarks:
+                    rect = landmark.get_rect()
+                    rects.append((rect['x1'], rect['y1'], rect['x2'], rect['y2']))
+
+                # Perform image segmentation to extract foreground objects, fanned out across the crop workers.
+                # Cut-outs come back in landmark order, so uploads happen in a deterministic order.
+                with metrics.span('grabcut'):
+                    cut_outs = self._cut_outs(cv_frame, landmarks, rects, budget)
+
+                if os.environ.get('debug'):
+                    from matplotlib import pyplot as plt
+                    for cut_out in cut_outs:
+                        plt.imshow(cut_out)
+                        plt.show()
+
+                # Cut-outs are encoded on the encoder pool. Their channels have always been stored in the order
+                # they were cut out in, as when PIL encoded them as RGBA.
+                with metrics.span('encode'):
+                    encoded = list(ImageEncoder.encode_all(encoder, cut_outs, order=ImageDecoder.RGB))
+
+                for landmark, img_bytes in zip(landmarks, encoded):
+                    # Put cropped images into S3
+                    self._put_cropped_image(img_bytes, landmark.landmark_id, encoder.content_type, uploads, metrics)
+
+                metrics.count('landmarks', len(landmarks))
+
+            # Wait until all cropped images are stored
+            with metrics.span('upload_wait'):
+                uploads.flush(UploadQueue.flush_timeout())
+
+            metrics.count('bytes_uploaded', uploads.bytes)
 
             hit.set_end_time_for_task("crop")
 
-            # Commit DB inserts, if any
-            session.commit()
+            # Commit DB inserts, if any, and which landmarks got degraded cut-outs
+            with metrics.span('db_commit'):
+                Degradations.store(session, 'crop', budget.levels)
+
+                session.commit()
 
             # Send success!
             self.send_success()
 
         except Exception as e:
             traceback.print_exc()
+            metrics.error(e)
             session.rollback()
+            uploads.cancel()
             self.send_failure('CROP_ERROR', e.message)
 
         finally:
             session.close()
-
-    def _get_streetview_image(self, position):
-        client = AWSClient.get_client('s3')
-        response = client.get_object(
-            Bucket=Constants.S3_BUCKETS['STREETVIEW_IMAGES'],
-            Key="{}_{}.jpg".format(self.hit_id, position)
-        )
-        img = Image.open(response['Body'])
-        # img.show()
-        return img
+            metrics.finish()
 
     @staticmethod
-    def _put_cropped_image(img, landmark_id):
-        img_file = StringIO()
-        img.save(img_file, 'PNG')
-
-        client = AWSClient.get_client('s3')
+    def _cut_outs(frame, landmarks, rects, budget):
+        """
+        Returns the cut-out of each of `rects` (the rects of `landmarks`) from `frame`, in order.
+        Against a deadline, landmarks are cut out most salient first, one per crop worker at a time, each with the
+        GrabCut iterations `budget` still affords, and the level of each landmark is recorded with `budget`.
+        """
+        if not rects:
+            return []
+
+        with CropPool.SharedFrame(frame) as shared:
+            if not budget.limited:
+                for landmark in landmarks:
+                    budget.record(landmark.landmark_id, Deadline.FULL)
+
+                return shared.cut_out_all(rects)
+
+            order = sorted(range(len(rects)), key=lambda i: -(landmarks[i].visual_saliency_score or 0))
+            iterations = GrabCut.parameters()['iterations']
+            batch = CropPool.pool_size()
+            cut_outs = [None] * len(rects)
+
+            for start in range(0, len(order), batch):
+                level = budget.level()
+                indices = order[start:start + batch]
+
+                for i, cut_out in zip(indices, shared.cut_out_all([rects[i] for i in indices],
+                                                                  Deadline.grabcut_iterations(level, iterations))):
+                    cut_outs[i] = cut_out
+                    budget.record(landmarks[i].landmark_id, level)
+
+            return cut_outs
 
+    @staticmethod
+    def _put_cropped_image(img_bytes, landmark_id, content_type, uploads, metrics=Instrumentation.NULL):
         # Put cropped image
-        client.put_object(
-            Body=img_file,
-            Bucket=Constants.S3_BUCKETS['TRANSPARENT_CROPPED_IMAGES'],
-            Key="{0}.png".format(landmark_id)
-        )
+        with metrics.span('upload_enqueue'):
+            uploads.put(
+                Constants.S3_BUCKETS['TRANSPARENT_CROPPED_IMAGES'],
+                ImageEncoder.s3_key(landmark_id),
+                img_bytes,
+                content_type=content_type
+            )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,113 @@
+import time
+import Config
+import Instrumentation
+
+'''
+Time budgets of the tasks whose work grows with the number of landmarks.
+A Budget counts from the time the task was claimed, and lowers the level of output (full, reduced, minimal) the task
+can afford as it is used up.
+'''
+
+FULL = 'full'
+REDUCED = 'reduced'
+MINIMAL = 'minimal'
+
+# Levels, from the most to the least expensive
+LEVELS = (FULL, REDUCED, MINIMAL)
+
+
+def deadline(task):
+    """
+    Returns the deadline of a run of `task`, in seconds, or 0 when it has none.
+    """
+    return Config.get_float('MATRIX_{}_DEADLINE'.format(task.upper()), Config.get_float('MATRIX_TASK_DEADLINE', 0))
+
+
+def worst(*levels):
+    """
+    Returns the least expensive of `levels`.
+    """
+    return max(levels, key=LEVELS.index)
+
+
+def grabcut_iterations(level, iterations):
+    """
+    Returns the GrabCut iterations of output at `level`, `iterations` being those of full output. 0 skips GrabCut.
+    """
+    if level == FULL:
+        return iterations
+
+    if level == REDUCED:
+        return min(Config.get_int('MATRIX_DEADLINE_GRABCUT_ITERATIONS', 1), iterations)
+
+    return 0
+
+
+def mask_scale(level, scale):
+    """
+    Returns the segmentation downscaling factor of output at `level`, `scale` being that of full output.
+    """
+    if level == FULL:
+        return scale
+
+    return max(Config.get_float('MATRIX_DEADLINE_MASK_SCALE', 4), scale)
+
+
+class Budget(object):
+    def __init__(self, task, metrics=Instrumentation.NULL, seconds=None, started=None):
+        """
+        Budget of a run of `task` claimed at time `started` (default now), of `seconds` or the task's configured
+        deadline.
+        """
+        self.task = task
+        self.seconds = deadline(task) if seconds is None else seconds
+        self.reduced_at = Config.get_float('MATRIX_DEADLINE_REDUCED_AT', 0.5)
+        self.minimal_at = Config.get_float('MATRIX_DEADLINE_MINIMAL_AT', 0.8)
+
+        # Landmark id (str) => level of its output
+        self.levels = {}
+
+        self._metrics = metrics
+        self._start = time.time() if started is None else started
+
+    @property
+    def limited(self):
+        return self.seconds > 0
+
+    def elapsed(self):
+        return time.time() - self._start
+
+    def remaining(self):
+        """
+        Returns the seconds left until the deadline, or None without one.
+        """
+        return self.seconds - self.elapsed() if self.limited else None
+
+    def level(self):
+        """
+        Returns the level of output the task can afford now.
+        """
+        if not self.limited:
+            return FULL
+
+        used = self.elapsed() / self.seconds
+
+        if used >= self.minimal_at:
+            return MINIMAL
+
+        return REDUCED if used >= self.reduced_at else FULL
+
+    def record(self, landmark_id, level):
+        """
+        Records that the output of a landmark was made at `level`.
+        """
+        self.levels[str(landmark_id)] = level
+
+        if level != FULL:
+            self._metrics.count('landmarks_{}'.format(level))
+
+    def degraded(self):
+        """
+        Returns the ids of the landmarks recorded with less than full output.
+        """
+        return [i for i, level in self.levels.items() if level != FULL]
@@ -0,0 +1,61 @@
+from sqlalchemy import Column, String
+import Deadline
+import LandmarkStore
+
+'''
+Landmarks whose output a task degraded to meet its deadline (see Deadline), in the side table landmark_degradation.
+A later run that gives a landmark full output removes its row.
+'''
+
+
+class LandmarkDegradation(LandmarkStore.SideTable):
+    __tablename__ = 'landmark_degradation'
+
+    landmark_id = Column(String(36), primary_key=True)
+    task = Column(String(32), primary_key=True)
+    level = Column(String(16), nullable=False)
+
+
+def load(session, task, landmark_ids):
+    """
+    Returns {landmark id (str): level} of the landmarks in `landmark_ids` whose `task` output is degraded.
+    """
+    return LandmarkStore.load_side_values(session, LandmarkDegradation.level, landmark_ids,
+                                          LandmarkDegradation.task == task)
+
+
+def store(session, task, levels):
+    """
+    Stores {landmark id: level} of `task`'s output, removing the rows of landmarks that got full output.
+    Committed with the session.
+    """
+    levels = dict((str(i), level) for i, level in levels.items())
+    existing = load(session, task, list(levels))
+
+    inserts = [{'landmark_id': i, 'task': task, 'level': level} for i, level in levels.items()
+               if level != Deadline.FULL and i not in existing]
+    updates = [{'landmark_id': i, 'task': task, 'level': level} for i, level in levels.items()
+               if level != Deadline.FULL and i in existing and existing[i] != level]
+    restored = [i for i, level in levels.items() if level == Deadline.FULL and i in existing]
+
+    if inserts:
+        session.bulk_insert_mappings(LandmarkDegradation, inserts)
+
+    if updates:
+        session.bulk_update_mappings(LandmarkDegradation, updates)
+
+    for chunk in LandmarkStore.chunks(restored):
+        session.query(LandmarkDegradation) \
+            .filter(LandmarkDegradation.task == task, LandmarkDegradation.landmark_id.in_(chunk)) \
+            .delete(synchronize_session=False)
+
+
+def delete(session, landmark_ids):
+    """
+    Removes the rows of the landmarks in `landmark_ids`, of every task, as the landmarks are deleted.
+    Committed with the session.
+    """
+    for chunk in LandmarkStore.chunks([str(i) for i in landmark_ids]):
+        session.query(LandmarkDegradation) \
+            .filter(LandmarkDegradation.landmark_id.in_(chunk)) \
+            .delete(synchronize_session=False)
@@ -0,0 +1,223 @@
+import traceback
+from sqlalchemy import Column, Integer, String
+from pythoncore import Task, Constants
+from pythoncore.Model import TorchbearerDB, Hit
+import AssetLoader
+import Deadline
+import Degradations
+import ImageEncoder
+import Instrumentation
+import LandmarkStore
+import MarkRenderer
+import MaskMaker
+import MaskSegmentations
+import ResultCache
+import SaliencyScorer
+import ScoreTask
+import UploadQueue
+
+'''
+Runs the mask, score and mark stages of a hit in one pass, on the mask activity (see Config.fused_pipeline).
+The score and mark activities that follow consume() the completion markers it commits, and report success.
+'''
+
+
+# Activities whose work the fused task does, as named in __main__.TASKS
+ACTIVITIES = ('score', 'mark')
+
+
+class FusedCompletion(LandmarkStore.SideTable):
+    __tablename__ = 'fused_completion'
+
+    hit_id = Column(Integer, primary_key=True, autoincrement=False)
+    ep_id = Column(Integer, primary_key=True, autoincrement=False)
+    activity = Column(String(16), primary_key=True)
+
+
+def consume(ep_id, hit_id, activity):
+    """
+    Removes the marker of a fused task that did the `activity` work of a hit and execution point, and returns whether
+    there was one.
+    """
+    session = TorchbearerDB.Session()
+
+    try:
+        deleted = session.query(FusedCompletion) \
+            .filter_by(hit_id=hit_id, ep_id=ep_id, activity=activity) \
+            .delete(synchronize_session=False)
+        session.commit()
+
+        return deleted > 0
+
+    finally:
+        session.close()
+
+
+class FusedTask(Task.Task):
+    def __init__(self, ep_id, hit_id, task_token, claimed_at=None):
+        super(FusedTask, self).__init__(ep_id, hit_id, task_token)
+        self.claimed_at = claimed_at
+
+    def run(self):
+        print("Starting fused mask, score and mark task for ep {}, hit {}".format(self.ep_id, self.hit_id))
+
+        metrics = Instrumentation.start('fused', self.ep_id, self.hit_id)
+        budget = Deadline.Budget('fused', metrics, started=self.claimed_at)
+
+        # One DB session and one upload batch for all stages
+        session = TorchbearerDB.Session()
+        uploads = UploadQueue.batch()
+
+        try:
+            hit = session.query(Hit.Hit).filter_by(hit_id=self.hit_id).one()
+
+            for task in ("mask", "score", "landmark_mark"):
+                hit.set_start_time_for_task(task)
+
+            candidates = []
+            updates = []
+            stale = []
+
+            # Download each position's saliency map and frame once, for all stages
+            for assets in metrics.timed('load_assets', AssetLoader.iter_hit_assets(
+                    self.hit_id, Constants.LANDMARK_POSITIONS.values(), require=AssetLoader.SALIENCY_MAP)):
+                metrics.count('positions')
+
+                # Short of time, the map is segmented at a lower resolution, which finds different regions
+                level = budget.level()
+
+                with metrics.span('mask'):
+                    key, boxes = self._mask(assets, level, budget, metrics)
+
+                with metrics.span('score'):
+                    landmark_ids, rects = self._score(session, assets, key, boxes, level, budget, candidates, updates,
+                                                      stale, metrics)
+
+                with metrics.span('mark'):
+                    self._mark(assets, landmark_ids, rects, uploads, metrics)
+
+            # Wait until all marked images are stored, before the landmarks are committed
+            with metrics.span('upload_wait'):
+                uploads.flush(UploadQueue.flush_timeout())
+
+            metrics.count('bytes_uploaded', uploads.bytes)
+
+            for task in ("mask", "score", "landmark_mark"):
+                hit.set_end_time_for_task(task)
+
+            # Insert new landmarks, update scores of existing ones, record which of them got degraded output, and
+            # commit once, with the completion markers
+            with metrics.span('db_commit'):
+                LandmarkStore.insert_landmarks(session, candidates, skip_existing=True)
+                LandmarkStore.update_landmarks(session, updates)
+                Degradations.store(session, 'fused', budget.levels)
+
+                # A retry finds the markers of an earlier attempt whose success was not reported
+                for activity in ACTIVITIES:
+                    session.merge(FusedCompletion(hit_id=self.hit_id, ep_id=self.ep_id, activity=activity))
+                session.commit()
+
+            # Images of the deleted landmarks are removed once nothing references them
+            try:
+                with metrics.span('s3_delete'):
+                    MaskSegmentations.delete_images(stale)
+            except Exception:
+                traceback.print_exc()
+
+            # Send success of the mask activity; score and mark report theirs when the state machine reaches them
+            self.send_success()
+            print("Completed fused mask, score and mark task for ep {}, hit {}".format(self.ep_id, self.hit_id))
+
+        except Exception as e:
+            traceback.print_exc()
+            metrics.error(e)
+            session.rollback()
+            uploads.cancel()
+            self.send_failure('MATRIX MASTER ERROR', e.message)
+
+        finally:
+            session.close()
+            metrics.finish()
+
+    def _mask(self, assets, level, budget, metrics):
+        """
+        Segments the position's saliency map for output at `level`. A degraded segmentation has its own result key, so
+        its landmarks are replaced by those of the next run with time to spare.
+        """
+        scale = Deadline.mask_scale(level, MaskMaker.parameters()['scale'])
+        key, boxes = ResultCache.bounding_boxes(assets.saliency_matrix, metrics, scale)
+        metrics.count('regions', len(boxes))
+
+        for i in range(len(boxes)):
+            budget.record(ResultCache.landmark_id(self.hit_id, assets.position, key, i), level)
+
+        return key, boxes
+
+    def _score(self, session, assets, key, boxes, level, budget, candidates, updates, stale, metrics):
+        """
+        Scores the landmarks already stored for the position and the new ones from `boxes`, the result `key` of a
+        segmentation at `level`. Queues the inserts and updates, appends the ids of the landmarks it replaces to
+        `stale`, and returns the ids and rects of all of them, for marking.
+        """
+        sm = assets.saliency_matrix
+
+        with metrics.span('integral_image'):
+            scorer = SaliencyScorer.SaliencyScorer(sm)
+
+        # Landmarks of an earlier segmentation this one replaces are deleted, so they are neither scored nor marked
+        with metrics.span('db_delete'):
+            replaced = MaskSegmentations.replace(session, self.hit_id, assets.position, key, len(boxes))
+
+        stale.extend(replaced)
+        metrics.count('landmarks_deleted', len(replaced))
+
+        # Landmarks stored by other services are scored too, as ScoreTask does
+        with metrics.span('db_load'):
+            landmarks = LandmarkStore.load_for_scoring(session, self.hit_id, assets.position)
+
+        # Boxes stored by an earlier attempt over the same map are among the stored landmarks already
+        stored_ids = set(str(landmark.landmark_id) for landmark in landmarks)
+        new = [(ResultCache.landmark_id(self.hit_id, assets.position, key, i), box) for i, box in enumerate(boxes)]
+        new = [(landmark_id, box) for landmark_id, box in new if str(landmark_id) not in stored_ids]
+
+        # The search reuses the mask stage's boxes, the salient areas it would segment the map for, so it costs
+        # nothing more unless output is minimal, when it is skipped
+        if budget.level() == Deadline.MINIMAL:
+            level = Deadline.MINIMAL
+
+        rects, scores, position_updates = ScoreTask.score_landmarks(
+            scorer, landmarks, assets.image_size, lambda level: boxes, level=level, budget=budget,
+            new_rects=[box for _, box in new], metrics=metrics)
+        updates.extend(position_updates)
+
+        landmark_ids = [landmark.landmark_id for landmark in landmarks]
+
+        for (landmark_id, box), visual_saliency_score in zip(new, scores[len(landmarks):]):
+            landmark_ids.append(landmark_id)
+
+            candidates.append(LandmarkStore.landmark_mapping(
+                rect=box,
+                landmark_id=landmark_id,
+                hit_id=self.hit_id,
+                position=assets.position,
+                status="UNKNOWN",
+                visual_saliency_score=visual_saliency_score
+            ))
+
+        metrics.count('landmarks', len(landmark_ids))
+
+        return landmark_ids, rects
+
+    @staticmethod
+    def _mark(assets, landmark_ids, rects, uploads, metrics):
+        with metrics.span('scale'):
+            renderer = MarkRenderer.MarkRenderer(assets.image)
+
+        for landmark_id, img_bytes in zip(landmark_ids, metrics.timed('render', renderer.render_all(rects))):
+            with metrics.span('upload_enqueue'):
+                uploads.put(
+                    Constants.S3_BUCKETS['MARKED_LANDMARK_IMAGES'],
+                    ImageEncoder.s3_key(landmark_id),
+                    img_bytes,
+                    content_type=renderer.content_type
+                )
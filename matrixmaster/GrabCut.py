@@ -1,8 +1,18 @@
 import numpy as np
 import cv2
-from matplotlib import pyplot as plt
 from PIL import Image
 import os
+import Config
+import ScratchBuffers
+
+'''
+GrabCut segmentation of landmarks, on a region of interest around the rect, with reused scratch buffers.
+With 0 iterations GrabCut is skipped, and the cut-out is the whole rect or the saliency mask.
+'''
+
+
+# Bump when a change to the segmentation changes its results, so results cached by ResultCache are not reused
+VERSION = 1
 
 
 def __bbox2(img):
@@ -14,40 +24,186 @@ def __bbox2(img):
     return rmin, rmax, cmin, cmax
 
 
-def crop_image_with_saliency_mask(img, saliency_mask):
-    # First, run GrabCut to segment image based on Saliency Mask
-    mask_copy = np.copy(saliency_mask).astype('uint8')
-    bgdModel = np.zeros((1,65),np.float64)
-    fgdModel = np.zeros((1,65),np.float64)
-    # mask[saliency_mask == 1] = 3
-    cv2.grabCut(img, mask_copy, None, bgdModel, fgdModel, 5, cv2.GC_INIT_WITH_MASK)
+def _settings(roi, margin, iterations, convergence):
+    return (
+        Config.get_bool('MATRIX_GRABCUT_ROI', True) if roi is None else roi,
+        Config.get_float('MATRIX_GRABCUT_MARGIN', 0.5) if margin is None else margin,
+        Config.get_int('MATRIX_GRABCUT_ITERATIONS', 5) if iterations is None else iterations,
+        Config.get_float('MATRIX_GRABCUT_CONVERGENCE', 0) if convergence is None else convergence
+    )
 
-    # Compute binary mask based on grabcut output (perfect "cut out" of object)
-    segment_mask = np.where((mask_copy==cv2.GC_PR_FGD)|(mask_copy==cv2.GC_FGD), 1, 0).astype('uint8')
 
-    # Find bounding box based on original saliency mask
-    rmin, rmax, cmin, cmax = __bbox2(saliency_mask)
+def parameters(roi=None, margin=None, iterations=None, convergence=None):
+    """
+    Returns the version and settings landmarks are segmented with, as a dict.
+    """
+    roi, margin, iterations, convergence = _settings(roi, margin, iterations, convergence)
+    return {'version': VERSION, 'roi': roi, 'margin': margin, 'iterations': iterations, 'convergence': convergence}
+
+
+def region_of_interest(shape, x1, y1, x2, y2, margin):
+    """
+    Returns the (x1, y1, x2, y2) bounds, exclusive at the end, of the rect grown by `margin` and clipped to the frame.
+    """
+    pad = int(np.ceil(margin * max(x2 - x1, y2 - y1)))
+    return max(x1 - pad, 0), max(y1 - pad, 0), min(x2 + pad, shape[1]), min(y2 + pad, shape[0])
+
+
+def _grabcut(img, mask, rect, bgd_model, fgd_model, iterations, mode, convergence, scratch):
+    # No segmentation: `mask` keeps the labels it was initialized with
+    if not iterations:
+        return 0
+
+    # GrabCut seeds its colour models with k-means on OpenCV's thread-local RNG. Reseed, so a landmark's result does
+    # not depend on which thread or process segmented it, or on what it segmented before.
+    if hasattr(cv2, 'setRNGSeed'):
+        cv2.setRNGSeed(0)
+
+    if not convergence:
+        cv2.grabCut(img, mask, rect, bgd_model, fgd_model, iterations, mode)
+        return iterations
+
+    # Iterate one step at a time, so we can stop once the labels settle
+    cv2.grabCut(img, mask, rect, bgd_model, fgd_model, 1, mode)
+    tolerance = convergence * mask.size
+
+    previous = scratch.take('previous_labels', mask.shape)
+    changed = scratch.take('changed_labels', mask.shape, np.bool_)
+
+    for i in range(1, iterations):
+        np.copyto(previous, mask)
+        cv2.grabCut(img, mask, None, bgd_model, fgd_model, 1, cv2.GC_EVAL)
+
+        if np.count_nonzero(np.not_equal(previous, mask, out=changed)) <= tolerance:
+            return i + 1
+
+    return iterations
+
+
+def _models(bgd_model, fgd_model, scratch):
+    return (scratch.zeros('bgd_model', (1, 65), np.float64) if bgd_model is None else bgd_model,
+            scratch.zeros('fgd_model', (1, 65), np.float64) if fgd_model is None else fgd_model)
+
+
+def _region(img, bounds, scratch):
+    # GrabCut needs a contiguous image, so the region of interest is copied into scratch
+    rx1, ry1, rx2, ry2 = bounds
+    region = scratch.take('region', (ry2 - ry1, rx2 - rx1) + img.shape[2:], img.dtype)
+    np.copyto(region, img[ry1:ry2, rx1:rx2])
+    return region
+
+
+def _segment_rect_region(img, rect, roi, margin, iterations, convergence, bgd_model, fgd_model, scratch):
+    """
+    Runs GrabCut within `rect` on its region of interest. Returns (labels, bounds): GrabCut's labels of the region, in
+    scratch, and the region's (x1, y1, x2, y2) bounds in the frame.
+    """
+    bgd_model, fgd_model = _models(bgd_model, fgd_model, scratch)
 
+    x1, y1, x2, y2 = rect
+    bounds = region_of_interest(img.shape, x1, y1, x2, y2, margin) if roi else (0, 0, img.shape[1], img.shape[0])
+    rx1, ry1, rx2, ry2 = bounds
+
+    if not iterations:
+        # No segmentation: everything within the rect is foreground
+        labels = scratch.zeros('labels', (ry2 - ry1, rx2 - rx1))
+        labels[y1 - ry1:y2 - ry1, x1 - rx1:x2 - rx1] = cv2.GC_PR_FGD
+        return labels, bounds
+
+    region = _region(img, bounds, scratch)
+    labels = scratch.zeros('labels', region.shape[:2])
+
+    # cv2 takes rects as (x, y, width, height), relative to the region of interest
+    _grabcut(region, labels, (x1 - rx1, y1 - ry1, x2 - x1, y2 - y1), bgd_model, fgd_model, iterations,
+             cv2.GC_INIT_WITH_RECT, convergence, scratch)
+
+    return labels, bounds
+
+
+def _composite(img, labels, rect, bounds, scratch):
+    """
+    Returns the `rect` ((x1, y1, x2, y2), exclusive at the end) tile of a 3-channel frame as a new 4-channel array,
+    with the pixels `labels` (GrabCut's labels of the region at `bounds`) does not mark foreground transparent.
+    """
+    x1, y1, x2, y2 = rect
+    rx1, ry1 = bounds[:2]
+
+    src = img[y1:y2, x1:x2]
+    tile = np.empty(src.shape[:2] + (4,), img.dtype)
+    tile[..., :3] = src
+    tile[..., 3] = 255
+
+    # Foreground labels (GC_FGD, GC_PR_FGD) are the odd ones
+    tile_labels = labels[y1 - ry1:y1 - ry1 + tile.shape[0], x1 - rx1:x1 - rx1 + tile.shape[1]]
+    foreground = np.bitwise_and(tile_labels, 1, out=scratch.take('foreground', tile.shape[:2]))
+    background = np.equal(foreground, 0, out=scratch.take('background', tile.shape[:2], np.bool_))
+
+    # Set alpha based on the labels. Set red channel to 100% for viewers that don't support alpha channel.
+    tile[background] = [255, 0, 0, 0]
+
+    return tile
+
+
+def segment_rect(img, rect, roi=None, margin=None, iterations=None, convergence=None, bgd_model=None, fgd_model=None):
     """
-    # Create matrix of 1's based on bounding box--this gives a rectangle around segmented region
-    region = np.ones((rmax-rmin, cmax-cmin), dtype=np.uint8)
-    segment_mask[rmin:rmax, cmin:cmax] = region
+    Segments the foreground object within `rect` ((x1, y1, x2, y2), exclusive at the end) of a BGR frame.
+    Returns a full-frame uint8 mask, 1 for foreground.
+    `bgd_model` and `fgd_model` can be passed in to reuse their buffers across landmarks.
     """
+    roi, margin, iterations, convergence = _settings(roi, margin, iterations, convergence)
+    rect = tuple(int(v) for v in rect)
+
+    with ScratchBuffers.borrow() as scratch:
+        labels, (rx1, ry1, rx2, ry2) = _segment_rect_region(img, rect, roi, margin, iterations, convergence,
+                                                             bgd_model, fgd_model, scratch)
+
+        mask = np.zeros(img.shape[:2], np.uint8)
+        np.bitwise_and(labels, 1, out=mask[ry1:ry2, rx1:rx2])
+
+    return mask
+
+
+def cut_out(img, rect, roi=None, margin=None, iterations=None, convergence=None):
+    """
+    Segments the landmark within `rect` ((x1, y1, x2, y2), exclusive at the end) of a BGR frame.
+    Returns the landmark's crop as a new BGRA array, with non-foreground pixels transparent.
+    Only the region of interest and the crop are ever copied; no full-frame array is allocated.
+    """
+    roi, margin, iterations, convergence = _settings(roi, margin, iterations, convergence)
+    rect = tuple(int(v) for v in rect)
+
+    with ScratchBuffers.borrow() as scratch:
+        labels, bounds = _segment_rect_region(img, rect, roi, margin, iterations, convergence, None, None, scratch)
+        return _composite(img, labels, rect, bounds, scratch)
+
+
+def crop_image_with_saliency_mask(img, saliency_mask, roi=None, margin=None, iterations=None, convergence=None):
+    roi, margin, iterations, convergence = _settings(roi, margin, iterations, convergence)
+
+    # Find bounding box based on original saliency mask
+    rmin, rmax, cmin, cmax = __bbox2(saliency_mask)
+
+    # Everything outside the saliency mask's bounding box is background, so GrabCut only needs to see its surroundings
+    bounds = region_of_interest(img.shape, cmin, rmin, cmax + 1, rmax + 1, margin) if roi else \
+        (0, 0, img.shape[1], img.shape[0])
+    rx1, ry1, rx2, ry2 = bounds
 
-    # Create transparent image
-    img_transparent_bg = np.copy(img)
+    with ScratchBuffers.borrow() as scratch:
+        # First, run GrabCut to segment image based on Saliency Mask
+        labels = scratch.take('labels', (ry2 - ry1, rx2 - rx1))
+        np.copyto(labels, saliency_mask[ry1:ry2, rx1:rx2], casting='unsafe')
+        bgd_model, fgd_model = _models(None, None, scratch)
 
-    # Project transparent image into RGBA space
-    img_transparent_bg = cv2.cvtColor(img_transparent_bg, cv2.COLOR_BGR2BGRA)
+        _grabcut(_region(img, bounds, scratch), labels, None, bgd_model, fgd_model, iterations,
+                 cv2.GC_INIT_WITH_MASK, convergence, scratch)
 
-    # Set alpha based on segment_mask. Set red channel to 100% for viewers that don't support alpha channel.
-    img_transparent_bg[segment_mask == 0] = [255, 0, 0, 0]
+        # Cut the transparent image out of the bounding box only (a perfect "cut out" of the object)
+        image_transparent = _composite(img, labels, (cmin, rmin, cmax, rmax), bounds, scratch)
 
-    # Crop images based on region, convert from BGR to RGB
     image = img[rmin:rmax, cmin:cmax, :]
-    image_transparent = img_transparent_bg[rmin:rmax, cmin:cmax, :]
 
     if os.environ.get('debug'):
+        from matplotlib import pyplot as plt
         plt.imshow(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)),plt.show()
 
     return {
@@ -0,0 +1,110 @@
+import multiprocessing
+import threading
+import traceback
+import Queue
+
+'''
+Runs the activity handlers of the worker on pre-forked processes, so CPU-bound tasks don't share one interpreter's GIL.
+The poller thread of a task waits for its process, sending heartbeats meanwhile; a process that dies is replaced.
+'''
+
+
+class HandlerError(Exception):
+    pass
+
+
+def _serve(conn, handlers, initializer):
+    if initializer is not None:
+        initializer()
+
+    while True:
+        try:
+            name, task_input, task_token, claimed_at = conn.recv()
+        except EOFError:
+            return
+
+        try:
+            handlers[name](task_input, task_token, claimed_at)
+            conn.send(None)
+        except Exception as e:
+            traceback.print_exc()
+            conn.send(str(e) or type(e).__name__)
+
+
+class HandlerProcesses(object):
+    def __init__(self, handlers, size, initializer=None):
+        """
+        `size` processes running the handlers of `handlers` (activity name => handler (task_input, task_token,
+        claimed_at)), each process calling `initializer` first. Create them before starting any thread, as forking a
+        process that runs other threads can leave a child holding a lock no thread will release.
+        """
+        self.handlers = handlers
+        self.initializer = initializer
+
+        self._idle = Queue.Queue()
+
+        # Forks one process at a time, so no process inherits the child end of another's pipe, which would keep the
+        # pipe open when that other process dies
+        self._fork_lock = threading.Lock()
+
+        for _ in range(size):
+            self._idle.put(self._fork())
+
+    def _fork(self):
+        with self._fork_lock:
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_serve, args=(child_conn, self.handlers, self.initializer))
+            process.start()
+            child_conn.close()
+
+        return process, conn
+
+    def run(self, name, task_input, task_token, claimed_at, heartbeat=None, interval=60):
+        """
+        Runs the handler of activity `name` on an idle process, and waits for it, calling `heartbeat` every `interval`
+        seconds meanwhile. Raises HandlerError when the handler raised, or its process died.
+        """
+        process, conn = self._idle.get()
+
+        try:
+            conn.send((name, task_input, task_token, claimed_at))
+
+            # A process that dies closes its end of the pipe, which ends the wait too
+            while not conn.poll(interval):
+                if not process.is_alive():
+                    raise EOFError
+
+                if heartbeat is not None:
+                    try:
+                        heartbeat()
+                    except Exception:
+                        traceback.print_exc()
+
+            error = conn.recv()
+
+        except (EOFError, IOError):
+            # The replacement is forked while the poller threads run, but these only hold the locks of their own
+            # connections, which the handlers don't use
+            conn.close()
+            process.terminate()
+            process.join()
+
+            process, conn = self._fork()
+
+            raise HandlerError("The handler process of a {} task exited".format(name))
+
+        finally:
+            self._idle.put((process, conn))
+
+        if error is not None:
+            raise HandlerError(error)
+
+    def close(self):
+        """
+        Stops the idle processes.
+        """
+        for _ in range(self._idle.qsize()):
+            process, conn = self._idle.get()
+            conn.close()
+            process.terminate()
+            process.join()
@@ -0,0 +1,68 @@
+from io import BytesIO
+import numpy as np
+import cv2
+from PIL import Image
+
+'''
+Decodes the Street View frames straight into the layout their consumer needs: BGR or RGB, at reduced JPEG scale.
+Decoded frames are read-only, so the stages of a hit can share them.
+'''
+
+RGB = 'RGB'
+BGR = 'BGR'
+
+# Frames are decoded as stored, as PIL does; EXIF orientation is not applied
+_IMREAD_FLAGS = cv2.IMREAD_COLOR | getattr(cv2, 'IMREAD_IGNORE_ORIENTATION', 0)
+
+
+def _read_only(arr):
+    arr.flags.writeable = False
+    return arr
+
+
+def decode(data, order=RGB):
+    """
+    Returns the image encoded in `data` (bytes), as a read-only HxWx3 uint8 array in `order` (RGB or BGR).
+    """
+    arr = cv2.imdecode(np.frombuffer(data, np.uint8), _IMREAD_FLAGS)
+
+    if arr is None:
+        raise ValueError("Could not decode image")
+
+    if order == RGB:
+        cv2.cvtColor(arr, cv2.COLOR_BGR2RGB, dst=arr)
+
+    return _read_only(arr)
+
+
+def image_size(data):
+    """
+    Returns the (width, height) of the image encoded in `data` (bytes), read from its header. `data` may be just the
+    start of the image, as long as it holds the header; raises IOError if it does not.
+    """
+    return Image.open(BytesIO(data)).size
+
+
+def decode_reduced(data, min_size, order=RGB):
+    """
+    Returns (image, (width, height) of the full image). JPEG images are decoded at the smallest DCT scale that keeps
+    them at least `min_size` (width, height); other images, or JPEGs too small to reduce, are decoded in full.
+    """
+    img = Image.open(BytesIO(data))
+    size = img.size
+
+    img.draft('RGB', tuple(min_size))
+
+    if img.size == size:
+        return decode(data, order), size
+
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    # np.asarray copies the decoded pixels out of PIL's buffer
+    arr = np.asarray(img)
+
+    if order == BGR:
+        arr = cv2.cvtColor(arr, cv2.COLOR_RGB2BGR)
+
+    return _read_only(arr), size
@@ -0,0 +1,146 @@
+import collections
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import cv2
+import Config
+import ImageDecoder
+
+'''
+Encodes the images the tasks upload (crops, transparent cut-outs, marked frames) as PNG, WebP or JPEG, with
+settings per output type, on a shared thread pool.
+'''
+
+# Output type => whether its images have an alpha channel
+OUTPUTS = {
+    'mark': False,
+    'crop': False,
+    'crop_transparent': True
+}
+
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg'
+}
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+class Encoder(object):
+    def __init__(self, output, fmt=None, png_compression=None, webp_quality=None, jpeg_quality=None):
+        """
+        Encoder for the images of an `output` type. Settings not given are read from the output's MATRIX_* settings.
+        """
+        if output not in OUTPUTS:
+            raise ValueError("Unknown output type {}".format(output))
+
+        prefix = 'MATRIX_{}_'.format(output.upper())
+
+        self.output = output
+        self.fmt = fmt or Config.get_str(prefix + 'FORMAT', 'png')
+
+        if self.fmt == 'png':
+            level = Config.get_int(prefix + 'PNG_COMPRESSION', 3) if png_compression is None else png_compression
+            self._ext, self._params = '.png', [cv2.IMWRITE_PNG_COMPRESSION, level]
+        elif self.fmt == 'webp':
+            quality = Config.get_int(prefix + 'WEBP_QUALITY', 101) if webp_quality is None else webp_quality
+            self._ext, self._params = '.webp', [cv2.IMWRITE_WEBP_QUALITY, quality]
+        elif self.fmt == 'jpeg':
+            if OUTPUTS[output]:
+                raise ValueError("JPEG cannot store the alpha channel of {} images".format(output))
+
+            quality = Config.get_int(prefix + 'JPEG_QUALITY', 90) if jpeg_quality is None else jpeg_quality
+            self._ext, self._params = '.jpg', [cv2.IMWRITE_JPEG_QUALITY, quality]
+        else:
+            raise ValueError("Unsupported {} format {}".format(output, self.fmt))
+
+        self.content_type = CONTENT_TYPES[self.fmt]
+
+    def parameters(self):
+        """
+        Returns the format and settings images are encoded with, as a dict.
+        """
+        return {'format': self.fmt, 'params': list(self._params[1:])}
+
+    def encode(self, img, order=ImageDecoder.BGR):
+        """
+        Returns `img` (an HxWx3 uint8 array, or HxWx4 with alpha, in `order`) encoded, as bytes.
+        """
+        if order == ImageDecoder.RGB:
+            img = cv2.cvtColor(img, cv2.COLOR_RGBA2BGRA if img.shape[2] == 4 else cv2.COLOR_RGB2BGR)
+
+        ok, buf = cv2.imencode(self._ext, img, self._params)
+
+        if not ok:
+            raise ValueError("Could not encode {} image as {}".format(self.output, self.fmt))
+
+        return buf.tobytes()
+
+
+def s3_key(landmark_id):
+    """
+    Returns the S3 key of a landmark's image. Keys stay .png whatever the format, as the front end builds them from the
+    landmark id; uploads carry the format's content type instead.
+    """
+    return "{0}.png".format(landmark_id)
+
+
+def pool_size():
+    workers = Config.get_int('MATRIX_ENCODE_WORKERS', None)
+    return multiprocessing.cpu_count() if workers is None else workers
+
+
+def get_pool():
+    """
+    Returns the shared encoder pool, or None when images are encoded inline.
+    """
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if (_pool is None or _pool_pid != os.getpid()) and pool_size() > 0:
+            _pool = ThreadPoolExecutor(max_workers=pool_size())
+            _pool_pid = os.getpid()
+
+    return _pool
+
+
+def submit(encoder, img, order=ImageDecoder.BGR):
+    """
+    Encodes `img` with `encoder` on the encoder pool. Returns a Future of the bytes.
+    `img` is read while it is encoded, so it must not be modified until the Future is done.
+    """
+    pool = get_pool()
+
+    if pool is not None:
+        return pool.submit(encoder.encode, img, order)
+
+    future = Future()
+
+    try:
+        future.set_result(encoder.encode(img, order))
+    except Exception as e:
+        future.set_exception(e)
+
+    return future
+
+
+def encode_all(encoder, images, order=ImageDecoder.BGR):
+    """
+    Yields the encoding of each of `images` (an iterable of arrays), in order.
+    Up to two images per encoder thread are in flight at once, so `images` must yield a fresh array each time.
+    """
+    window = max(2 * pool_size(), 1)
+    pending = collections.deque()
+
+    for img in images:
+        pending.append(submit(encoder, img, order))
+
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
@@ -0,0 +1,255 @@
+from __future__ import print_function
+import bisect
+import json
+import threading
+import time
+import Config
+
+'''
+Per-task timing and counters.
+A task run opens a TaskMetrics with start(), records spans and counters, and logs them as one JSON line on finish().
+'''
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullMetrics(object):
+    """
+    Recorder used when instrumentation is disabled: every call is a no-op.
+    """
+    enabled = False
+
+    def span(self, name):
+        return _NULL_SPAN
+
+    def timed(self, name, iterable):
+        return iterable
+
+    def count(self, name, n=1):
+        pass
+
+    def error(self, e):
+        pass
+
+    def finish(self):
+        pass
+
+
+NULL = NullMetrics()
+
+
+class _Span(object):
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        stack = self._metrics._stack()
+        stack.append(self._name)
+        self._path = '/'.join(stack)
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._metrics._add_span(self._path, time.time() - self._start)
+        self._metrics._stack().pop()
+        return False
+
+
+class TaskMetrics(object):
+    enabled = True
+
+    def __init__(self, task, ep_id=None, hit_id=None):
+        self.task = task
+        self.ep_id = ep_id
+        self.hit_id = hit_id
+        self.status = 'success'
+        self.error_message = None
+
+        self.spans = {}
+        self.counters = {}
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._start = time.time()
+        self._finished = False
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+
+        if stack is None:
+            stack = self._local.stack = []
+
+        return stack
+
+    def _add_span(self, path, seconds):
+        with self._lock:
+            span = self.spans.get(path)
+
+            if span is None:
+                self.spans[path] = [1, seconds]
+            else:
+                span[0] += 1
+                span[1] += seconds
+
+    def span(self, name):
+        """
+        Returns a context manager timing its block as span `name`, nested under the spans open on this thread.
+        """
+        return _Span(self, name)
+
+    def timed(self, name, iterable):
+        """
+        Yields from `iterable`, timing each step of the iteration as span `name`. Use it to time lazy producers, such
+        as iter_hit_assets, separately from the loop body consuming them.
+        """
+        iterator = iter(iterable)
+
+        while True:
+            with self.span(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+
+            yield item
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def error(self, e):
+        self.status = 'failure'
+        self.error_message = repr(e)
+
+    def finish(self):
+        """
+        Logs the task's metrics as one JSON line, and adds them to the histograms. Only the first call has an effect.
+        """
+        if self._finished:
+            return
+
+        self._finished = True
+        seconds = time.time() - self._start
+
+        if getattr(_current, 'metrics', None) is self:
+            _current.metrics = None
+
+        record_histogram(self.task, seconds)
+        for path, (count, span_seconds) in self.spans.items():
+            record_histogram('{}/{}'.format(self.task, path), span_seconds)
+
+        print(json.dumps({
+            'event': 'task_metrics',
+            'task': self.task,
+            'ep_id': self.ep_id,
+            'hit_id': self.hit_id,
+            'status': self.status,
+            'error': self.error_message,
+            'seconds': round(seconds, 6),
+            'spans': dict((path, {'count': count, 'seconds': round(s, 6)})
+                          for path, (count, s) in self.spans.items()),
+            'counters': self.counters
+        }, sort_keys=True, default=str))
+
+
+class Histogram(object):
+    """
+    Distribution of durations, in power-of-two millisecond buckets from 1ms up.
+    """
+    BOUNDS = [2 ** i / 1000.0 for i in range(21)]  # 1ms to ~17 minutes
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """
+        Returns the upper bound of the bucket holding the `p`th percentile (0-100), or the max for the last bucket.
+        """
+        if not self.count:
+            return 0.0
+
+        rank = p / 100.0 * self.count
+        seen = 0
+
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return min(self.BOUNDS[i], self.max) if i < len(self.BOUNDS) else self.max
+
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max
+        }
+
+
+_current = threading.local()
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+def enabled():
+    return Config.get_bool('MATRIX_METRICS', True)
+
+
+def start(task, ep_id=None, hit_id=None):
+    """
+    Opens the metrics of a task run on this thread, and makes them current(). Returns NULL when disabled.
+    """
+    if not enabled():
+        return NULL
+
+    metrics = TaskMetrics(task, ep_id, hit_id)
+    _current.metrics = metrics
+
+    return metrics
+
+
+def current():
+    """
+    Returns the metrics of the task running on this thread, or NULL.
+    """
+    return getattr(_current, 'metrics', None) or NULL
+
+
+def record_histogram(name, seconds):
+    with _histograms_lock:
+        histogram = _histograms.get(name)
+
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+
+        histogram.record(seconds)
+
+
+def histograms():
+    """
+    Returns {name: summary} of the durations recorded in this process, for tasks ('mask') and spans ('mask/watershed').
+    """
+    with _histograms_lock:
+        return dict((name, h.summary()) for name, h in _histograms.items())
@@ -1,14 +1,13 @@
 import traceback
-from io import BytesIO
 from pythoncore import Task, Constants
-from pythoncore.AWS import AWSClient
 from pythoncore.Model.Landmark import Landmark
 from pythoncore.Model.Hit import Hit
 from pythoncore.Model import TorchbearerDB
-from PIL import Image
-import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
+import AssetLoader
+import ImageEncoder
+import MarkRenderer
+import UploadQueue
+import Instrumentation
 
 
 class LandmarkMarker (Task.Task):
@@ -19,91 +18,77 @@ class LandmarkMarker (Task.Task):
     def _run_landmark_marker(self):
         print("Starting mark task for ep {}, hit {}".format(self.ep_id, self.hit_id))
 
+        metrics = Instrumentation.start('mark', self.ep_id, self.hit_id)
+
         # Create DB session
         session = TorchbearerDB.Session()
 
+        # Marked images are uploaded in the background while the next landmarks are rendered
+        uploads = UploadQueue.batch()
+
         try:
             hit = session.query(Hit).filter_by(hit_id=self.hit_id).one()
             hit.set_start_time_for_task("landmark_mark")
 
             # Load from S3, across all positions available for corresponding ExecutionPoint
-            for position in Constants.LANDMARK_POSITIONS.values():
-                if AWSClient.s3_key_exists(Constants.S3_BUCKETS['STREETVIEW_IMAGES'],
-                                           "{}_{}.jpg".format(self.hit_id, position)):
-
-                    # Get streetview image for this Hit's ExecutionPoint
-                    img_array = self._get_streetview_image(position)
-
-                    # Get all landmarks for this hit for given position
-                    for landmark in session.query(Landmark).filter_by(hit_id=self.hit_id, position=position).all():
-                        # Create figure and axes
-                        fig, ax = plt.subplots(figsize=(8, 8), dpi=72)
+            for assets in metrics.timed('load_assets', AssetLoader.iter_hit_assets(
+                    self.hit_id, Constants.LANDMARK_POSITIONS.values(), saliency_maps=False,
+                    image_min_size=MarkRenderer.MAX_OUTPUT_SIZE)):
+                position = assets.position
+                metrics.count('positions')
 
-                        # Remove axes
-                        ax.axis('off')
-                        fig.axes[0].get_xaxis().set_visible(False)
-                        fig.axes[0].get_yaxis().set_visible(False)
+                # Scale this position's streetview image once, and mark all of its landmarks from it.
+                # Frames are decoded no larger than needed for the marked image size.
+                with metrics.span('scale'):
+                    renderer = MarkRenderer.MarkRenderer(assets.image, frame_size=assets.image_size)
 
-                        # Add the image
-                        ax.imshow(img_array)
+                # Get all landmarks for this hit for given position
+                with metrics.span('db_load'):
+                    landmarks = session.query(Landmark).filter_by(hit_id=self.hit_id, position=position).all()
 
-                        # Create a Rectangle patch
-                        x1 = landmark.get_rect()["x1"]
-                        x2 = landmark.get_rect()["x2"]
-                        y1 = landmark.get_rect()["y1"]
-                        y2 = landmark.get_rect()["y2"]
+                # Rendering is lazy, so time each render (draw and encode) apart from queueing its upload
+                rendered = metrics.timed('render', renderer.render_all(l.get_rect() for l in landmarks))
 
-                        width = x2 - x1
-                        height = y2 - y1
+                for landmark, img_bytes in zip(landmarks, rendered):
+                    with metrics.span('upload_enqueue'):
+                        self._put_marked_streetview_image(img_bytes, landmark.landmark_id, renderer.content_type,
+                                                          uploads)
 
-                        rect = patches.Rectangle((x1, y1), width, height, linewidth=2, edgecolor='r', facecolor='none')
+                metrics.count('landmarks', len(landmarks))
 
-                        # Add the patch to the Axes
-                        ax.add_patch(rect)
+            # Wait until all marked images are stored
+            with metrics.span('upload_wait'):
+                uploads.flush(UploadQueue.flush_timeout())
 
-                        # Save image
-                        img_file = BytesIO()
-                        fig.savefig(img_file, format='png', bbox_inches='tight', pad_inches=0)
-                        self._put_marked_streetview_image(img_file, landmark.landmark_id)
-                        # fig.show()
+            metrics.count('bytes_uploaded', uploads.bytes)
 
             hit.set_end_time_for_task("landmark_mark")
 
             # Commit DB inserts
-            session.commit()
+            with metrics.span('db_commit'):
+                session.commit()
 
             self.send_success()
             print("Completed mark task for ep {}, hit {}".format(self.ep_id, self.hit_id))
 
         except Exception, e:
             traceback.print_exc()
+            metrics.error(e)
+            uploads.cancel()
             self.send_failure('LANDMARK_MARK_ERROR', e.message)
 
         finally:
             session.close()
-
-    def _get_streetview_image(self, position):
-        client = AWSClient.get_client('s3')
-        response = client.get_object(
-            Bucket=Constants.S3_BUCKETS['STREETVIEW_IMAGES'],
-            Key="{}_{}.jpg".format(self.hit_id, position)
-        )
-        img = Image.open(response['Body'])
-        # img.show()
-        return np.array(img, dtype=np.uint8)
+            metrics.finish()
 
     @staticmethod
-    def _put_marked_streetview_image(img_file, landmark_id):
-        client = AWSClient.get_client('s3')
-
-        # Make sure file is "rewound"
-        img_file.seek(0)
-
-        # Put cropped image
-        client.put_object(
-            Body=img_file,
-            Bucket=Constants.S3_BUCKETS['MARKED_LANDMARK_IMAGES'],
-            Key="{0}.png".format(landmark_id)
+    def _put_marked_streetview_image(img_bytes, landmark_id, content_type, uploads):
+        # Put marked image
+        uploads.put(
+            Constants.S3_BUCKETS['MARKED_LANDMARK_IMAGES'],
+            ImageEncoder.s3_key(landmark_id),
+            img_bytes,
+            content_type=content_type
         )
 
     def run(self):
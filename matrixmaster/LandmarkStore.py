@@ -0,0 +1,166 @@
+from sqlalchemy import inspect
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import load_only
+from pythoncore.Model.Landmark import Landmark
+
+'''
+Bulk persistence of landmarks, with executemany-style statements instead of one ORM object per row.
+Data pythoncore's models have no column for is kept in side tables declared on SideTable (see migrations/).
+'''
+
+# Ids per IN clause, below SQLite's limit of bound parameters
+CHUNK = 500
+
+# Declarative base of the side tables
+SideTable = declarative_base()
+
+_rect_columns = None
+
+
+def _columns():
+    return [attr.key for attr in inspect(Landmark).column_attrs]
+
+
+def _primary_key():
+    return inspect(Landmark).primary_key[0].key
+
+
+def _existing_ids(session, landmark_ids):
+    column = getattr(Landmark, _primary_key())
+    existing = set()
+
+    for chunk in chunks(landmark_ids):
+        existing.update(str(row[0]) for row in session.query(column).filter(column.in_(chunk)))
+
+    return existing
+
+
+def rect_columns():
+    """
+    Returns the names of the columns Landmark.set_rect writes to.
+    """
+    global _rect_columns
+
+    if _rect_columns is None:
+        probe = Landmark()
+        before = dict((c, getattr(probe, c)) for c in _columns())
+        probe.set_rect({'x1': 1, 'x2': 2, 'y1': 3, 'y2': 4})
+        _rect_columns = [c for c in _columns() if getattr(probe, c) != before[c]]
+
+    return _rect_columns
+
+
+def rect_values(rect):
+    """
+    Returns the column values storing `rect` (which may be None), as a dict.
+    """
+    probe = Landmark()
+    probe.set_rect(rect)
+    return dict((c, getattr(probe, c)) for c in rect_columns())
+
+
+def landmark_mapping(rect=None, **kwargs):
+    """
+    Returns the column mapping of a new landmark, for insert_landmarks.
+    `kwargs` are Landmark constructor arguments. Columns left unset are omitted, so they get their defaults.
+    """
+    landmark = Landmark(**kwargs)
+
+    if rect is not None:
+        landmark.set_rect(rect)
+
+    return dict((c, getattr(landmark, c)) for c in _columns() if getattr(landmark, c) is not None)
+
+
+def insert_landmarks(session, mappings, skip_existing=False):
+    """
+    Inserts new landmarks from landmark_mapping()s, with one multi-row statement per set of columns.
+    With `skip_existing`, landmarks whose id is already stored are left out, so inserting the derived ids of a retried
+    task (see ResultCache.landmark_id) does not fail.
+    """
+    if skip_existing and mappings:
+        existing = _existing_ids(session, [str(m[_primary_key()]) for m in mappings])
+        mappings = [m for m in mappings if str(m[_primary_key()]) not in existing]
+
+    if mappings:
+        session.bulk_insert_mappings(Landmark, mappings)
+
+
+def update_mapping(landmark, **values):
+    """
+    Returns the mapping updating `values` (column => value) of an existing landmark, for update_landmarks.
+    """
+    values[_primary_key()] = getattr(landmark, _primary_key())
+    return values
+
+
+def update_landmarks(session, mappings):
+    """
+    Applies update_mapping()s, with one executemany UPDATE per set of columns.
+    Loaded Landmark objects are not refreshed; don't modify them in the same session.
+    """
+    if mappings:
+        session.bulk_update_mappings(Landmark, mappings)
+
+
+def delete_landmarks(session, landmark_ids):
+    """
+    Deletes the landmarks in `landmark_ids`. Committed with the session.
+    """
+    column = getattr(Landmark, _primary_key())
+
+    for chunk in chunks([str(i) for i in landmark_ids]):
+        session.query(Landmark).filter(column.in_(chunk)).delete(synchronize_session=False)
+
+
+def stored_ids(session, hit_id, position):
+    """
+    Returns the ids (str) of the stored landmarks of a hit and position.
+    """
+    column = getattr(Landmark, _primary_key())
+    return set(str(row[0]) for row in session.query(column).filter_by(hit_id=hit_id, position=position))
+
+
+def upsert_landmarks(session, mappings):
+    """
+    Inserts the landmarks of landmark_mapping()s `mappings` whose id is not stored yet, and updates the stored ones with
+    their values. Committed with the session.
+    """
+    stored = _existing_ids(session, [str(m[_primary_key()]) for m in mappings])
+
+    insert_landmarks(session, [m for m in mappings if str(m[_primary_key()]) not in stored])
+    update_landmarks(session, [m for m in mappings if str(m[_primary_key()]) in stored])
+
+
+def load_for_scoring(session, hit_id, position):
+    """
+    Loads the landmarks of a hit and position, with only the columns the score stage reads.
+    """
+    columns = [_primary_key(), 'relative_bearing'] + rect_columns()
+
+    return session.query(Landmark) \
+        .options(load_only(*columns)) \
+        .filter_by(hit_id=hit_id, position=position) \
+        .all()
+
+
+def chunks(items):
+    """
+    Yields `items` (a list) in slices of at most CHUNK, for IN clauses.
+    """
+    for i in range(0, len(items), CHUNK):
+        yield items[i:i + CHUNK]
+
+
+def load_side_values(session, column, landmark_ids, *criteria):
+    """
+    Returns {landmark id (str): value of `column`} of the landmarks in `landmark_ids` that have a row in `column`'s side
+    table, keyed by landmark_id, matching `criteria`.
+    """
+    model = column.class_
+    values = {}
+
+    for chunk in chunks([str(i) for i in landmark_ids]):
+        values.update(session.query(model.landmark_id, column).filter(model.landmark_id.in_(chunk), *criteria))
+
+    return values
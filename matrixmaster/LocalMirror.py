@@ -0,0 +1,79 @@
+import os
+from io import BytesIO
+from botocore.exceptions import ClientError
+
+'''
+A read-only S3 client over a local mirror of the buckets, one directory per bucket as `aws s3 sync` creates.
+Only the calls AssetLoader makes are supported.
+'''
+
+
+class _Paginator(object):
+    def __init__(self, mirror):
+        self._mirror = mirror
+
+    def paginate(self, Bucket, Prefix=''):
+        yield {'Contents': self._mirror.list_objects(Bucket, Prefix)}
+
+
+class LocalMirror(object):
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    def _stat(self, bucket, key, operation):
+        try:
+            return os.stat(self._path(bucket, key))
+        except OSError:
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, operation)
+
+    @staticmethod
+    def _etag(st):
+        return '"{:x}-{:x}"'.format(int(st.st_mtime * 1e6), st.st_size)
+
+    def head_object(self, Bucket, Key):
+        st = self._stat(Bucket, Key, 'HeadObject')
+        return {'ETag': self._etag(st), 'ContentLength': st.st_size}
+
+    def get_object(self, Bucket, Key, Range=None):
+        st = self._stat(Bucket, Key, 'GetObject')
+
+        with open(self._path(Bucket, Key), 'rb') as f:
+            if Range is None:
+                data = f.read()
+            else:
+                # Only 'bytes=first-last' ranges, as AssetLoader requests them
+                first, last = [int(b) for b in Range[len('bytes='):].split('-')]
+                f.seek(first)
+                data = f.read(last - first + 1)
+
+        return {'Body': BytesIO(data), 'ETag': self._etag(st), 'ContentLength': len(data)}
+
+    def list_objects(self, bucket, prefix=''):
+        """
+        Returns [{'Key', 'ETag', 'Size'}] of the objects in `bucket` whose key starts with `prefix`.
+        """
+        directory, _, name_prefix = prefix.rpartition('/')
+        path = os.path.join(self.root, bucket, *directory.split('/')) if directory else os.path.join(self.root, bucket)
+
+        if not os.path.isdir(path):
+            return []
+
+        contents = []
+        for name in sorted(n for n in os.listdir(path) if n.startswith(name_prefix)):
+            if os.path.isdir(os.path.join(path, name)):
+                continue
+
+            st = os.stat(os.path.join(path, name))
+            key = directory + '/' + name if directory else name
+            contents.append({'Key': key, 'ETag': self._etag(st), 'Size': st.st_size})
+
+        return contents
+
+    def get_paginator(self, operation):
+        if operation != 'list_objects_v2':
+            raise ValueError("LocalMirror does not support {}".format(operation))
+
+        return _Paginator(self)
@@ -0,0 +1,100 @@
+import math
+import numpy as np
+import cv2
+import ImageEncoder
+
+'''
+Draws landmark rectangles onto Street View frames, with the geometry of the former matplotlib rendering.
+The frame is scaled once per position, and images are encoded as ImageEncoder's 'mark' output.
+'''
+
+# Geometry of the former matplotlib figure: figsize=(8, 8) at dpi=72, default subplot params
+FIGURE_SIZE = 8 * 72
+AXES_FRACTION = (0.9 - 0.125, 0.88 - 0.11)
+LINE_WIDTH = 2
+
+# Largest (width, height) a frame is scaled to: frames decoded at least this size lose nothing
+MAX_OUTPUT_SIZE = (int(math.ceil(FIGURE_SIZE * AXES_FRACTION[0])), int(math.ceil(FIGURE_SIZE * AXES_FRACTION[1])))
+
+# BGR, as the canvas is encoded with OpenCV
+EDGE_COLOR = (0, 0, 255)
+
+
+def output_size(width, height):
+    """
+    Returns the (width, height, scale) a frame is scaled to, matching the former matplotlib output.
+    """
+    scale = min(FIGURE_SIZE * AXES_FRACTION[0] / width, FIGURE_SIZE * AXES_FRACTION[1] / height)
+    return int(width * scale), int(height * scale), scale
+
+
+class MarkRenderer(object):
+    def __init__(self, img, fmt=None, png_compression=None, jpeg_quality=None, frame_size=None, webp_quality=None):
+        """
+        `img` is the RGB frame of one position. All landmarks of that position are rendered from one scaled copy.
+        When `img` was decoded at reduced scale, `frame_size` is the (width, height) of the full frame, whose pixels
+        rects are in.
+        """
+        self.encoder = ImageEncoder.Encoder('mark', fmt=fmt, png_compression=png_compression,
+                                            webp_quality=webp_quality, jpeg_quality=jpeg_quality)
+        self.fmt = self.encoder.fmt
+        self.content_type = self.encoder.content_type
+
+        width, height = frame_size or (img.shape[1], img.shape[0])
+        out_width, out_height, self._scale = output_size(width, height)
+
+        base = cv2.resize(np.ascontiguousarray(img), (out_width, out_height), interpolation=cv2.INTER_AREA)
+        self._base = cv2.cvtColor(base, cv2.COLOR_RGB2BGR)
+
+        # Scratch canvas reused by every render
+        self._canvas = np.empty_like(self._base)
+
+    @property
+    def shape(self):
+        return self._base.shape
+
+    def _stroke_start(self, coord, limit):
+        # matplotlib centres a pixel on each integer data coordinate and the stroke on the edge
+        edge = (coord + 0.5) * self._scale
+        start = int(np.floor(edge - LINE_WIDTH / 2.0 + 0.5))
+        return max(min(start, limit - LINE_WIDTH), 0)
+
+    def draw(self, rect, canvas=None):
+        """
+        Draws `rect` ({'x1', 'x2', 'y1', 'y2'} in frame pixels) onto a fresh copy of the scaled frame, in `canvas` (an
+        array shaped as the scaled frame). Returns the canvas; without one, the scratch canvas overwritten by the next
+        draw.
+        """
+        if canvas is None:
+            canvas = self._canvas
+
+        np.copyto(canvas, self._base)
+
+        # Landmarks without a rect are rendered unmarked
+        if rect is None:
+            return canvas
+
+        height, width = canvas.shape[:2]
+        x1, x2 = self._stroke_start(rect['x1'], width), self._stroke_start(rect['x2'], width)
+        y1, y2 = self._stroke_start(rect['y1'], height), self._stroke_start(rect['y2'], height)
+
+        c = canvas
+        c[y1:y1 + LINE_WIDTH, x1:x2 + LINE_WIDTH] = EDGE_COLOR
+        c[y2:y2 + LINE_WIDTH, x1:x2 + LINE_WIDTH] = EDGE_COLOR
+        c[y1:y2 + LINE_WIDTH, x1:x1 + LINE_WIDTH] = EDGE_COLOR
+        c[y1:y2 + LINE_WIDTH, x2:x2 + LINE_WIDTH] = EDGE_COLOR
+
+        return c
+
+    def render(self, rect):
+        """
+        Returns the encoded marked image for `rect`, as bytes.
+        """
+        return self.encoder.encode(self.draw(rect))
+
+    def render_all(self, rects):
+        """
+        Yields the encoded marked image for each rect, in order.
+        Each rect is drawn on its own canvas, so the next ones are drawn while it is encoded on the encoder pool.
+        """
+        return ImageEncoder.encode_all(self.encoder, (self.draw(rect, np.empty_like(self._base)) for rect in rects))
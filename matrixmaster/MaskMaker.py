@@ -1,16 +1,148 @@
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from scipy import ndimage
 import cv2
 import numpy as np
-from skimage.feature import peak_local_max
 import os
+import Config
 
+'''
+Segments saliency maps into salient regions with a watershed, optionally coarse-to-fine (MATRIX_MASK_SCALE).
+Full 360 degree panoramas are segmented in wrap-aware vertical tiles (make_panorama_regions).
+'''
 
-def make_bounding_boxes(sm):
 
+# Bump when a change to the segmentation changes its results, so results cached by ResultCache are not reused
+VERSION = 1
+
+# One row per watershed region, as returned by make_regions.
+# Bounds are inclusive pixel indices; (cx, cy) is the centroid; saliency is the sum of the saliency map over the region.
+REGION_DTYPE = np.dtype([
+    ('label', np.int32),
+    ('x1', np.int32),
+    ('y1', np.int32),
+    ('x2', np.int32),
+    ('y2', np.int32),
+    ('area', np.int64),
+    ('cx', np.float64),
+    ('cy', np.float64),
+    ('saliency', np.float64)
+])
+
+
+def make_bounding_boxes(sm, scale=None, refine=None):
+    return regions_to_bounding_boxes(make_regions(sm, scale, refine))
+
+
+def make_regions(sm, scale=None, refine=None):
+    """
+    Segments a saliency map into salient regions. Returns a REGION_DTYPE structured array, one row per region.
+    """
+    return regions_from_markers(segment(sm, scale, refine), sm)
+
+
+def regions_to_bounding_boxes(regions):
+    return [{
+        'y1': int(r['y1']),
+        'y2': int(r['y2']),
+        'x1': int(r['x1']),
+        'x2': int(r['x2'])
+    } for r in regions]
+
+
+def get_masks_from_saliency_map(sm, scale=None, refine=None):
+    """
+    Returns a uint8 mask, 1 inside, of each salient region of `sm`, in the order of make_regions.
+    """
+    return make_region_masks(sm, scale, refine)[1]
+
+
+def make_region_masks(sm, scale=None, refine=None):
+    """
+    Segments a saliency map into salient regions. Returns (regions, masks): the regions as make_regions, and a uint8
+    mask, 1 inside, of each.
+    """
+    markers = segment(sm, scale, refine)
+    regions = regions_from_markers(markers, sm)
+    return regions, [(markers == label).astype(np.uint8) for label in regions['label']]
+
+
+def _settings(scale, refine):
+    return (
+        Config.get_float('MATRIX_MASK_SCALE', 1) if scale is None else scale,
+        Config.get_bool('MATRIX_MASK_REFINE', True) if refine is None else refine
+    )
+
+
+def parameters(scale=None, refine=None):
+    """
+    Returns the version and settings maps are segmented with, as a dict.
+    """
+    scale, refine = _settings(scale, refine)
+    return {'version': VERSION, 'scale': scale, 'refine': refine}
+
+
+def segment(sm, scale=None, refine=None):
+    """
+    Runs the watershed segmentation of a saliency map.
+    Returns the full resolution label image: 1 is background, -1 boundaries between regions, labels > 1 salient regions.
+    With `scale` > 1 the map is segmented at 1 / `scale` of its resolution, and region borders are refined at full
+    resolution if `refine` is set.
+    """
+    scale, refine = _settings(scale, refine)
+    return _segment(sm, scale, refine)
+
+
+def _downscale(sm, scale):
+    height, width = sm.shape
+    return cv2.resize(sm, (max(int(round(width / scale)), 1), max(int(round(height / scale)), 1)),
+                      interpolation=cv2.INTER_AREA)
+
+
+def _segment(sm, scale, refine, threshold=None, distance_max=None):
+    if scale <= 1:
+        return _watershed(sm, threshold, distance_max)
+
+    height, width = sm.shape
+    small = _downscale(sm, scale)
+
+    small_markers = _watershed(small, threshold, distance_max)
+    markers = cv2.resize(small_markers, (width, height), interpolation=cv2.INTER_NEAREST)
+
+    if refine:
+        # Re-run the watershed at full resolution, with only the pixels near region borders left unknown (0) and
+        # flooded from the labels around them. Borders are found at the coarse resolution, where it is cheaper.
+        band = cv2.resize(_borders(small_markers), (width, height), interpolation=cv2.INTER_NEAREST)
+        markers[band.view(bool)] = 0
+        cv2.watershed(cv2.cvtColor(sm, cv2.COLOR_GRAY2BGR), markers)
+
+    return markers
+
+
+def _borders(markers):
+    """
+    Returns a uint8 mask, 1 within a pixel of the borders between labels (including -1 boundaries).
+    """
+    # Borders are where the 3x3 min and max of the labels differ; labels are exact in float32 below 2 ** 24
+    labels = markers.astype(np.float32)
+    kernel = np.ones((3, 3), np.uint8)
+    borders = (cv2.dilate(labels, kernel) != cv2.erode(labels, kernel)).astype(np.uint8)
+
+    return cv2.dilate(borders, kernel)
+
+
+def _salient_area(sm, threshold=None):
+    """
+    Returns (cleaned, sure_bg): the salient area with noise removed, and that area dilated, outside of which is surely
+    background. Salient pixels are those above `threshold`, by default Otsu's threshold of `sm`.
+    """
     # Apply Otsu's thresholding to saliency matrix
     # Otsu' finds optimal value for threshold--values > than thresh get 255, < get 0
     # This gives a binary segmentation of salient/non-salient
-    thresh = cv2.threshold(sm, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
+    if threshold is None:
+        thresh = cv2.threshold(sm, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
+    else:
+        thresh = cv2.threshold(sm, threshold, 255, cv2.THRESH_BINARY)[1]
 
     if os.environ.get('debug'):
         cv2.imshow("Thresh", thresh)
@@ -29,6 +161,12 @@ def make_bounding_boxes(sm):
     #cv2.imshow("sure_bg", sure_bg)
     #cv2.waitKey()
 
+    return cleaned, sure_bg
+
+
+def _watershed(sm, threshold=None, distance_max=None):
+    cleaned, sure_bg = _salient_area(sm, threshold)
+
     # Finding sure foreground (salient) area.
     # For each "salient" pixel in binary threshold, compute distance to nearest non-salient pixel
     # This will leave us with the most intense values being at the center of salient regions,
@@ -38,7 +176,10 @@ def make_bounding_boxes(sm):
     #cv2.imshow("distance_transform", dist_transform / 255)
     #cv2.waitKey()
 
-    sure_fg = cv2.threshold(dist_transform, 0.5 * dist_transform.max(), 255, 0)[1]
+    if distance_max is None:
+        distance_max = dist_transform.max()
+
+    sure_fg = cv2.threshold(dist_transform, 0.5 * distance_max, 255, 0)[1]
 
     #cv2.imshow("sure_fg", sure_fg)
     #cv2.waitKey()
@@ -68,48 +209,234 @@ def make_bounding_boxes(sm):
     # Saves final labels into markers
     cv2.watershed(cv2.cvtColor(sm, cv2.COLOR_GRAY2BGR), markers)
 
-    bounding_boxes = []
+    return markers
+
+
+def regions_from_markers(markers, sm):
+    """
+    Extracts every region's bounding box and statistics from a watershed label image.
+    One pass over the label image finds all bounding boxes; statistics are then computed within each box only,
+    instead of building and scanning a full-frame mask per region.
+    """
+    # Boundaries (-1) become 0 so they belong to no region; label 1 is the background
+    slices = ndimage.find_objects(np.maximum(markers, 0))
 
-    # loop over the unique regions returned by the Watershed
-    # algorithm
-    for region in np.unique(markers):
-        # if the region is 1, we are examining the 'background'
-        # if the region is -1, this is the boundary between regions
-        if region == 1 or region == -1:
+    regions = []
+
+    for label, sl in enumerate(slices, 1):
+        if label == 1 or sl is None:
             continue
 
-        # otherwise, allocate memory for the region and draw it on the mask
-        mask = np.zeros(sm.shape, dtype="uint8")
-        mask[markers == region] = 1
+        rows, cols = sl
+        region_mask = markers[sl] == label
+
+        # Per-row and per-column pixel counts give area and centroid without any coordinate arrays
+        row_counts = region_mask.sum(axis=1)
+        col_counts = region_mask.sum(axis=0)
+        area = row_counts.sum()
+
+        regions.append((
+            label,
+            cols.start,
+            rows.start,
+            cols.stop - 1,
+            rows.stop - 1,
+            area,
+            cols.start + col_counts.dot(np.arange(len(col_counts))) / float(area),
+            rows.start + row_counts.dot(np.arange(len(row_counts))) / float(area),
+            sm[sl][region_mask].sum()
+        ))
 
         if os.environ.get('debug'):
-            cv2.imshow("Output", mask * sm)
+            cv2.imshow("Output", region_mask * sm[sl])
             cv2.waitKey(0)
 
-        # If this region is smaller than 2% of image, ignore it
-        '''
-        if np.count_nonzero(mask) < 0.02 * sm.size:
+    regions = np.array(regions, dtype=REGION_DTYPE)
+
+    # If a region is smaller than 2% of image, it could be ignored here:
+    # regions = regions[regions['area'] >= 0.02 * sm.size]
+
+    return regions
+
+
+def make_panorama_bounding_boxes(sm, tile_width=None, overlap=None, workers=None, scale=None, refine=None):
+    return regions_to_bounding_boxes(make_panorama_regions(sm, tile_width, overlap, workers, scale, refine))
+
+
+def make_panorama_regions(sm, tile_width=None, overlap=None, workers=None, scale=None, refine=None):
+    """
+    Segments the saliency map of an equirectangular panorama, whose left and right edges meet, into salient regions.
+    Returns a REGION_DTYPE structured array as make_regions, sorted top to bottom then left to right, with x2 (and cx)
+    past the panorama's width for regions crossing the wrap.
+    The map is segmented in tiles of `tile_width` columns, each with `overlap` columns of context on either side, on
+    `workers` threads.
+    """
+    scale, refine = _settings(scale, refine)
+    tile_width = tile_width or Config.get_int('MATRIX_PANORAMA_TILE_WIDTH', 1024)
+    overlap = min(Config.get_int('MATRIX_PANORAMA_OVERLAP', 128) if overlap is None else overlap, sm.shape[1])
+    workers = workers or Config.get_int('MATRIX_PANORAMA_WORKERS', multiprocessing.cpu_count())
+
+    tiles = [(x0, min(x0 + tile_width, sm.shape[1])) for x0 in range(0, sm.shape[1], tile_width)]
+
+    # Three passes over the tiles, so every tile is thresholded and seeded as the whole map would be: the histogram
+    # for Otsu's threshold, the largest distance to the background, and the segmentation itself
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        threshold = _otsu_threshold(sum(executor.map(lambda tile: _tile_histogram(sm, tile), tiles)))
+
+        distance_max = max(executor.map(
+            lambda tile: _tile_distance_max(sm, tile, overlap, scale, threshold), tiles))
+
+        results = list(executor.map(
+            lambda tile: _tile_regions(sm, tile, overlap, scale, refine, threshold, distance_max), tiles))
+
+    return _merge_tiles(results, sm.shape[1])
+
+
+def _otsu_threshold(hist):
+    """
+    Returns Otsu's threshold of a 256-bin histogram, computed as OpenCV's THRESH_OTSU computes it.
+    """
+    hist = [int(h) for h in hist]
+    scale = 1.0 / sum(hist)
+    mu = sum(i * h for i, h in enumerate(hist)) * scale
+    epsilon = float(np.finfo(np.float32).eps)
+
+    mu1 = q1 = max_sigma = 0.0
+    threshold = 0
+
+    for i, h in enumerate(hist):
+        p_i = h * scale
+        mu1 *= q1
+        q1 += p_i
+        q2 = 1.0 - q1
+
+        if min(q1, q2) < epsilon or max(q1, q2) > 1.0 - epsilon:
             continue
-        '''
 
-        # Otherwise, create a landmark based on the bounding box around this region
-        # Find bounding box based on original saliency mask
-        y1, y2, x1, x2 = __bbox2(mask)
+        mu1 = (mu1 + i * p_i) / q1
+        mu2 = (mu - q1 * mu1) / q2
+        sigma = q1 * q2 * (mu1 - mu2) * (mu1 - mu2)
+
+        if sigma > max_sigma:
+            max_sigma = sigma
+            threshold = i
+
+    return threshold
+
+
+def _strip(sm, tile, overlap):
+    # The tile's columns and `overlap` columns either side, wrapping around the panorama
+    x0, x1 = tile
+    return np.take(sm, np.arange(x0 - overlap, x1 + overlap), axis=1, mode='wrap')
+
+
+def _tile_histogram(sm, tile):
+    x0, x1 = tile
+    return np.bincount(sm[:, x0:x1].ravel(), minlength=256)
+
+
+def _tile_distance_max(sm, tile, overlap, scale, threshold):
+    x0, x1 = tile
+    strip = _strip(sm, tile, overlap)
+
+    if scale > 1:
+        strip = _downscale(strip, scale)
+        overlap = int(round(overlap / scale))
+
+    cleaned = _salient_area(strip, threshold)[0]
+    core = cv2.distanceTransform(cleaned, cv2.DIST_L2, 5)[:, overlap:strip.shape[1] - overlap]
+
+    return float(core.max()) if core.size else 0.0
+
+
+def _tile_regions(sm, tile, overlap, scale, refine, threshold, distance_max):
+    """
+    Segments a tile with its overlap. Returns (regions, first, last): the regions of the tile in panorama coordinates,
+    and the labels of its first and last columns.
+    """
+    x0, x1 = tile
+    markers = _segment(_strip(sm, tile, overlap), scale, refine, threshold, distance_max)
+    core = np.ascontiguousarray(markers[:, overlap:overlap + x1 - x0])
+
+    regions = regions_from_markers(core, sm[:, x0:x1])
+    for field in ('x1', 'x2', 'cx'):
+        regions[field] += x0
+
+    return regions, core[:, 0].copy(), core[:, -1].copy()
+
+
+def _merge_tiles(results, width):
+    """
+    Merges the regions of adjacent tiles that touch across a seam, the last tile's right edge being the first's left.
+    """
+    parent = {}
+
+    def find(key):
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    parts = {}
+    for t, (regions, _, _) in enumerate(results):
+        for region in regions:
+            key = (t, int(region['label']))
+            parent[key] = key
+            parts[key] = region
+
+    for t, (_, _, last) in enumerate(results):
+        n = (t + 1) % len(results)
+        first = results[n][1]
+        touching = (last > 1) & (first > 1)
+
+        for a, b in set(zip(last[touching].tolist(), first[touching].tolist())):
+            root_a, root_b = find((t, a)), find((n, b))
+            if root_a != root_b:
+                parent[root_a] = root_b
+
+    components = {}
+    for key, region in parts.items():
+        components.setdefault(find(key), []).append(region)
+
+    merged = []
+    for members in components.values():
+        start, end = _arc([(int(r['x1']), int(r['x2'])) for r in members], width)
+        area = sum(int(r['area']) for r in members)
+
+        # Parts left of the arc's start lie past the wrap
+        cx = sum(r['area'] * (r['cx'] + (width if r['x1'] < start else 0)) for r in members) / float(area)
+        cy = sum(r['area'] * r['cy'] for r in members) / float(area)
+
+        merged.append((0, start, min(int(r['y1']) for r in members), end, max(int(r['y2']) for r in members), area,
+                       cx, cy, sum(float(r['saliency']) for r in members)))
+
+    merged.sort(key=lambda r: (r[2], r[1]))
+    regions = np.array(merged, dtype=REGION_DTYPE)
+    regions['label'] = np.arange(2, len(regions) + 2)
+
+    return regions
 
-        bounding_boxes.append({
-            'y1': y1,
-            'y2': y2,
-            'x1': x1,
-            'x2': x2
-        })
 
-    return bounding_boxes
+def _arc(intervals, width):
+    """
+    Returns (start, end) of the shortest run of columns around the panorama covering all `intervals` (inclusive
+    (x1, x2) pairs), with end past `width` when the run crosses the wrap.
+    """
+    covered = []
+    for x1, x2 in sorted(intervals):
+        if covered and x1 <= covered[-1][1] + 1:
+            covered[-1][1] = max(covered[-1][1], x2)
+        else:
+            covered.append([x1, x2])
 
+    # The run leaves out the widest gap between covered columns. The gap across the wrap is taken on ties, so runs
+    # only cross the wrap when they have to.
+    start, end = covered[0][0], covered[-1][1]
+    widest = covered[0][0] + width - covered[-1][1] - 1
 
-def __bbox2(img):
-    rows = np.any(img, axis=1)
-    cols = np.any(img, axis=0)
-    rmin, rmax = np.where(rows)[0][[0, -1]]
-    cmin, cmax = np.where(cols)[0][[0, -1]]
+    for (_, gap_start), (gap_end, _) in zip(covered, covered[1:]):
+        if gap_end - gap_start - 1 > widest:
+            widest = gap_end - gap_start - 1
+            start, end = gap_end, gap_start + width
 
-    return rmin, rmax, cmin, cmax
\ No newline at end of file
+    return start, end
@@ -0,0 +1,72 @@
+from sqlalchemy import Column, Integer, String
+from pythoncore import Constants
+import Degradations
+import ImageEncoder
+import LandmarkStore
+import ResultCache
+import ScoreFingerprints
+import UploadQueue
+
+'''
+The segmentation each position's mask and crop-from-saliency landmarks derive from, in side tables.
+A re-run deletes only the landmarks of the segmentation it replaces, not those other services stored.
+'''
+
+
+# The buckets of the images stored under a landmark's id, which its deletion leaves behind
+LANDMARK_IMAGES = ('MARKED_LANDMARK_IMAGES', 'CROPPED_IMAGES', 'TRANSPARENT_CROPPED_IMAGES')
+
+
+class _Segmentation(object):
+    hit_id = Column(Integer, primary_key=True, autoincrement=False)
+    position = Column(String(32), primary_key=True)
+    result_key = Column(String(64), nullable=False)
+    landmarks = Column(Integer, nullable=False)
+
+
+class MaskSegmentation(_Segmentation, LandmarkStore.SideTable):
+    __tablename__ = 'mask_segmentation'
+
+
+class CropFromSaliencySegmentation(_Segmentation, LandmarkStore.SideTable):
+    __tablename__ = 'crop_from_saliency_segmentation'
+
+
+def landmark_ids(hit_id, position, key, count):
+    """
+    Returns the ids (str) of the `count` landmarks of the segmentation `key`, for a hit and position.
+    """
+    return [str(ResultCache.landmark_id(hit_id, position, key, i)) for i in range(count)]
+
+
+def replace(session, hit_id, position, key, count, model=MaskSegmentation):
+    """
+    Records the segmentation `key`, of `count` landmarks, as the one of a hit and position in `model`'s table, and
+    deletes the landmarks of the segmentation it replaces that `key` does not produce again. Returns the ids (str) of
+    the deleted landmarks. Committed with the session.
+    """
+    previous = session.query(model).get((hit_id, position))
+    stale = []
+
+    # A segmentation under the same key produces the same ids, unless an earlier run of it kept more regions
+    if previous is not None:
+        current = set(landmark_ids(hit_id, position, key, count))
+        stale = [i for i in landmark_ids(hit_id, position, previous.result_key, previous.landmarks) if i not in current]
+
+    LandmarkStore.delete_landmarks(session, stale)
+    Degradations.delete(session, stale)
+    ScoreFingerprints.delete(session, stale)
+    session.merge(model(hit_id=hit_id, position=position, result_key=key, landmarks=count))
+
+    return stale
+
+
+def delete_images(landmark_ids, buckets=LANDMARK_IMAGES):
+    """
+    Deletes the S3 images of the landmarks `landmark_ids` from `buckets` (keys of Constants.S3_BUCKETS). Call once the
+    landmarks' deletion is committed, so a failure only leaves the images behind.
+    """
+    keys = [ImageEncoder.s3_key(landmark_id) for landmark_id in landmark_ids]
+
+    for bucket in buckets:
+        UploadQueue.delete(Constants.S3_BUCKETS[bucket], keys)
@@ -1,20 +1,24 @@
-import json
-import uuid
-from io import BytesIO
 import traceback
-import numpy as np
-from PIL import Image
 from pythoncore import Task, Constants
-from pythoncore.AWS import AWSClient
-from pythoncore.Model import TorchbearerDB, Landmark, Hit
-from matplotlib import pyplot as plt
+from pythoncore.Model import TorchbearerDB, Hit
 import os
 import cv2
-from skimage.feature import peak_local_max
-from skimage.morphology import watershed
-from scipy import ndimage
-import GrabCut
+import numpy as np
 import MaskMaker
+import AssetLoader
+import LandmarkStore
+import MaskSegmentations
+import ResultCache
+import Instrumentation
+
+
+def warm_up():
+    """
+    Segments a small synthetic saliency map, so the first task doesn't pay for loading and initialising the kernels.
+    """
+    sm = np.zeros((64, 64), np.uint8)
+    sm[16:48, 16:48] = 255
+    MaskMaker.make_bounding_boxes(sm)
 
 
 class MaskTask(Task.Task):
@@ -24,6 +28,8 @@ class MaskTask(Task.Task):
     def run(self):
         print("Starting mask task for ep {}, hit {}".format(self.ep_id, self.hit_id))
 
+        metrics = Instrumentation.start('mask', self.ep_id, self.hit_id)
+
         # Create DB session
         session = TorchbearerDB.Session()
 
@@ -31,33 +37,61 @@ class MaskTask(Task.Task):
             hit = session.query(Hit.Hit).filter_by(hit_id=self.hit_id).one()
             hit.set_start_time_for_task("mask")
 
-            for position in Constants.LANDMARK_POSITIONS.values():
-                if AWSClient.s3_key_exists(Constants.S3_BUCKETS['SALIENCY_MAPS'],
-                                           "{}_{}.json".format(self.hit_id, position)):
-                    # Load saliency mask and image from S3
-                    sm = self._get_saliency_matrix(position)
+            candidates = []
 
-                    bounding_boxes = MaskMaker.make_bounding_boxes(sm)
+            # Position => (result key, landmark count) of its segmentation
+            segmentations = {}
 
-                    for bb in bounding_boxes:
-                        x1, x2, y1, y2 = [bb[k] for k in ('x1', 'x2', 'y1', 'y2')]
-                        if os.environ.get('debug'):
-                            cv2.imshow("Output", sm[y1:y2, x1:x2])
-                            cv2.waitKey(0)
+            # Load saliency masks from S3, across all positions available for this hit, as they finish downloading
+            for assets in metrics.timed('load_assets', AssetLoader.iter_hit_assets(
+                    self.hit_id, Constants.LANDMARK_POSITIONS.values(), require=AssetLoader.SALIENCY_MAP,
+                    images=False)):
+                position = assets.position
+                sm = assets.saliency_matrix
+                metrics.count('positions')
 
-                        landmark = {
-                            'id': uuid.uuid1(),
-                            'rect': {'x1': x1, 'x2': x2, 'y1': y1, 'y2': y2},
-                            'position': position
-                        }
+                # A retry, or a re-run over the same map, reuses the boxes and gets the same landmark ids
+                key, bounding_boxes = ResultCache.bounding_boxes(sm, metrics)
 
-                        # Insert candidate landmark into DB
-                        self._insert_candidate_landmark(landmark, session)
+                metrics.count('regions', len(bounding_boxes))
+                segmentations[position] = key, len(bounding_boxes)
+
+                for i, bb in enumerate(bounding_boxes):
+                    x1, x2, y1, y2 = [bb[k] for k in ('x1', 'x2', 'y1', 'y2')]
+                    if os.environ.get('debug'):
+                        cv2.imshow("Output", sm[y1:y2, x1:x2])
+                        cv2.waitKey(0)
+
+                    landmark = {
+                        'id': ResultCache.landmark_id(self.hit_id, position, key, i),
+                        'rect': {'x1': x1, 'x2': x2, 'y1': y1, 'y2': y2},
+                        'position': position
+                    }
+
+                    # Queue candidate landmark for insertion into DB
+                    candidates.append(self._candidate_landmark_mapping(landmark))
 
             hit.set_end_time_for_task("mask")
 
-            # Commit DB inserts
-            session.commit()
+            # Delete the landmarks of earlier segmentations this one replaces, insert all candidate landmarks at once,
+            # and commit
+            stale = []
+            with metrics.span('db_commit'):
+                for position, (key, count) in segmentations.items():
+                    stale.extend(MaskSegmentations.replace(session, self.hit_id, position, key, count))
+
+                LandmarkStore.insert_landmarks(session, candidates, skip_existing=True)
+                session.commit()
+
+            metrics.count('landmarks', len(candidates))
+            metrics.count('landmarks_deleted', len(stale))
+
+            # Images of the deleted landmarks are removed once nothing references them
+            try:
+                with metrics.span('s3_delete'):
+                    MaskSegmentations.delete_images(stale)
+            except Exception:
+                traceback.print_exc()
 
             # Send success!
             self.send_success()
@@ -65,71 +99,25 @@ class MaskTask(Task.Task):
 
         except Exception as e:
             traceback.print_exc()
+            metrics.error(e)
             session.rollback()
             self.send_failure('MATRIX MASTER ERROR', e.message)
 
         finally:
             session.close()
+            metrics.finish()
 
-    def _get_saliency_matrix(self, position):
-        client = AWSClient.get_client('s3')
-        response = client.get_object(
-            Bucket=Constants.S3_BUCKETS['SALIENCY_MAPS'],
-            Key="{}_{}.json".format(self.hit_id, position)
-        )
-        data = json.load(response['Body'])
-        return np.array(data["saliencyMatrix"], np.uint8)
-
-    def _get_streetview_image(self, position):
-        client = AWSClient.get_client('s3')
-        response = client.get_object(
-            Bucket=Constants.S3_BUCKETS['STREETVIEW_IMAGES'],
-            Key="{}_{}.jpg".format(self.hit_id, position)
-        )
-        img = Image.open(response['Body'])
-        # img.show()
-        return np.array(img)
-
-    @staticmethod
-    def _put_cropped_images(candidate):
-        img_file = BytesIO()
-        transparent_img_file = BytesIO()
-        candidate['image'].save(img_file, 'PNG')
-        candidate['image_transparent'].save(transparent_img_file, 'PNG')
-        img_file.seek(0)
-        transparent_img_file.seek(0)
-
-        client = AWSClient.get_client('s3')
-
-        # Put cropped image
-        client.put_object(
-            Body=img_file,
-            ContentType='image/png',
-            Bucket=Constants.S3_BUCKETS['CROPPED_IMAGES'],
-            Key="{0}.png".format(candidate['id'])
-        )
-
-        # Put transparent cropped image
-        client.put_object(
-            Body=transparent_img_file,
-            ContentType='image/png',
-            Bucket=Constants.S3_BUCKETS['TRANSPARENT_CROPPED_IMAGES'],
-            Key="{0}.png".format(candidate['id'])
-        )
-
-    def _insert_candidate_landmark(self, candidate, session):
-        landmark = Landmark.Landmark(
+    def _candidate_landmark_mapping(self, candidate):
+        return LandmarkStore.landmark_mapping(
+            rect=candidate['rect'],
             landmark_id=candidate['id'],
             hit_id=self.hit_id,
             position=candidate['position'],
             status="UNKNOWN"
         )
-        landmark.set_rect(candidate['rect'])
-
-        session.add(landmark)
 
 
 if __name__ == '__main__':
     # Test
-    x = MaskTask(21, '123456gh')
+    x = MaskTask(21, 6, '123456gh')
     x.run()
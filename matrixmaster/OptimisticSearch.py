@@ -1,30 +1,120 @@
+import bisect
+import heapq
+import numpy as np
 import MaskMaker
 from pythoncore import Constants
 
 '''
 Finds salient areas intersecting a vertical degree.
 Center of image is at 0 degrees, with positive degrees to right and negative to left.
+In panorama mode bearings wrap around at +/-180 degrees. A missing or non-finite bearing finds no salient area.
 '''
 
 
-def get_salient_area_at_degrees(img, sm, deg):
-    salient_boxes = MaskMaker.make_bounding_boxes(sm)
-    img_height = img.shape[0]
-    img_width = img.shape[1]
-    pixels_per_degree = img_width / Constants.STREETVIEW_FOV
+def get_salient_area_at_degrees(img, sm, deg, panorama=False):
+    return BearingIndex.from_saliency_map(img, sm, panorama).lookup(deg)
 
-    # Since `deg` is (-180, 180), must adjust so that 0deg => FOV/2deg (center of image)
-    adjusted_deg = int(deg + Constants.STREETVIEW_FOV / 2)
 
-    # Clamp between (0, img_width - 1)
-    longitude = max(min(int(adjusted_deg * pixels_per_degree), img_width - 1), 0)
-    intersected_boxes = [box for box in salient_boxes if (box['x1'] < longitude < box['x2'])]
+class BearingIndex(object):
+    """
+    Answers bearing queries against the salient areas of one saliency map, segmenting it only once.
 
-    def box_comparator(b):
-        center = b['y2'] - b['y1']
-        return abs(center - img_height / 2.0)
+    The x-ranges of the boxes are cut into elementary intervals, each holding the box a query landing in it resolves
+    to, so every lookup is a binary search instead of a re-segmentation. The intervals are built in one sweep.
+    """
 
-    # If we have more than one salient region lying on the vertical, choose the one closest to the horizontal center
-    intersected_boxes.sort(key=box_comparator)
+    def __init__(self, boxes, img_width, img_height, panorama=False):
+        self.img_width = img_width
+        self.img_height = img_height
+        self.panorama = panorama
+        self.fov = 360.0 if panorama else Constants.STREETVIEW_FOV
+        self.pixels_per_degree = img_width / self.fov
 
-    return intersected_boxes[0] if len(intersected_boxes) > 0 else None
+        def box_comparator(b):
+            center = b['y2'] - b['y1']
+            return abs(center - img_height / 2.0)
+
+        # If more than one salient region lies on the vertical, choose the one closest to the horizontal center.
+        # Sorting is stable, so ties resolve to the first box, as in a per-query sort.
+        ranked = sorted(boxes, key=box_comparator)
+
+        # (x1, x2, box) of the columns each box spans. A panorama box crossing the wrap also spans the columns from 0,
+        # as if shifted back by a turn.
+        spans = []
+        for b in ranked:
+            spans.append((b['x1'], b['x2'], b))
+
+            if panorama and b['x2'] >= img_width:
+                spans.append((b['x1'] - img_width, b['x2'] - img_width, b))
+
+        # A box intersects longitudes x1 < longitude < x2, i.e. the integer range [x1 + 1, x2)
+        breaks = sorted(set([x1 + 1 for x1, _, _ in spans] + [x2 for _, x2, _ in spans]))
+
+        self._breaks = breaks
+        self._boxes = []
+
+        # Sweep the breaks left to right, keeping the spans open at the current one in a heap by rank, so each break
+        # resolves to the first span in ranked order that it lies in
+        starts = sorted(range(len(spans)), key=lambda i: spans[i][0])
+        open_spans = []
+        j = 0
+
+        for start in breaks:
+            while j < len(starts) and spans[starts[j]][0] < start:
+                heapq.heappush(open_spans, starts[j])
+                j += 1
+
+            # Spans ending at or before the break are closed
+            while open_spans and spans[open_spans[0]][1] <= start:
+                heapq.heappop(open_spans)
+
+            self._boxes.append(spans[open_spans[0]][2] if open_spans else None)
+
+    @classmethod
+    def from_saliency_map(cls, img, sm, panorama=False):
+        boxes = MaskMaker.make_panorama_bounding_boxes(sm) if panorama else MaskMaker.make_bounding_boxes(sm)
+        return cls(boxes, img.shape[1], img.shape[0], panorama)
+
+    def longitude(self, deg):
+        if self.panorama:
+            # 0deg is the centre column, and bearings wrap around at +/-180deg
+            return int(((deg + 180.0) % 360.0) * self.pixels_per_degree) % self.img_width
+
+        # Since `deg` is (-180, 180), must adjust so that 0deg => FOV/2deg (center of image)
+        adjusted_deg = int(deg + Constants.STREETVIEW_FOV / 2)
+
+        # Clamp between (0, img_width - 1)
+        return max(min(int(adjusted_deg * self.pixels_per_degree), self.img_width - 1), 0)
+
+    def lookup(self, deg):
+        """
+        Returns the salient box at bearing `deg`, or None. In panorama mode, a box crossing the wrap has x2 past the
+        panorama's width.
+        """
+        if deg is None or not np.isfinite(deg):
+            return None
+
+        i = bisect.bisect_right(self._breaks, self.longitude(deg)) - 1
+        box = self._boxes[i] if i >= 0 else None
+
+        return dict(box) if box is not None else None
+
+    def lookup_many(self, degs):
+        """
+        Vectorized lookup. Returns a list with the salient box (or None) at each bearing of `degs`.
+        """
+        # None becomes nan, which has no longitude; clamping it would resolve it to column 0
+        degs = np.asarray(degs, dtype=np.float64)
+        finite = np.isfinite(degs)
+        degs = np.where(finite, degs, 0.0)
+
+        if self.panorama:
+            longitudes = (np.mod(degs + 180.0, 360.0) * self.pixels_per_degree).astype(np.int64) % self.img_width
+        else:
+            adjusted_deg = (degs + Constants.STREETVIEW_FOV / 2).astype(np.int64)
+            longitudes = np.clip((adjusted_deg * self.pixels_per_degree).astype(np.int64), 0, self.img_width - 1)
+
+        indices = np.searchsorted(self._breaks, longitudes, side='right') - 1
+
+        return [dict(self._boxes[i]) if ok and i >= 0 and self._boxes[i] is not None else None
+                for i, ok in zip(indices, finite)]
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import struct
+import uuid
+import numpy as np
+import AssetLoader
+import Config
+import Instrumentation
+import MaskMaker
+
+'''
+Caches stage results by the content and settings they were computed from, and derives landmark ids from result
+keys, so a retried task reuses its results and produces the same landmark rows and S3 keys.
+'''
+
+# Namespace of the landmark ids derived from result keys
+LANDMARK_NAMESPACE = uuid.UUID('6f1c1f0e-5a43-4c1b-9a8e-2f0d6c3b7e41')
+
+cache = AssetLoader.ArrayCache(
+    Config.get_int('MATRIX_RESULT_CACHE_BYTES', 64 * 1024 * 1024),
+    disk_dir=Config.get_str('MATRIX_RESULT_CACHE_DIR'),
+    max_disk_bytes=Config.get_int('MATRIX_RESULT_CACHE_DISK_BYTES', 1024 * 1024 * 1024)
+)
+
+
+def result_key(stage, arrays, parameters):
+    """
+    Returns the key of a `stage` result computed from `arrays` with the algorithm `parameters` (a JSON-able dict).
+    """
+    digest = hashlib.sha1(json.dumps([stage, parameters], sort_keys=True).encode('utf-8'))
+
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        digest.update('{}{}'.format(arr.dtype.str, arr.shape).encode('utf-8'))
+        digest.update(arr.data)
+
+    return '{}-{}'.format(stage, digest.hexdigest())
+
+
+def landmark_id(hit_id, position, key, index):
+    """
+    Returns the id of the `index`th landmark of the result `key`, for a hit and position.
+    """
+    return uuid.uuid5(LANDMARK_NAMESPACE, '{}/{}/{}/{}'.format(hit_id, position, key, index))
+
+
+def _pack(doc, blobs):
+    header = json.dumps({'doc': doc, 'sizes': [len(b) for b in blobs]}).encode('utf-8')
+    return np.frombuffer(struct.pack('<I', len(header)) + header + b''.join(blobs), np.uint8)
+
+
+def _unpack(arr):
+    data = arr.tobytes()
+    size = struct.unpack('<I', data[:4])[0]
+    header = json.loads(data[4:4 + size].decode('utf-8'))
+
+    blobs = []
+    offset = 4 + size
+    for size in header['sizes']:
+        blobs.append(data[offset:offset + size])
+        offset += size
+
+    return header['doc'], blobs
+
+
+def get(key):
+    """
+    Returns the (document, blobs) stored under `key`, or None.
+    """
+    arr = cache.get((key,))
+    return None if arr is None else _unpack(arr)
+
+
+def put(key, doc, blobs=()):
+    cache.put((key,), _pack(doc, blobs))
+
+
+def bounding_boxes(sm, metrics=Instrumentation.NULL, scale=None):
+    """
+    Returns (key, boxes): the result key and MaskMaker's bounding boxes of the salient regions of `sm`, segmented at
+    `scale` (default the configured one), from cache when the map was segmented before with the same settings.
+    """
+    key = result_key('mask', [sm], MaskMaker.parameters(scale))
+    cached = get(key)
+
+    if cached is not None:
+        metrics.count('result_cache_hits')
+        return key, cached[0]['boxes']
+
+    with metrics.span('watershed'):
+        markers = MaskMaker.segment(sm, scale)
+
+    with metrics.span('regions'):
+        boxes = MaskMaker.regions_to_bounding_boxes(MaskMaker.regions_from_markers(markers, sm))
+
+    put(key, {'boxes': boxes})
+
+    return key, boxes
@@ -0,0 +1,160 @@
+import json
+import struct
+from io import BytesIO
+import numpy as np
+import cv2
+
+'''
+Encodes and decodes saliency maps, in the binary raw, npy and png formats or the legacy JSON document.
+The format is sniffed from the leading bytes; raw and npy decode zero-copy into read-only arrays.
+'''
+
+# Raw documents: magic, uint32 height, uint32 width (little endian), then height * width uint8 values
+RAW_MAGIC = b'SMAP'
+RAW_HEADER = struct.Struct('<4sII')
+
+NPY_MAGIC = b'\x93NUMPY'
+PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+
+# name => {'magic', 'suffixes', 'decode', 'encode', 'content_type'}
+_CODECS = {}
+
+# Order in which codecs are sniffed
+_SNIFF_ORDER = []
+
+
+def register_codec(name, decode, encode, suffixes=(), magic=None, content_type='application/octet-stream'):
+    """
+    Registers a saliency map codec.
+    `decode` takes the raw document bytes and returns a 2D uint8 array, `encode` does the reverse.
+    Documents starting with `magic` (if given) or stored under a key ending in one of `suffixes` use this codec.
+    """
+    _CODECS[name] = {
+        'decode': decode,
+        'encode': encode,
+        'suffixes': tuple(suffixes),
+        'magic': magic,
+        'content_type': content_type
+    }
+
+    if name in _SNIFF_ORDER:
+        _SNIFF_ORDER.remove(name)
+
+    if magic is not None:
+        _SNIFF_ORDER.append(name)
+
+
+def detect_format(data, key=None):
+    # Leading bytes are authoritative, as producers may write binary maps under legacy .json keys
+    for name in _SNIFF_ORDER:
+        if data[:len(_CODECS[name]['magic'])] == _CODECS[name]['magic']:
+            return name
+
+    if key is not None:
+        for name, codec in _CODECS.items():
+            if key.endswith(codec['suffixes']):
+                return name
+
+    return 'json'
+
+
+def decode(data, key=None, fmt=None):
+    """
+    Decodes a saliency map document into a 2D uint8 array.
+    `data` is the full document (bytes); `key` is the S3 key it was read from, used as a format hint.
+    """
+    if fmt is None:
+        fmt = detect_format(data, key)
+
+    return _CODECS[fmt]['decode'](data)
+
+
+def encode(sm, fmt='raw'):
+    """
+    Encodes a 2D saliency map into a document of the given format. Returns bytes.
+    """
+    return _CODECS[fmt]['encode'](np.asarray(sm, dtype=np.uint8))
+
+
+def content_type(fmt):
+    return _CODECS[fmt]['content_type']
+
+
+def _check_shape(sm):
+    if sm.ndim != 2:
+        raise ValueError("Saliency map must be 2D, got shape {}".format(sm.shape))
+
+
+def _decode_raw(data):
+    magic, height, width = RAW_HEADER.unpack_from(data)
+
+    if magic != RAW_MAGIC:
+        raise ValueError("Not a raw saliency map")
+
+    return np.frombuffer(data, np.uint8, count=height * width, offset=RAW_HEADER.size).reshape(height, width)
+
+
+def _encode_raw(sm):
+    _check_shape(sm)
+    return RAW_HEADER.pack(RAW_MAGIC, sm.shape[0], sm.shape[1]) + np.ascontiguousarray(sm).tobytes()
+
+
+def _decode_npy(data):
+    # Parse the header ourselves so the array body can be wrapped without copying it
+    f = BytesIO(data)
+    version = np.lib.format.read_magic(f)
+
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+    count = int(np.prod(shape))
+    arr = np.frombuffer(data, dtype, count=count, offset=f.tell())
+    arr = arr.reshape(shape[::-1]).T if fortran_order else arr.reshape(shape)
+
+    return arr if dtype == np.uint8 else arr.astype(np.uint8)
+
+
+def _encode_npy(sm):
+    _check_shape(sm)
+    f = BytesIO()
+    np.save(f, np.ascontiguousarray(sm), allow_pickle=False)
+    return f.getvalue()
+
+
+def _decode_png(data):
+    sm = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+
+    if sm is None:
+        raise ValueError("Could not decode PNG saliency map")
+
+    return sm
+
+
+def _encode_png(sm):
+    _check_shape(sm)
+    ok, buf = cv2.imencode('.png', sm)
+
+    if not ok:
+        raise ValueError("Could not encode PNG saliency map")
+
+    return buf.tobytes()
+
+
+def _decode_json(data):
+    if not isinstance(data, str):
+        data = data.decode('utf-8')
+
+    return np.array(json.loads(data)["saliencyMatrix"], np.uint8)
+
+
+def _encode_json(sm):
+    _check_shape(sm)
+    return json.dumps({"saliencyMatrix": sm.tolist()}).encode('utf-8')
+
+
+register_codec('raw', _decode_raw, _encode_raw, suffixes=('.smap', '.raw'), magic=RAW_MAGIC)
+register_codec('npy', _decode_npy, _encode_npy, suffixes=('.npy',), magic=NPY_MAGIC)
+register_codec('png', _decode_png, _encode_png, suffixes=('.png',), magic=PNG_MAGIC, content_type='image/png')
+register_codec('json', _decode_json, _encode_json, suffixes=('.json',), content_type='application/json')
@@ -0,0 +1,107 @@
+import numpy as np
+
+'''
+Scores landmark rects against a saliency map, from its summed-area tables, in one vectorized call.
+Rects follow NumPy slicing, as sm[y1:y2, x1:x2] did: x2 and y2 are exclusive, and bounds are clipped to the map.
+'''
+
+
+def _integral(a):
+    s = np.zeros((a.shape[0] + 1, a.shape[1] + 1), np.float64 if a.dtype.kind == 'f' else np.int64)
+    np.cumsum(a, axis=0, dtype=s.dtype, out=s[1:, 1:])
+    np.cumsum(s[1:, 1:], axis=1, out=s[1:, 1:])
+    return s
+
+
+def rects_array(rects):
+    """
+    Converts a list of {'x1', 'y1', 'x2', 'y2'} dicts into an N x 4 int array of (x1, y1, x2, y2) rows.
+    None entries become empty rects, which score 0.
+    """
+    arr = np.zeros((len(rects), 4), np.int64)
+
+    for i, r in enumerate(rects):
+        if r is not None:
+            arr[i] = (r['x1'], r['y1'], r['x2'], r['y2'])
+
+    return arr
+
+
+class SaliencyScorer(object):
+    def __init__(self, sm, centre_sigma=0.25):
+        """
+        `centre_sigma` is the width of the centre weighting used by centre_weighted_scores, as a fraction of the map's
+        width and height.
+        """
+        self.sm = sm
+        self.height, self.width = sm.shape
+        self.centre_sigma = centre_sigma
+
+        self._integral = _integral(sm)
+        self.total = self._integral[-1, -1]
+
+        self._weighted_integral = None
+
+    def _bounds(self, rects):
+        rects = np.asarray(rects, dtype=np.int64).reshape(-1, 4)
+
+        x1 = np.clip(rects[:, 0], 0, self.width)
+        y1 = np.clip(rects[:, 1], 0, self.height)
+        x2 = np.maximum(np.clip(rects[:, 2], 0, self.width), x1)
+        y2 = np.maximum(np.clip(rects[:, 3], 0, self.height), y1)
+
+        return x1, y1, x2, y2
+
+    @staticmethod
+    def _lookup(s, x1, y1, x2, y2):
+        return s[y2, x2] - s[y1, x2] - s[y2, x1] + s[y1, x1]
+
+    def sums(self, rects):
+        """
+        Returns the saliency sum over each rect of an N x 4 (x1, y1, x2, y2) array.
+        """
+        return self._lookup(self._integral, *self._bounds(rects))
+
+    def scores(self, rects):
+        """
+        Returns each rect's visual saliency score: its share of the map's total saliency.
+        """
+        return self.sums(rects) / float(self.total)
+
+    def score(self, rect):
+        """
+        Scores a single {'x1', 'y1', 'x2', 'y2'} rect.
+        """
+        return self.scores(rects_array([rect]))[0]
+
+    def means(self, rects):
+        """
+        Returns the mean saliency within each rect, 0 for empty rects.
+        """
+        x1, y1, x2, y2 = self._bounds(rects)
+        area = (x2 - x1) * (y2 - y1)
+        sums = self._lookup(self._integral, x1, y1, x2, y2)
+
+        return np.where(area > 0, sums / np.maximum(area, 1).astype(np.float64), 0.0)
+
+    def peaks(self, rects):
+        """
+        Returns the peak saliency within each rect, 0 for empty rects.
+        Unlike the other statistics this is not O(1) per rect: each rect's pixels are scanned.
+        """
+        return np.array([self.sm[b:d, a:c].max() if c > a and d > b else 0
+                         for a, b, c, d in zip(*self._bounds(rects))], dtype=np.float64)
+
+    def centre_weighted_scores(self, rects):
+        """
+        Like scores, with saliency weighted by a Gaussian centred on the frame, so salient areas near the centre of
+        view count for more than those at the edges.
+        """
+        if self._weighted_integral is None:
+            wy = np.exp(-0.5 * ((np.arange(self.height) - (self.height - 1) / 2.0) /
+                                (self.centre_sigma * self.height)) ** 2)
+            wx = np.exp(-0.5 * ((np.arange(self.width) - (self.width - 1) / 2.0) /
+                                (self.centre_sigma * self.width)) ** 2)
+            self._weighted_integral = _integral(self.sm * wy[:, np.newaxis] * wx[np.newaxis, :])
+
+        return self._lookup(self._weighted_integral, *self._bounds(rects)) / float(self._weighted_integral[-1, -1])
@@ -0,0 +1,247 @@
+import multiprocessing
+import os
+import threading
+import time
+import Config
+
+'''
+Adaptive concurrency of the worker's activities, under a CPU budget.
+Slots are rebalanced periodically by each activity's running tasks and backlog, for the poller threads of one process.
+'''
+
+# Weight of the latest task in an activity's moving average latency
+LATENCY_SMOOTHING = 0.2
+
+
+def _read_int(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def available_cpus():
+    """
+    Returns the cores available to this container: the cgroup CPU quota if one is set, else the core count.
+    """
+    cpus = multiprocessing.cpu_count()
+
+    # cgroup v2, then v1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            return max(min(float(quota) / float(period), cpus), 1.0)
+    except (IOError, OSError, ValueError):
+        pass
+
+    quota = _read_int('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+    period = _read_int('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota and period and quota > 0:
+        return max(min(float(quota) / period, cpus), 1.0)
+
+    return float(cpus)
+
+
+def available_memory():
+    """
+    Returns the memory available to this container, in bytes: the cgroup limit if one is set, else physical memory.
+    """
+    physical = None
+    try:
+        physical = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        pass
+
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        limit = _read_int(path)
+        # Unlimited cgroups report 'max' (v2) or a huge number (v1)
+        if limit and (physical is None or limit < physical):
+            return limit
+
+    return physical
+
+
+class Activity(object):
+    def __init__(self, name, cpu, min_slots, max_slots):
+        self.name = name
+        self.cpu = cpu
+        self.min_slots = min_slots
+        self.max_slots = max_slots
+
+
+class Scheduler(object):
+    def __init__(self, activities, cpu_budget, max_concurrency, interval):
+        """
+        `activities` is a list of Activity. `cpu_budget` is in CPU units, `interval` in seconds.
+        """
+        self.activities = activities
+        self.index = dict((a.name, i) for i, a in enumerate(activities))
+        self.cpu_budget = cpu_budget
+        self.max_concurrency = max(max_concurrency, sum(a.min_slots for a in activities))
+        self.interval = interval
+
+        n = len(activities)
+        self._cond = threading.Condition()
+
+        # Per activity slots, claimed slots, running tasks, queued tasks, completed tasks, and average latency
+        self._claimed = [0] * n
+        self._running = [0] * n
+        self._backlog = [0] * n
+        self._completed = [0] * n
+        self._latency = [0.0] * n
+        self._cpu_in_use = 0.0
+        self._last_rebalance = time.time()
+
+        # Start with an even split
+        self._slots = self._allocate([1.0] * n)
+
+    @classmethod
+    def from_config(cls, names, cpu_costs):
+        """
+        Builds a scheduler of the activities `names`, with default CPU units per task from `cpu_costs` (name => units),
+        sized from the container's cores and memory. The limits can be set with MATRIX_CPU_BUDGET (CPU units, default
+        the cores available), MATRIX_MAX_CONCURRENCY (total slots, default the smaller of twice the cores and memory /
+        MATRIX_TASK_MEMORY), MATRIX_SCHEDULER_INTERVAL (seconds between rebalances), and per activity
+        MATRIX_<ACTIVITY>_CPU, MATRIX_<ACTIVITY>_MIN_SLOTS and MATRIX_<ACTIVITY>_MAX_SLOTS.
+        """
+        cpus = available_cpus()
+        memory = available_memory()
+
+        default_concurrency = int(2 * cpus)
+        if memory:
+            default_concurrency = min(default_concurrency, memory // Config.get_int('MATRIX_TASK_MEMORY', 512 << 20))
+
+        max_concurrency = Config.get_int('MATRIX_MAX_CONCURRENCY', max(int(default_concurrency), len(names)))
+
+        activities = [Activity(
+            name,
+            Config.get_float('MATRIX_{}_CPU'.format(name.upper()), cpu_costs.get(name, 1.0)),
+            Config.get_int('MATRIX_{}_MIN_SLOTS'.format(name.upper()), 1),
+            Config.get_int('MATRIX_{}_MAX_SLOTS'.format(name.upper()), max_concurrency)
+        ) for name in names]
+
+        return cls(activities, Config.get_float('MATRIX_CPU_BUDGET', cpus), max_concurrency,
+                   Config.get_float('MATRIX_SCHEDULER_INTERVAL', 10))
+
+    def max_slots(self, name):
+        """
+        Returns the most tasks of an activity that can ever run at once: the concurrency to register it with.
+        """
+        return min(self.activities[self.index[name]].max_slots, self.max_concurrency)
+
+    def _allocate(self, demand):
+        """
+        Splits the total slots: every activity gets its minimum, the rest go in proportion to `demand`, within each
+        activity's maximum.
+        """
+        slots = [a.min_slots for a in self.activities]
+
+        # Hand out the spare slots one at a time, each to the activity with the most demand per slot it already got
+        for _ in range(self.max_concurrency - sum(slots)):
+            open_ = [i for i, a in enumerate(self.activities) if slots[i] < a.max_slots and demand[i] > 0]
+            if not open_:
+                break
+
+            best = max(open_, key=lambda i: demand[i] / float(slots[i] - self.activities[i].min_slots + 1))
+            slots[best] += 1
+
+        return slots
+
+    def _rebalance(self):
+        # Called with the condition held
+        now = time.time()
+        if now - self._last_rebalance < self.interval:
+            return
+
+        self._last_rebalance = now
+
+        demand = []
+        for i in range(len(self.activities)):
+            # Activities that never completed a task count one second per task
+            latency = self._latency[i] if self._completed[i] else 1.0
+            demand.append((self._running[i] + self._backlog[i]) * latency)
+
+        # When idle, split evenly, so a burst of any activity finds slots
+        if not any(demand):
+            demand = [1.0] * len(demand)
+
+        self._slots = self._allocate(demand)
+        self._cond.notify_all()
+
+    def _cost(self, i):
+        return min(self.activities[i].cpu, self.cpu_budget)
+
+    def _can_poll(self, i):
+        return self._claimed[i] < self._slots[i] and self._cpu_in_use + self._cost(i) <= self.cpu_budget + 1e-9
+
+    def acquire(self, name):
+        """
+        Blocks until activity `name` has a free slot and the CPU budget has room for one of its tasks, and claims the
+        slot, to poll for a task with. The CPU is only charged once the poll returns a task, so polls in flight when the
+        budget fills up can overshoot it by the tasks they return.
+        """
+        i = self.index[name]
+
+        with self._cond:
+            while True:
+                self._rebalance()
+                if self._can_poll(i):
+                    break
+                self._cond.wait(self.interval)
+
+            self._claimed[i] += 1
+
+    def start(self, name):
+        """
+        Charges the CPU of a task of activity `name` that a poll holding a slot returned, and counts it as running.
+        """
+        i = self.index[name]
+
+        with self._cond:
+            self._running[i] += 1
+            self._cpu_in_use += self._cost(i)
+
+    def release(self, name, started=None):
+        """
+        Frees a slot claimed by acquire(). For a task that started at `started` (see start()), also frees its CPU and
+        records its latency; without one, the poll found no task.
+        """
+        i = self.index[name]
+
+        with self._cond:
+            self._claimed[i] -= 1
+
+            if started is not None:
+                self._running[i] -= 1
+                self._cpu_in_use -= self._cost(i)
+
+                seconds = time.time() - started
+
+                if self._completed[i]:
+                    self._latency[i] += LATENCY_SMOOTHING * (seconds - self._latency[i])
+                else:
+                    self._latency[i] = seconds
+                self._completed[i] += 1
+
+            self._rebalance()
+            self._cond.notify_all()
+
+    def set_backlog(self, name, tasks):
+        """
+        Sets the number of tasks of activity `name` queued in Step Functions, for the next rebalance.
+        """
+        with self._cond:
+            self._backlog[self.index[name]] = max(int(tasks), 0)
+
+    def stats(self):
+        with self._cond:
+            return dict((a.name, {
+                'slots': self._slots[i],
+                'claimed': self._claimed[i],
+                'running': self._running[i],
+                'backlog': self._backlog[i],
+                'completed': self._completed[i],
+                'latency': self._latency[i]
+            }) for i, a in enumerate(self.activities))
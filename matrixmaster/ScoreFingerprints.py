@@ -0,0 +1,67 @@
+import hashlib
+import json
+from sqlalchemy import Column, String
+import LandmarkStore
+
+'''
+Fingerprints (saliency map ETag and rect) of the inputs of each landmark's score, in the side table
+landmark_score_fingerprint, so the incremental score stage only rescores landmarks whose inputs changed.
+'''
+
+# Bump when a change to scoring changes scores, so every landmark is rescored once
+VERSION = 1
+
+
+class ScoreFingerprint(LandmarkStore.SideTable):
+    __tablename__ = 'landmark_score_fingerprint'
+
+    landmark_id = Column(String(36), primary_key=True)
+    fingerprint = Column(String(40), nullable=False)
+
+
+def fingerprint(saliency_map_version, rect):
+    """
+    Returns the fingerprint of a score computed from `rect` on the saliency map of `saliency_map_version`, or None when
+    either is unknown, as such scores are never reused.
+    """
+    if saliency_map_version is None or rect is None:
+        return None
+
+    doc = [VERSION, saliency_map_version, [int(rect[k]) for k in ('x1', 'y1', 'x2', 'y2')]]
+    return hashlib.sha1(json.dumps(doc).encode('utf-8')).hexdigest()
+
+
+def load(session, landmark_ids):
+    """
+    Returns {landmark id (str): fingerprint} of the landmarks in `landmark_ids` that have one.
+    """
+    return LandmarkStore.load_side_values(session, ScoreFingerprint.fingerprint, landmark_ids)
+
+
+def store(session, fingerprints):
+    """
+    Stores {landmark id: fingerprint}, replacing the landmarks' previous fingerprints. None fingerprints are not stored.
+    Committed with the session.
+    """
+    fingerprints = dict((str(i), f) for i, f in fingerprints.items() if f is not None)
+    existing = load(session, list(fingerprints))
+
+    inserts = [{'landmark_id': i, 'fingerprint': f} for i, f in fingerprints.items() if i not in existing]
+    updates = [{'landmark_id': i, 'fingerprint': f} for i, f in fingerprints.items()
+               if i in existing and existing[i] != f]
+
+    if inserts:
+        session.bulk_insert_mappings(ScoreFingerprint, inserts)
+
+    if updates:
+        session.bulk_update_mappings(ScoreFingerprint, updates)
+
+
+def delete(session, landmark_ids):
+    """
+    Removes the fingerprints of the landmarks in `landmark_ids`, as the landmarks are deleted. Committed with the session.
+    """
+    for chunk in LandmarkStore.chunks([str(i) for i in landmark_ids]):
+        session.query(ScoreFingerprint) \
+            .filter(ScoreFingerprint.landmark_id.in_(chunk)) \
+            .delete(synchronize_session=False)
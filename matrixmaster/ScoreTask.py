@@ -1,27 +1,90 @@
-import json
-import uuid
-from io import BytesIO
 import traceback
-import numpy as np
-from PIL import Image
 from pythoncore import Task, Constants
-from pythoncore.AWS import AWSClient
-from pythoncore.Model import TorchbearerDB, Landmark, Hit
-from matplotlib import pyplot as plt
+from pythoncore.Model import TorchbearerDB, Hit
 import os
 import OptimisticSearch
 
-import GrabCut
 import MaskMaker
+import AssetLoader
+import Config
+import Deadline
+import Degradations
+import LandmarkStore
+import SaliencyScorer
+import ScoreFingerprints
+import Instrumentation
+
+'''
+Scores the landmarks of a hit by the saliency of their rect, finding rects by optimistic search for landmarks without.
+With MATRIX_SCORE_INCREMENTAL, only landmarks whose inputs changed are scored (see ScoreFingerprints).
+'''
+
+
+def score_landmarks(scorer, landmarks, image_size, search_boxes, level=Deadline.FULL, budget=None, new_rects=(),
+                    metrics=Instrumentation.NULL):
+    """
+    Scores `landmarks`, then `new_rects`, with SaliencyScorer `scorer`. Landmarks without a rect are given one by
+    optimistic search among the boxes `search_boxes(level)` returns, unless `level` is MINIMAL, and are recorded at
+    `level` in `budget`. Returns (rects, scores, updates): the rects of the landmarks then `new_rects`, their scores,
+    and the landmarks' update mappings.
+    """
+    rects = [landmark.get_rect() for landmark in landmarks]
+    found_rects = {}
+
+    # If rectangle was not already defined by another service, do optimistic saliency search
+    # Note that this can still return None
+    # The saliency map is segmented once, and all bearings of this position are resolved in one call
+    unbounded = [i for i, r in enumerate(rects) if r is None]
+
+    if unbounded and level != Deadline.MINIMAL:
+        with metrics.span('optimistic_search'):
+            bearing_index = OptimisticSearch.BearingIndex(search_boxes(level), *image_size)
+            bearings = [landmarks[i].relative_bearing for i in unbounded]
+
+            for i, r in zip(unbounded, bearing_index.lookup_many(bearings)):
+                # A landmark without a salient area at its bearing keeps its rect unset
+                if r is not None:
+                    rects[i] = found_rects[i] = r
+
+        metrics.count('optimistic_searches', len(unbounded))
+
+    # Only the rects found by the search depend on the level. A rect found by a degraded search is kept, so its
+    # landmark stays recorded as degraded until its rect is cleared.
+    if budget is not None:
+        for i in unbounded:
+            budget.record(landmarks[i].landmark_id, level)
+
+    # Compute visual saliency scores for all landmarks at once (0 for landmarks without a rect)
+    rects.extend(new_rects)
+
+    with metrics.span('score'):
+        scores = [float(s) for s in scorer.scores(SaliencyScorer.rects_array(rects))]
+
+    updates = []
+
+    for i, landmark in enumerate(landmarks):
+        values = {'visual_saliency_score': scores[i]}
+
+        # Save rects found by optimistic search with landmark back to db
+        if i in found_rects:
+            values.update(LandmarkStore.rect_values(found_rects[i]))
+
+        updates.append(LandmarkStore.update_mapping(landmark, **values))
+
+    return rects, scores, updates
 
 
 class ScoreTask(Task.Task):
-    def __init__(self, ep_id, hit_id, task_token):
+    def __init__(self, ep_id, hit_id, task_token, claimed_at=None):
         super(ScoreTask, self).__init__(ep_id, hit_id, task_token)
+        self.claimed_at = claimed_at
 
     def run(self):
         print("Starting score task for ep {}, hit {}".format(self.ep_id, self.hit_id))
 
+        metrics = Instrumentation.start('score', self.ep_id, self.hit_id)
+        budget = Deadline.Budget('score', metrics, started=self.claimed_at)
+
         # Create DB session
         session = TorchbearerDB.Session()
 
@@ -29,44 +92,77 @@ class ScoreTask(Task.Task):
             hit = session.query(Hit.Hit).filter_by(hit_id=self.hit_id).one()
             hit.set_start_time_for_task("score")
 
-            # Load saliency mask and image from S3, across all positions available for this ExecutionPoint
-            for position in Constants.LANDMARK_POSITIONS.values():
-                if AWSClient.s3_key_exists(Constants.S3_BUCKETS['STREETVIEW_IMAGES'],
-                                           "{}_{}.jpg".format(self.hit_id, position)):
-                    sm = self._get_saliency_matrix(position)
-                    img = self._get_streetview_image(position)
-
-                    if os.environ.get('debug'):
-                        plt.imshow(img, alpha=1)
-                        plt.imshow(sm, alpha=0.6)
-                        plt.show()
-
-                    # Compute sum of saliency mask
-                    image_saliency_sum = sm.sum()
+            updates = []
+            fingerprints = {}
+            positions = Constants.LANDMARK_POSITIONS.values()
+            listings = None
+            work = None
 
-                    # Retrieve landmarks for this hit and position
-                    for landmark in session.query(Landmark.Landmark) \
-                            .filter_by(hit_id=self.hit_id, position=position).all():
+            if Config.get_bool('MATRIX_SCORE_INCREMENTAL'):
+                # Find the landmarks to score before downloading anything, and only load positions that have some
+                with metrics.span('plan'):
+                    listings, work = self._plan(session, positions, metrics)
 
-                        # Compute visual saliency score for this landmark
-                        r = landmark.get_rect()
+                positions = [p for p in positions if work[p]]
+                metrics.count('positions_unchanged', len(work) - len(positions))
 
-                        # If rectangle was not already defined by another service, do optimistic saliency search
-                        # Note that this can still return None
-                        # Save this rect with landmark back to db
-                        if r is None:
-                            r = OptimisticSearch.get_salient_area_at_degrees(img, sm, landmark.relative_bearing)
-                            landmark.set_rect(r)
+            # Load saliency mask and image from S3, across all positions available for this ExecutionPoint
+            for assets in metrics.timed('load_assets', AssetLoader.iter_hit_assets(
+                    self.hit_id, positions,
+                    # Only the frame's size is used, so only its header is read, but for debugging
+                    image_sizes_only=not os.environ.get('debug'), listings=listings)):
+                position = assets.position
+                metrics.count('positions')
+                sm = assets.saliency_matrix
+                img = assets.image
+
+                if os.environ.get('debug'):
+                    from matplotlib import pyplot as plt
+                    plt.imshow(img, alpha=1)
+                    plt.imshow(sm, alpha=0.6)
+                    plt.show()
+
+                # Build the saliency map's integral image once, to score every landmark of this position from it
+                with metrics.span('integral_image'):
+                    scorer = SaliencyScorer.SaliencyScorer(sm)
+
+                # Retrieve landmarks for this hit and position, loading only the columns needed for scoring
+                if work is not None:
+                    landmarks = work[position]
+                else:
+                    with metrics.span('db_load'):
+                        landmarks = LandmarkStore.load_for_scoring(session, self.hit_id, position)
+
+                # Short of time, the map is segmented at a lower resolution for the search, or not at all
+                rects, _, position_updates = score_landmarks(
+                    scorer, landmarks, assets.image_size,
+                    lambda level: MaskMaker.make_bounding_boxes(
+                        sm, Deadline.mask_scale(level, MaskMaker.parameters()['scale'])),
+                    level=budget.level(), budget=budget, metrics=metrics)
+
+                metrics.count('landmarks', len(landmarks))
+                updates.extend(position_updates)
+
+                if work is not None:
+                    map_key = AssetLoader.saliency_map_key(self.hit_id, position)
+                    version = listings[AssetLoader.SALIENCY_MAP].get(map_key)
+
+                    # Landmarks still without a rect get no fingerprint, so the search is tried again next time, nor do
+                    # those of a map missing from the listing, whose version is unknown
+                    for landmark, rect in zip(landmarks, rects):
+                        if rect is not None and version is not None:
+                            fingerprints[landmark.landmark_id] = ScoreFingerprints.fingerprint(version, rect)
 
-                        visual_saliency_score = sm[r['y1']:r['y2'], r['x1']:r['x2']].sum() / float(image_saliency_sum) \
-                            if r is not None else 0
+            hit.set_end_time_for_task("score")
 
-                        landmark.visual_saliency_score = visual_saliency_score
+            # Write all scores at once, and commit
+            with metrics.span('db_commit'):
+                LandmarkStore.update_landmarks(session, updates)
+                ScoreFingerprints.store(session, fingerprints)
 
-            hit.set_end_time_for_task("score")
+                Degradations.store(session, 'score', budget.levels)
 
-            # Commit DB inserts
-            session.commit()
+                session.commit()
 
             # Send success!
             self.send_success()
@@ -74,30 +170,45 @@ class ScoreTask(Task.Task):
 
         except Exception as e:
             traceback.print_exc()
+            metrics.error(e)
             session.rollback()
             self.send_failure('MATRIX MASTER ERROR', e.message)
 
         finally:
             session.close()
+            metrics.finish()
+
+    def _plan(self, session, positions, metrics):
+        """
+        Returns (listings, {position: landmarks to score}), the listings being the hit's saliency maps, as
+        AssetLoader.iter_hit_assets takes them.
+        """
+        listings = {
+            AssetLoader.SALIENCY_MAP: AssetLoader.list_hit_objects(
+                Constants.S3_BUCKETS[AssetLoader.SALIENCY_MAP], self.hit_id, metrics=metrics)
+        }
+        work = {}
+
+        for position in positions:
+            version = listings[AssetLoader.SALIENCY_MAP].get(AssetLoader.saliency_map_key(self.hit_id, position))
+
+            with metrics.span('db_load'):
+                landmarks = LandmarkStore.load_for_scoring(session, self.hit_id, position)
+                stored = ScoreFingerprints.load(session, [landmark.landmark_id for landmark in landmarks])
+
+            # New landmarks, landmarks whose rect or saliency map changed, and landmarks without a rect
+            work[position] = [landmark for landmark in landmarks if not self._unchanged(version, landmark, stored)]
+
+            metrics.count('landmarks_unchanged', len(landmarks) - len(work[position]))
+
+        return listings, work
+
+    @staticmethod
+    def _unchanged(version, landmark, stored):
+        # Landmarks without a rect, or on a saliency map of unknown version, are always scored
+        fingerprint = ScoreFingerprints.fingerprint(version, landmark.get_rect())
+        return fingerprint is not None and fingerprint == stored.get(str(landmark.landmark_id))
 
-    def _get_saliency_matrix(self, position):
-        client = AWSClient.get_client('s3')
-        response = client.get_object(
-            Bucket=Constants.S3_BUCKETS['SALIENCY_MAPS'],
-            Key="{}_{}.json".format(self.hit_id, position)
-        )
-        data = json.load(response['Body'])
-        return np.array(data["saliencyMatrix"], np.uint8)
-
-    def _get_streetview_image(self, position):
-        client = AWSClient.get_client('s3')
-        response = client.get_object(
-            Bucket=Constants.S3_BUCKETS['STREETVIEW_IMAGES'],
-            Key="{}_{}.jpg".format(self.hit_id, position)
-        )
-        img = Image.open(response['Body'])
-        # img.show()
-        return np.array(img)
 
 if __name__ == '__main__':
     # Test
@@ -0,0 +1,77 @@
+import threading
+from contextlib import contextmanager
+import numpy as np
+import Config
+
+'''
+Scratch buffers reused across landmarks and tasks.
+Kernels borrow an arena, one thread at a time, and take named buffers from it; only temporaries live in them.
+'''
+
+_idle = []
+_lock = threading.Lock()
+
+
+class Arena(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.reused = 0
+        self.allocated = 0
+        self._buffers = {}
+
+    def take(self, name, shape, dtype=np.uint8):
+        """
+        Returns an uninitialized array of `shape` and `dtype` backed by the `name` buffer, valid until the next take of
+        `name`.
+        """
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape)) * dtype.itemsize
+        buf = self._buffers.get(name)
+
+        if buf is not None and buf.nbytes >= size:
+            self.reused += 1
+            return buf[:size].view(dtype).reshape(shape)
+
+        self.allocated += 1
+        held = self.nbytes - (0 if buf is None else buf.nbytes)
+
+        if held + size > self.max_bytes:
+            return np.empty(shape, dtype)
+
+        buf = np.empty(size, np.uint8)
+        self._buffers[name] = buf
+        self.nbytes = held + size
+
+        return buf.view(dtype).reshape(shape)
+
+    def zeros(self, name, shape, dtype=np.uint8):
+        arr = self.take(name, shape, dtype)
+        arr.fill(0)
+        return arr
+
+
+@contextmanager
+def borrow():
+    """
+    Lends an arena for the duration of the with block.
+    """
+    with _lock:
+        arena = _idle.pop() if _idle else Arena(Config.get_int('MATRIX_SCRATCH_BYTES', 32 * 1024 * 1024))
+
+    try:
+        yield arena
+    finally:
+        with _lock:
+            if len(_idle) < Config.get_int('MATRIX_SCRATCH_ARENAS', 4):
+                _idle.append(arena)
+
+
+def stats():
+    with _lock:
+        return {
+            'idle_arenas': len(_idle),
+            'bytes': sum(arena.nbytes for arena in _idle),
+            'reused': sum(arena.reused for arena in _idle),
+            'allocated': sum(arena.allocated for arena in _idle)
+        }
@@ -0,0 +1,239 @@
+import threading
+import time
+from pythoncore.AWS import AWSClient
+import Config
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+'''
+Uploads task outputs to S3 in the background, from a bounded queue drained by uploader threads.
+batch.flush() blocks until every upload of the batch is stored, and raises UploadError if any failed.
+'''
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadBatch(object):
+    def __init__(self, uploader):
+        self._uploader = uploader
+        self._cond = threading.Condition()
+        self._pending = 0
+        self._errors = []
+
+        self.cancelled = False
+
+        self.uploaded = 0
+        self.bytes = 0
+        self.started = time.time()
+
+    def put(self, bucket, key, body, content_type=None):
+        """
+        Enqueues `body` (bytes) for upload to bucket/key. Blocks while the upload queue is full.
+        """
+        with self._cond:
+            self._pending += 1
+
+        self._uploader.enqueue(self, bucket, key, body, content_type)
+
+    def flush(self, timeout=None):
+        """
+        Blocks until all uploads of this batch are done. Raises UploadError if any failed.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+
+        with self._cond:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise UploadError("Timed out with {} uploads pending".format(self._pending))
+                self._cond.wait(remaining)
+
+            if self._errors:
+                raise UploadError("{} uploads failed, first: {}".format(len(self._errors), self._errors[0]))
+
+    def cancel(self):
+        """
+        Drops the uploads of this batch still in the queue. Uploads already in flight complete.
+        """
+        self.cancelled = True
+
+    def _done(self, size, error=None):
+        with self._cond:
+            self._pending -= 1
+
+            if error is None:
+                self.uploaded += 1
+                self.bytes += size
+            else:
+                self._errors.append(error)
+
+            self._cond.notify_all()
+
+
+class Uploader(object):
+    def __init__(self, workers, queue_size, retries, backoff, client=None):
+        self.retries = retries
+        self.backoff = backoff
+
+        self._client = client
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+
+        self.uploaded = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self.restarted = 0
+        self.bytes = 0
+        self.busy_seconds = 0.0
+        self.started = time.time()
+
+        self._workers = [self._start_worker() for _ in range(workers)]
+
+    def _start_worker(self):
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+        return t
+
+    def _check_workers(self):
+        """
+        Replaces uploader threads that died.
+        """
+        with self._lock:
+            for i, t in enumerate(self._workers):
+                if not t.is_alive():
+                    print("Uploader thread {} died, restarting it".format(t.name))
+                    self._workers[i] = self._start_worker()
+                    self.restarted += 1
+
+    def batch(self):
+        return UploadBatch(self)
+
+    def enqueue(self, batch, bucket, key, body, content_type):
+        self._check_workers()
+        self._queue.put((batch, bucket, key, body, content_type))
+
+    def metrics(self):
+        with self._lock:
+            elapsed = time.time() - self.started
+            return {
+                'queue_depth': self._queue.qsize(),
+                'uploaded': self.uploaded,
+                'failed': self.failed,
+                'retried': self.retried,
+                'dropped': self.dropped,
+                'restarted': self.restarted,
+                'bytes': self.bytes,
+                'uploads_per_second': self.uploaded / elapsed if elapsed else 0.0,
+                'bytes_per_second': self.bytes / elapsed if elapsed else 0.0,
+                'busy_seconds': self.busy_seconds
+            }
+
+    def _get_client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = AWSClient.get_client('s3')
+
+            return self._client
+
+    def _put_object(self, bucket, key, body, content_type):
+        kwargs = {'Body': body, 'Bucket': bucket, 'Key': key}
+        if content_type:
+            kwargs['ContentType'] = content_type
+
+        for attempt in range(self.retries + 1):
+            try:
+                # The client is created by the first put, and a failure to create it is retried like the put
+                self._get_client().put_object(**kwargs)
+                return
+            except Exception:
+                if attempt == self.retries:
+                    raise
+
+                with self._lock:
+                    self.retried += 1
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def _run(self):
+        while True:
+            batch, bucket, key, body, content_type = self._queue.get()
+            start = time.time()
+
+            if batch.cancelled:
+                with self._lock:
+                    self.dropped += 1
+                batch._done(len(body), "{}/{}: cancelled".format(bucket, key))
+                self._queue.task_done()
+                continue
+
+            try:
+                self._put_object(bucket, key, body, content_type)
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                    self.busy_seconds += time.time() - start
+                batch._done(len(body), "{}/{}: {}".format(bucket, key, e))
+            else:
+                with self._lock:
+                    self.uploaded += 1
+                    self.bytes += len(body)
+                    self.busy_seconds += time.time() - start
+                batch._done(len(body))
+            finally:
+                self._queue.task_done()
+
+
+_uploader = None
+_uploader_lock = threading.Lock()
+
+
+def get_uploader():
+    global _uploader
+
+    with _uploader_lock:
+        if _uploader is None:
+            _uploader = Uploader(
+                Config.get_int('MATRIX_UPLOAD_WORKERS', 8),
+                Config.get_int('MATRIX_UPLOAD_QUEUE_SIZE', 64),
+                Config.get_int('MATRIX_UPLOAD_RETRIES', 3),
+                Config.get_float('MATRIX_UPLOAD_BACKOFF', 0.5)
+            )
+
+    return _uploader
+
+
+def batch():
+    """
+    Opens an upload batch on the shared uploader.
+    """
+    return get_uploader().batch()
+
+
+def flush_timeout():
+    """
+    Returns the seconds a task waits for its uploads.
+    """
+    return Config.get_float('MATRIX_UPLOAD_TIMEOUT', 120)
+
+
+def metrics():
+    return get_uploader().metrics()
+
+
+def delete(bucket, keys, client=None):
+    """
+    Deletes the objects `keys` from S3 `bucket`, up to 1000 keys per request. The client defaults to AWSClient's.
+    """
+    client = client or AWSClient.get_client('s3')
+
+    for i in range(0, len(keys), 1000):
+        client.delete_objects(Bucket=bucket, Delete={
+            'Objects': [{'Key': key} for key in keys[i:i + 1000]],
+            'Quiet': True
+        })
@@ -1,46 +1,125 @@
-import matplotlib
+import os
 
-# Disable X server for matplotlib
-matplotlib.use('Agg')
+# Disable X server for matplotlib, which only debug paths import
+os.environ.setdefault('MPLBACKEND', 'Agg')
 
-from pythoncore import Constants, WorkerService
-from MaskTask import MaskTask
-from CropTask import CropTask
-from ScoreTask import ScoreTask
-from LandmarkMarker import LandmarkMarker
+import importlib
+from pythoncore import Constants, Task
+import ActivityPoller
+import Config
+import CropPool
+import HandlerProcesses
+import Scheduler
 import cv2
 
+'''
+Worker entry point.
+Task modules are imported by the first task of their activity, or before polling with MATRIX_WARM_UP.
+'''
+
+# Task class of each activity, as (module, class); the module is imported by the activity's first task
+TASKS = {
+    'mask': ('MaskTask', 'MaskTask'),
+    'fused': ('FusedTask', 'FusedTask'),
+    'score': ('ScoreTask', 'ScoreTask'),
+    'mark': ('LandmarkMarker', 'LandmarkMarker'),
+    'crop': ('CropTask', 'CropTask')
+}
+
+# Activities whose tasks cut out landmarks on CropPool's worker processes (crop_from_saliency cuts out inline)
+CROP_POOL_ACTIVITIES = ('crop',)
+
 
 # disable multithreading in OpenCV for main thread to avoid problems after fork
 # This is likely only needed on OSX, and multithreading could be re-enabled in production
 cv2.setNumThreads(0)
 
 
-def handle_mask_task(task_input, task_token):
+def task_module(name):
+    return importlib.import_module(TASKS[name][0])
+
+
+def task_class(name):
+    return getattr(task_module(name), TASKS[name][1])
+
+
+def fused_task():
+    """
+    Returns the FusedTask module when the fused pipeline is enabled, else None. FusedTask is only imported when it is
+    enabled, so score and mark workers don't load the mask stage's libraries when it is off.
+    """
+    if Config.fused_pipeline():
+        return task_module('fused')
+
+
+def warm_up(names):
+    """
+    Imports the task modules of activities `names`, and runs their warm_up() hooks.
+    """
+    if fused_task() and 'mask' in names:
+        names = list(names) + ['fused']
+
+    for name in names:
+        module = task_module(name)
+
+        if hasattr(module, 'warm_up'):
+            module.warm_up()
+
+
+def handle_mask_task(task_input, task_token, claimed_at=None):
     ep_id = task_input["epId"]
     hit_id = task_input["hitId"]
-    mt = MaskTask(ep_id, hit_id, task_token)
+
+    # In fused mode, the mask activity runs the score and mark stages too
+    if fused_task():
+        mt = task_class('fused')(ep_id, hit_id, task_token, claimed_at=claimed_at)
+    else:
+        mt = task_class('mask')(ep_id, hit_id, task_token)
+
     mt.run()
 
 
-def handle_score_task(task_input, task_token):
+def done_by_fused_task(name, ep_id, hit_id, task_token):
+    """
+    Reports success of a task of activity `name` whose work a fused task did, and returns whether it did.
+    """
+    fused = fused_task()
+
+    if not (fused and fused.consume(ep_id, hit_id, name)):
+        return False
+
+    print("{} task for ep {}, hit {} already done by fused task".format(name.capitalize(), ep_id, hit_id))
+    Task.Task(ep_id, hit_id, task_token).send_success()
+
+    return True
+
+
+def handle_score_task(task_input, task_token, claimed_at=None):
     ep_id = task_input["epId"]
     hit_id = task_input["hitId"]
-    st = ScoreTask(ep_id, hit_id, task_token)
+
+    if done_by_fused_task('score', ep_id, hit_id, task_token):
+        return
+
+    st = task_class('score')(ep_id, hit_id, task_token, claimed_at=claimed_at)
     st.run()
 
 
-def handle_mark_task(task_input, task_token):
+def handle_mark_task(task_input, task_token, claimed_at=None):
     ep_id = task_input["epId"]
     hit_id = task_input["hitId"]
-    lm = LandmarkMarker(ep_id, hit_id, task_token)
+
+    if done_by_fused_task('mark', ep_id, hit_id, task_token):
+        return
+
+    lm = task_class('mark')(ep_id, hit_id, task_token)
     lm.run()
 
 
-def handle_crop_task(task_input, task_token):
+def handle_crop_task(task_input, task_token, claimed_at=None):
     ep_id = task_input["epId"]
     hit_id = task_input["hitId"]
-    ct = CropTask(ep_id, hit_id, task_token)
+    ct = task_class('crop')(ep_id, hit_id, task_token, claimed_at=claimed_at)
     ct.run()
 
 if __name__ == '__main__':
@@ -51,8 +130,28 @@ if __name__ == '__main__':
     markTask = Constants.TASK_ARNS['LANDMARK_MARKER']
     # cropTask = Constants.TASK_ARNS['CROP_LANDMARKS']
 
-    WorkerService.start(
-        (scoreTask, handle_score_task, 2),
-        (markTask, handle_mark_task, 2),
-        (maskTask, handle_mask_task, 2)
-    )
+    # The activities this worker polls, as (name, activity ARN, handler)
+    pollers = [
+        ('score', scoreTask, handle_score_task),
+        ('mark', markTask, handle_mark_task),
+        ('mask', maskTask, handle_mask_task)
+        # ('crop', cropTask, handle_crop_task)
+    ]
+    activities = [name for name, _, _ in pollers]
+
+    # Concurrency is sized from the container, and shifted between activities by their latency and backlog.
+    # CPU units per task: mask runs a single-threaded watershed, score and mark mostly wait on S3 and the DB.
+    scheduler = Scheduler.Scheduler.from_config(activities, {'mask': 1.0, 'score': 0.5, 'mark': 0.5})
+
+    if Config.get_bool('MATRIX_WARM_UP', False):
+        warm_up(activities)
+
+    # Tasks run on one process per slot, so CPU-bound stages don't share a GIL. The processes are forked after the
+    # warm-up, which they inherit, and before the pollers start their threads. Each starts its own crop pool, as a
+    # pool's threads don't survive a fork.
+    initializer = CropPool.start if any(name in CROP_POOL_ACTIVITIES for name in activities) else None
+    processes = HandlerProcesses.HandlerProcesses(dict((name, handler) for name, _, handler in pollers),
+                                                  scheduler.max_concurrency, initializer=initializer)
+
+    # Pollers claim a slot before they poll, so the worker only takes tasks it can start
+    ActivityPoller.ActivityPoller(scheduler, pollers, processes=processes).start()
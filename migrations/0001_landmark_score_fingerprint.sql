@@ -0,0 +1,6 @@
+-- Fingerprints of the inputs of each landmark's visual saliency score (see matrixmaster/ScoreFingerprints.py)
+CREATE TABLE landmark_score_fingerprint (
+    landmark_id VARCHAR(36) NOT NULL,
+    fingerprint VARCHAR(40) NOT NULL,
+    PRIMARY KEY (landmark_id)
+);
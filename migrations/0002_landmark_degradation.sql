@@ -0,0 +1,7 @@
+-- Landmarks whose output a task degraded to meet its deadline (see matrixmaster/Degradations.py)
+CREATE TABLE landmark_degradation (
+    landmark_id VARCHAR(36) NOT NULL,
+    task VARCHAR(32) NOT NULL,
+    level VARCHAR(16) NOT NULL,
+    PRIMARY KEY (landmark_id, task)
+);
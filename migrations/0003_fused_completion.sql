@@ -0,0 +1,8 @@
+-- Hits and execution points whose score and mark work a fused task has done, one marker per activity, consumed by that
+-- activity's task (see matrixmaster/FusedTask.py)
+CREATE TABLE fused_completion (
+    hit_id INTEGER NOT NULL,
+    ep_id INTEGER NOT NULL,
+    activity VARCHAR(16) NOT NULL,
+    PRIMARY KEY (hit_id, ep_id, activity)
+);
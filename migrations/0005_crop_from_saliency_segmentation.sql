@@ -0,0 +1,9 @@
+-- The segmentation each hit and position's crop-from-saliency landmarks were derived from (see
+-- matrixmaster/MaskSegmentations.py)
+CREATE TABLE crop_from_saliency_segmentation (
+    hit_id INTEGER NOT NULL,
+    position VARCHAR(32) NOT NULL,
+    result_key VARCHAR(64) NOT NULL,
+    landmarks INTEGER NOT NULL,
+    PRIMARY KEY (hit_id, position)
+);
@@ -0,0 +1,189 @@
+import json
+import os
+import threading
+import time
+import unittest
+import testutil
+import ActivityPoller
+import HandlerProcesses
+import Scheduler
+
+'''
+ActivityPoller's slot and CPU accounting, driving a Scheduler with stub Step Functions and CloudWatch clients.
+'''
+
+
+class StubStepFunctions(object):
+    """
+    Serves the queued inputs of each activity ARN; an empty queue answers a poll with no task after `poll_seconds`.
+    """
+    def __init__(self, queues, poll_seconds=0.01):
+        self.queues = queues
+        self.poll_seconds = poll_seconds
+        self.polls = dict((arn, 0) for arn in queues)
+        self.polling = dict((arn, 0) for arn in queues)
+        self.most_polling = dict((arn, 0) for arn in queues)
+        self.failures = []
+        self.heartbeats = []
+        self._lock = threading.Lock()
+
+    def put(self, arn, task_input):
+        with self._lock:
+            self.queues[arn].append(task_input)
+
+    def get_activity_task(self, activityArn, workerName):
+        with self._lock:
+            self.polls[activityArn] += 1
+            self.polling[activityArn] += 1
+            self.most_polling[activityArn] = max(self.most_polling[activityArn], self.polling[activityArn])
+            queue = self.queues[activityArn]
+            task_input = queue.pop(0) if queue else None
+
+        if task_input is None:
+            time.sleep(self.poll_seconds)
+
+        with self._lock:
+            self.polling[activityArn] -= 1
+
+        if task_input is None:
+            return {}
+
+        return {'taskToken': 'token', 'input': json.dumps(task_input)}
+
+    def send_task_failure(self, taskToken, error, cause):
+        with self._lock:
+            self.failures.append((taskToken, error, cause))
+
+    def send_task_heartbeat(self, taskToken):
+        with self._lock:
+            self.heartbeats.append(taskToken)
+
+
+class StubCloudWatch(object):
+    def get_metric_statistics(self, **kwargs):
+        return {'Datapoints': []}
+
+
+def _sleep_or_exit(task_input, token, claimed_at):
+    if task_input.get('exit'):
+        os._exit(1)
+    time.sleep(task_input['seconds'])
+
+
+def _wait_for(condition, timeout=5.0):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class ActivityPollerTest(unittest.TestCase):
+    def scheduler(self, activities, cpu_budget, max_concurrency):
+        return Scheduler.Scheduler([Scheduler.Activity(*a) for a in activities], cpu_budget, max_concurrency, 3600)
+
+    def start(self, scheduler, sfn, handlers, processes=None):
+        poller = ActivityPoller.ActivityPoller(scheduler, [(name, name, handler) for name, handler in handlers],
+                                               processes=processes, client=sfn, cloudwatch=StubCloudWatch())
+        thread = threading.Thread(target=poller.start)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(poller.stop)
+        return poller
+
+    def test_empty_polls_hold_no_cpu(self):
+        # Two cores: idle score and mark pollers must leave room for a mask task
+        scheduler = self.scheduler([('score', 0.5, 2, 2), ('mark', 0.5, 1, 1), ('mask', 1.0, 1, 1)], 2.0, 4)
+        sfn = StubStepFunctions({'score': [], 'mark': [], 'mask': []}, poll_seconds=0.05)
+        ran = []
+        handler = lambda task_input, token, claimed_at: ran.append(task_input)
+
+        self.start(scheduler, sfn, [('score', handler), ('mark', handler), ('mask', handler)])
+
+        self.assertTrue(_wait_for(lambda: all(n >= 5 for n in sfn.polls.values())))
+        stats = scheduler.stats()
+        self.assertEqual([stats[a]['running'] for a in ('score', 'mark', 'mask')], [0, 0, 0])
+        self.assertLessEqual(scheduler._cpu_in_use, 1e-9)
+        self.assertEqual(sfn.most_polling, {'score': 2, 'mark': 1, 'mask': 1})
+
+        sfn.put('mask', {'n': 1})
+        self.assertTrue(_wait_for(lambda: ran == [{'n': 1}]))
+
+    def test_running_tasks_charge_cpu(self):
+        scheduler = self.scheduler([('a', 0.5, 3, 3)], 1.0, 3)
+        sfn = StubStepFunctions({'a': [{'n': i} for i in range(6)]})
+        seen = []
+
+        def handler(task_input, token, claimed_at):
+            with scheduler._cond:
+                seen.append((scheduler._running[0], scheduler._cpu_in_use, time.time() - claimed_at))
+            time.sleep(0.05)
+
+        self.start(scheduler, sfn, [('a', handler)])
+
+        self.assertTrue(_wait_for(lambda: scheduler.stats()['a']['completed'] == 6))
+
+        # Every running task, and only those, is charged
+        for running, cpu, seconds in seen:
+            self.assertTrue(1 <= running <= 3)
+            self.assertAlmostEqual(cpu, 0.5 * running)
+            self.assertLess(seconds, 1.0)
+        self.assertTrue(_wait_for(lambda: scheduler.stats()['a']['running'] == 0))
+        self.assertAlmostEqual(scheduler._cpu_in_use, 0.0)
+
+    def test_handler_errors_release_the_task(self):
+        scheduler = self.scheduler([('a', 1.0, 1, 1)], 1.0, 1)
+        sfn = StubStepFunctions({'a': [{'n': 1}, {'n': 2}]})
+        ran = []
+
+        def handler(task_input, token, claimed_at):
+            ran.append(task_input['n'])
+            raise ValueError('handler error')
+
+        self.start(scheduler, sfn, [('a', handler)])
+
+        self.assertTrue(_wait_for(lambda: scheduler.stats()['a']['completed'] == 2))
+        self.assertEqual(ran, [1, 2])
+        self.assertTrue(_wait_for(lambda: scheduler.stats()['a']['running'] == 0))
+
+        # Both claimed tasks are reported failed, without backing off
+        self.assertTrue(_wait_for(lambda: len(sfn.failures) == 2))
+        self.assertEqual(set(sfn.failures), set([('token', 'MATRIX MASTER ERROR', 'handler error')]))
+
+    def test_processes_run_and_heartbeat_tasks(self):
+        scheduler = self.scheduler([('a', 1.0, 1, 1)], 1.0, 1)
+        sfn = StubStepFunctions({'a': [{'seconds': 0.3}, {'exit': True}, {'seconds': 0}]})
+        processes = HandlerProcesses.HandlerProcesses({'a': _sleep_or_exit}, 1)
+        self.addCleanup(processes.close)
+
+        os.environ['MATRIX_HEARTBEAT_INTERVAL'] = '0.05'
+        self.addCleanup(os.environ.pop, 'MATRIX_HEARTBEAT_INTERVAL')
+        self.start(scheduler, sfn, [('a', _sleep_or_exit)], processes=processes)
+
+        self.assertTrue(_wait_for(lambda: scheduler.stats()['a']['completed'] == 3))
+        self.assertGreaterEqual(len(sfn.heartbeats), 2)
+
+        # The task whose process died is reported failed, and the next one runs on its replacement
+        self.assertEqual(len(sfn.failures), 1)
+        self.assertTrue(_wait_for(lambda: scheduler.stats()['a']['running'] == 0))
+
+    def test_poll_errors_back_off(self):
+        scheduler = self.scheduler([('a', 1.0, 1, 1)], 1.0, 1)
+        sfn = StubStepFunctions({'a': []})
+
+        def get_activity_task(activityArn, workerName):
+            sfn.polls[activityArn] += 1
+            raise ValueError('poll error')
+
+        sfn.get_activity_task = get_activity_task
+        self.start(scheduler, sfn, [('a', lambda task_input, token, claimed_at: None)])
+
+        self.assertTrue(_wait_for(lambda: sfn.polls['a'] >= 1))
+        time.sleep(0.1)
+        self.assertEqual(sfn.polls['a'], 1)
+        self.assertEqual(sfn.failures, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+import io
+import unittest
+import boto3
+import numpy as np
+from botocore.exceptions import ClientError
+from moto import mock_s3
+from PIL import Image
+import testutil
+from pythoncore import Constants
+import AssetLoader
+import ImageDecoder
+import SaliencyCodec
+
+'''
+AssetLoader's listing of a hit's objects and its concurrent download of their assets, against moto's S3.
+'''
+
+
+def _jpeg(width, height, value):
+    out = io.BytesIO()
+    Image.new('RGB', (width, height), (value, value, value)).save(out, 'JPEG')
+    return out.getvalue()
+
+
+class HitAssetsTest(unittest.TestCase):
+    def setUp(self):
+        mock = mock_s3()
+        mock.start()
+        self.addCleanup(mock.stop)
+
+        self.client = boto3.client('s3', region_name='us-east-1')
+        self.images = Constants.S3_BUCKETS[AssetLoader.STREETVIEW_IMAGE]
+        self.maps = Constants.S3_BUCKETS[AssetLoader.SALIENCY_MAP]
+
+        for bucket in (self.images, self.maps):
+            self.client.create_bucket(Bucket=bucket)
+
+        # Assets are cached by bucket, key and ETag across tests; moto's ETags are content hashes
+        for cache in (AssetLoader.cache, AssetLoader.encoded_cache):
+            cache.clear()
+            self.addCleanup(cache.clear)
+
+        self.gets = []
+        self.client.meta.events.register('before-parameter-build.s3.GetObject', self._record_get)
+
+    def _record_get(self, params, **kwargs):
+        self.gets.append((params['Key'], params.get('Range')))
+
+    def put_image(self, hit_id, position, width=8, height=4, value=0):
+        self.client.put_object(Bucket=self.images, Key=AssetLoader.streetview_image_key(hit_id, position),
+                               Body=_jpeg(width, height, value))
+
+    def put_saliency_map(self, hit_id, position, value=128):
+        sm = np.full((4, 8), value, np.uint8)
+        key = AssetLoader.saliency_map_key(hit_id, position)
+        self.client.put_object(Bucket=self.maps, Key=key, Body=SaliencyCodec.encode(sm))
+
+    def assets(self, hit_id, positions, **kwargs):
+        return dict((a.position, a) for a in AssetLoader.iter_hit_assets(hit_id, positions, client=self.client,
+                                                                         **kwargs))
+
+    def test_list_hit_objects_by_prefix(self):
+        self.put_image(12, 'front')
+        self.put_image(12, 'left')
+        self.put_image(123, 'front')
+        self.put_image(1, 'front')
+
+        etags = AssetLoader.list_hit_objects(self.images, 12, client=self.client)
+
+        self.assertEqual(sorted(etags), [AssetLoader.streetview_image_key(12, 'front'),
+                                         AssetLoader.streetview_image_key(12, 'left')])
+        head = self.client.head_object(Bucket=self.images, Key=AssetLoader.streetview_image_key(12, 'front'))
+        self.assertEqual(etags[AssetLoader.streetview_image_key(12, 'front')], head['ETag'])
+
+    def test_list_hit_objects_of_missing_hit(self):
+        self.assertEqual(AssetLoader.list_hit_objects(self.images, 12, client=self.client), {})
+
+    def test_iter_hit_assets_skips_missing_positions(self):
+        self.put_image(12, 'front', value=10)
+        self.put_saliency_map(12, 'front', 64)
+        self.put_image(12, 'left', value=200)
+        self.put_saliency_map(12, 'left', 192)
+
+        assets = self.assets(12, ['front', 'left', 'right'])
+
+        self.assertEqual(sorted(assets), ['front', 'left'])
+        self.assertEqual(assets['front'].image_size, (8, 4))
+        self.assertEqual(assets['front'].image.shape, (4, 8, 3))
+        self.assertLess(assets['front'].image.mean(), assets['left'].image.mean())
+        np.testing.assert_array_equal(assets['front'].saliency_matrix, np.full((4, 8), 64, np.uint8))
+        np.testing.assert_array_equal(assets['left'].saliency_matrix, np.full((4, 8), 192, np.uint8))
+
+    def test_iter_hit_assets_requires_saliency_map(self):
+        self.put_image(12, 'front')
+        self.put_image(12, 'left')
+        self.put_saliency_map(12, 'left')
+
+        self.assertEqual(sorted(self.assets(12, ['front', 'left'], saliency_maps=False)), ['front', 'left'])
+        self.assertEqual(sorted(self.assets(12, ['front', 'left'], require=AssetLoader.SALIENCY_MAP, images=False)),
+                         ['left'])
+
+    def test_iter_hit_assets_raises_for_unlisted_asset(self):
+        # The image is required and listed, but the saliency map does not exist: its HEAD fallback raises
+        self.put_image(12, 'front')
+
+        with self.assertRaises(ClientError):
+            self.assets(12, ['front'])
+
+    def test_frame_variants_are_downloaded_once(self):
+        self.put_image(12, 'front', width=64, height=48)
+
+        # A full frame would serve a reduced one too, so the reduced frame goes first
+        reduced, reduced_size = AssetLoader.get_streetview_frame(12, 'front', client=self.client, min_size=(8, 8))
+        rgb, size = AssetLoader.get_streetview_frame(12, 'front', client=self.client)
+        bgr, _ = AssetLoader.get_streetview_frame(12, 'front', client=self.client, order=ImageDecoder.BGR)
+
+        self.assertEqual(self.gets, [('12_front.jpg', None)])
+        self.assertEqual(size, (64, 48))
+        self.assertEqual(reduced_size, (64, 48))
+        np.testing.assert_array_equal(rgb, bgr[..., ::-1])
+        self.assertEqual(reduced.shape, (12, 16, 3))
+
+    def test_frame_size_from_header(self):
+        self.put_image(12, 'front', width=64, height=48)
+
+        self.assertEqual(AssetLoader.get_streetview_size(12, 'front', client=self.client), (64, 48))
+        self.assertEqual(AssetLoader.get_streetview_size(12, 'front', client=self.client), (64, 48))
+        self.assertEqual(self.gets, [('12_front.jpg', 'bytes=0-16383')])
+
+    def test_frame_size_from_cached_frame(self):
+        self.put_image(12, 'front', width=64, height=48)
+
+        AssetLoader.get_streetview_frame(12, 'front', client=self.client)
+
+        self.assertEqual(AssetLoader.get_streetview_size(12, 'front', client=self.client), (64, 48))
+        self.assertEqual(self.gets, [('12_front.jpg', None)])
+
+    def test_frame_size_with_long_header(self):
+        out = io.BytesIO()
+        Image.new('RGB', (64, 48)).save(out, 'JPEG', exif=b'Exif\x00\x00' + b'x' * 20000)
+        self.client.put_object(Bucket=self.images, Key=AssetLoader.streetview_image_key(12, 'front'),
+                               Body=out.getvalue())
+
+        self.assertEqual(AssetLoader.get_streetview_size(12, 'front', client=self.client), (64, 48))
+        self.assertEqual(self.gets, [('12_front.jpg', 'bytes=0-16383'), ('12_front.jpg', None)])
+
+    def test_iter_hit_assets_image_sizes_only(self):
+        self.put_image(12, 'front', width=64, height=48)
+        self.put_saliency_map(12, 'front')
+
+        assets = self.assets(12, ['front'], image_sizes_only=True)['front']
+
+        self.assertIsNone(assets.image)
+        self.assertEqual(assets.image_size, (64, 48))
+        self.assertEqual(sorted(self.gets), [('12_front.jpg', 'bytes=0-16383'), ('12_front.json', None)])
+
+    def test_iter_hit_assets_without_positions(self):
+        self.assertEqual(self.assets(12, []), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import multiprocessing.pool
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+import numpy as np
+import testutil
+import CropPool
+
+'''
+CropPool's recovery from a worker process that dies with a batch of cut-outs in flight, and its workers' frame cache.
+'''
+
+SETTINGS = {'MATRIX_CROP_WORKERS': '2', 'MATRIX_CROP_TIMEOUT': '2'}
+
+# Where each worker records its pid when it starts a cut-out; the workers inherit it when the pool forks them
+_started_dir = None
+
+
+def _slow_cut_out(frame, rect, iterations=None):
+    open(os.path.join(_started_dir, str(os.getpid())), 'w').close()
+    time.sleep(0.2)
+    return np.zeros((rect[3] - rect[1], rect[2] - rect[0], 4), np.uint8)
+
+
+def _kill_first_worker(killed, timeout=10.0):
+    """
+    Kills the first worker that starts a cut-out, while it is still running it, and appends its pid to `killed`.
+    """
+    end = time.time() + timeout
+    while time.time() < end:
+        pids = os.listdir(_started_dir)
+        if pids:
+            os.kill(int(pids[0]), signal.SIGKILL)
+            killed.append(int(pids[0]))
+            return
+        time.sleep(0.01)
+
+
+class CropPoolTest(unittest.TestCase):
+    def setUp(self):
+        global _started_dir
+        _started_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, _started_dir)
+
+        environ = os.environ.copy()
+        os.environ.update(SETTINGS)
+        self.addCleanup(lambda: (os.environ.clear(), os.environ.update(environ)))
+
+        # The workers run the slow cut-out, so it must be in place before the pool forks them
+        cut_out = CropPool.cut_out
+        CropPool.cut_out = _slow_cut_out
+        self.addCleanup(setattr, CropPool, 'cut_out', cut_out)
+        self.addCleanup(self.terminate_pool)
+
+        CropPool.start()
+        self.frame = np.zeros((40, 60, 3), np.uint8)
+        self.rects = [(0, 0, 10, 20), (10, 5, 40, 25), (20, 10, 60, 40)]
+
+    @staticmethod
+    def terminate_pool():
+        for pool in list(CropPool._batches) + [CropPool._pool]:
+            if pool is not None:
+                pool.terminate()
+
+        CropPool._pool = None
+        CropPool._batches.clear()
+
+    def test_cut_out_all(self):
+        with CropPool.SharedFrame(self.frame) as shared:
+            crops = shared.cut_out_all(self.rects)
+
+        self.assertEqual([crop.shape for crop in crops], [(20, 10, 4), (20, 30, 4), (30, 40, 4)])
+        # The cut-outs ran on the pool's workers, not inline
+        self.assertNotIn(str(os.getpid()), os.listdir(_started_dir))
+        self.assertTrue(os.listdir(_started_dir))
+
+    def test_killed_worker_replaces_the_pool(self):
+        pool = CropPool._pool
+        killed = []
+        killer = threading.Thread(target=_kill_first_worker, args=(killed,))
+
+        with CropPool.SharedFrame(self.frame) as shared:
+            started = time.time()
+            killer.start()
+
+            # The killed worker's job never returns, so the batch times out rather than hang
+            with self.assertRaises(CropPool.CropPoolError):
+                shared.cut_out_all(self.rects)
+
+            killer.join()
+            self.assertEqual(len(killed), 1)
+            self.assertLess(time.time() - started, 10)
+
+            # The pool was replaced, and the new one runs the batch
+            self.assertIsNot(CropPool._pool, pool)
+            crops = shared.cut_out_all(self.rects)
+
+        self.assertEqual([crop.shape for crop in crops], [(20, 10, 4), (20, 30, 4), (30, 40, 4)])
+
+    def test_replaced_pool_drains_other_batches(self):
+        # Another task's batch in flight on the pool
+        pool = CropPool._acquire_pool()
+        killer = threading.Thread(target=_kill_first_worker, args=([],))
+
+        with CropPool.SharedFrame(self.frame) as shared:
+            killer.start()
+
+            with self.assertRaises(CropPool.CropPoolError):
+                shared.cut_out_all(self.rects)
+
+            killer.join()
+
+        # New batches go to a new pool, and the old one is only terminated once the other batch is done
+        self.assertIsNot(CropPool._pool, pool)
+        self.assertEqual(pool._state, multiprocessing.pool.RUN)
+
+        CropPool._release_pool(pool)
+        self.assertEqual(pool._state, multiprocessing.pool.TERMINATE)
+        self.assertNotIn(pool, CropPool._batches)
+
+    def test_reused_frame_path(self):
+        frames = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, frames)
+        path = os.path.join(frames, 'frame.npy')
+        np.save(path, self.frame)
+        self.assertEqual(CropPool._open_frame(path).shape, (40, 60, 3))
+
+        # A later frame written under the same name is mapped, not the cached one
+        os.remove(path)
+        np.save(path, np.ones((20, 30, 3), np.uint8))
+        frame = CropPool._open_frame(path)
+        self.assertEqual(frame.shape, (20, 30, 3))
+        self.assertEqual(frame[0, 0, 0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
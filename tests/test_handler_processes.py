@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import testutil
+import HandlerProcesses
+
+'''
+HandlerProcesses running handlers on its processes, reporting their errors, replacing a process that dies, and
+heartbeating a task while it runs.
+'''
+
+
+def _record_pid(task_input, task_token, claimed_at):
+    open(os.path.join(task_input['dir'], task_token), 'w').write(str(os.getpid()))
+
+
+def _sleep(task_input, task_token, claimed_at):
+    time.sleep(task_input['seconds'])
+
+
+def _fail(task_input, task_token, claimed_at):
+    raise ValueError('handler error')
+
+
+def _exit(task_input, task_token, claimed_at):
+    os._exit(1)
+
+
+HANDLERS = {'pid': _record_pid, 'sleep': _sleep, 'fail': _fail, 'exit': _exit}
+
+
+class HandlerProcessesTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+        self.processes = HandlerProcesses.HandlerProcesses(HANDLERS, 1)
+        self.addCleanup(self.processes.close)
+
+    def pid(self, token):
+        self.processes.run('pid', {'dir': self.dir}, token, time.time())
+        return int(open(os.path.join(self.dir, token)).read())
+
+    def test_handlers_run_on_the_processes(self):
+        first = self.pid('a')
+        self.assertNotEqual(first, os.getpid())
+
+        # The process is reused across tasks
+        self.assertEqual(self.pid('b'), first)
+
+    def test_handler_errors_are_raised(self):
+        with self.assertRaises(HandlerProcesses.HandlerError) as raised:
+            self.processes.run('fail', {}, 'token', time.time())
+        self.assertEqual(str(raised.exception), 'handler error')
+
+        # The process survives its handler's error
+        self.pid('a')
+
+    def test_dead_processes_are_replaced(self):
+        first = self.pid('a')
+
+        with self.assertRaises(HandlerProcesses.HandlerError):
+            self.processes.run('exit', {}, 'token', time.time())
+
+        self.assertNotEqual(self.pid('b'), first)
+
+    def test_running_tasks_are_heartbeated(self):
+        beats = []
+        self.processes.run('sleep', {'seconds': 0.3}, 'token', time.time(), heartbeat=lambda: beats.append(1),
+                           interval=0.05)
+        self.assertTrue(2 <= len(beats) <= 6)
+
+        # A failing heartbeat doesn't fail the task
+        def heartbeat():
+            raise IOError('heartbeat error')
+
+        self.processes.run('sleep', {'seconds': 0.1}, 'token', time.time(), heartbeat=heartbeat, interval=0.02)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,243 @@
+import unittest
+import uuid
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+import testutil
+from pythoncore.Model.Landmark import Landmark
+import Degradations
+import LandmarkStore
+import MaskSegmentations
+
+'''
+LandmarkStore's bulk statements and partial loads, against an in-memory SQLite database.
+'''
+
+
+class LandmarkStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Landmark.__table__.create(self.engine)
+        LandmarkStore.SideTable.metadata.create_all(self.engine)
+
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+
+        self.session = sessionmaker(bind=self.engine)()
+        self.addCleanup(self.session.close)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append((statement.split()[0].upper(), executemany))
+
+    def inserts(self):
+        return [executemany for verb, executemany in self.statements if verb == 'INSERT']
+
+    def mapping(self, hit_id=1, position='front', rect=None, **kwargs):
+        kwargs.setdefault('landmark_id', str(uuid.uuid4()))
+        return LandmarkStore.landmark_mapping(rect=rect, hit_id=hit_id, position=position, **kwargs)
+
+    def stored_ids(self):
+        return sorted(str(row[0]) for row in self.session.query(Landmark.landmark_id))
+
+    def test_rect_columns(self):
+        values = LandmarkStore.rect_values({'x1': 1, 'x2': 2, 'y1': 3, 'y2': 4})
+
+        self.assertEqual(sorted(values), sorted(LandmarkStore.rect_columns()))
+        self.assertEqual(sorted(values.values()), [1, 2, 3, 4])
+        self.assertEqual(set(LandmarkStore.rect_values(None).values()), set([None]))
+
+    def test_insert_landmarks_in_one_statement(self):
+        mappings = [self.mapping(rect={'x1': i, 'x2': i + 10, 'y1': 0, 'y2': 5}, status='UNKNOWN') for i in range(5)]
+
+        LandmarkStore.insert_landmarks(self.session, mappings)
+        self.session.commit()
+
+        self.assertEqual(self.inserts(), [True])
+        self.assertEqual(self.stored_ids(), sorted(m['landmark_id'] for m in mappings))
+
+        landmark = self.session.query(Landmark).filter_by(landmark_id=mappings[3]['landmark_id']).one()
+        self.assertEqual(landmark.get_rect(), {'x1': 3, 'x2': 13, 'y1': 0, 'y2': 5})
+        self.assertEqual(landmark.status, 'UNKNOWN')
+
+    def test_insert_landmarks_one_statement_per_set_of_columns(self):
+        scored = [self.mapping(visual_saliency_score=0.5) for _ in range(3)]
+        unscored = [self.mapping() for _ in range(2)]
+
+        LandmarkStore.insert_landmarks(self.session, scored + unscored)
+        self.session.commit()
+
+        self.assertEqual(len(self.inserts()), 2)
+        self.assertEqual(len(self.stored_ids()), 5)
+
+    def test_insert_landmarks_skip_existing(self):
+        stored = [self.mapping() for _ in range(3)]
+        LandmarkStore.insert_landmarks(self.session, stored)
+        self.session.commit()
+
+        new = [self.mapping() for _ in range(2)]
+        LandmarkStore.insert_landmarks(self.session, stored[1:] + new, skip_existing=True)
+        self.session.commit()
+
+        self.assertEqual(self.stored_ids(), sorted(m['landmark_id'] for m in stored + new))
+
+        with self.assertRaises(IntegrityError):
+            LandmarkStore.insert_landmarks(self.session, stored[:1] + [self.mapping()])
+            self.session.commit()
+
+    def test_insert_landmarks_skip_existing_in_chunks(self):
+        stored = [self.mapping() for _ in range(LandmarkStore.CHUNK + 1)]
+        LandmarkStore.insert_landmarks(self.session, stored)
+        self.session.commit()
+        del self.statements[:]
+
+        new = [self.mapping() for _ in range(2)]
+        LandmarkStore.insert_landmarks(self.session, stored + new, skip_existing=True)
+        self.session.commit()
+
+        self.assertEqual([verb for verb, _ in self.statements if verb != 'INSERT'], ['SELECT', 'SELECT'])
+        self.assertEqual(len(self.inserts()), 1)
+        self.assertEqual(self.stored_ids(), sorted(m['landmark_id'] for m in stored + new))
+
+    def test_insert_landmarks_skip_existing_all_stored(self):
+        stored = [self.mapping() for _ in range(2)]
+        LandmarkStore.insert_landmarks(self.session, stored)
+        self.session.commit()
+        del self.statements[:]
+
+        LandmarkStore.insert_landmarks(self.session, stored, skip_existing=True)
+
+        self.assertEqual(self.inserts(), [])
+
+    def test_update_landmarks(self):
+        mappings = [self.mapping(visual_saliency_score=0.1) for _ in range(3)]
+        LandmarkStore.insert_landmarks(self.session, mappings)
+        self.session.commit()
+
+        landmarks = self.session.query(Landmark).order_by(Landmark.landmark_id).all()
+        LandmarkStore.update_landmarks(self.session, [
+            LandmarkStore.update_mapping(landmark, visual_saliency_score=0.9, **LandmarkStore.rect_values(
+                {'x1': 1, 'x2': 2, 'y1': 3, 'y2': 4})) for landmark in landmarks[:2]])
+        self.session.commit()
+        self.session.expire_all()
+
+        stored = self.session.query(Landmark).order_by(Landmark.landmark_id)
+        scores = [landmark.visual_saliency_score for landmark in stored]
+        self.assertEqual(scores, [0.9, 0.9, 0.1])
+        self.assertEqual(self.session.query(Landmark).get(landmarks[0].landmark_id).get_rect(),
+                         {'x1': 1, 'x2': 2, 'y1': 3, 'y2': 4})
+
+    def test_delete_landmarks(self):
+        mappings = [self.mapping() for _ in range(3)] + [self.mapping(position='left')]
+        LandmarkStore.insert_landmarks(self.session, mappings)
+        self.session.commit()
+
+        LandmarkStore.delete_landmarks(self.session, [mappings[0]['landmark_id'], uuid.uuid4()])
+        self.session.commit()
+
+        self.assertEqual(LandmarkStore.stored_ids(self.session, 1, 'front'),
+                         set(m['landmark_id'] for m in mappings[1:3]))
+        self.assertEqual(LandmarkStore.stored_ids(self.session, 1, 'left'), set([mappings[3]['landmark_id']]))
+
+    def crop_from_saliency(self, key, count):
+        """
+        Stores the landmarks of a crop-from-saliency run over the segmentation `key`, as the task does. Returns the
+        deleted ids.
+        """
+        stale = MaskSegmentations.replace(self.session, 1, 'front', key, count,
+                                          model=MaskSegmentations.CropFromSaliencySegmentation)
+        LandmarkStore.upsert_landmarks(self.session, [
+            self.mapping(landmark_id=landmark_id, rect={'x1': count, 'x2': count + 1, 'y1': 0, 'y2': 1})
+            for landmark_id in MaskSegmentations.landmark_ids(1, 'front', key, count)
+        ])
+        self.session.commit()
+
+        return stale
+
+    def test_upsert_landmarks(self):
+        stored = [self.mapping(rect={'x1': i, 'x2': i + 1, 'y1': 0, 'y2': 1}) for i in range(2)]
+        LandmarkStore.insert_landmarks(self.session, stored)
+        self.session.commit()
+
+        changed = self.mapping(landmark_id=stored[1]['landmark_id'], rect={'x1': 5, 'x2': 6, 'y1': 0, 'y2': 1})
+        new = self.mapping()
+        LandmarkStore.upsert_landmarks(self.session, [changed, new])
+        self.session.commit()
+
+        self.assertEqual(self.stored_ids(), sorted(m['landmark_id'] for m in stored + [new]))
+        self.assertEqual(self.session.query(Landmark).get(changed['landmark_id']).get_rect(),
+                         {'x1': 5, 'x2': 6, 'y1': 0, 'y2': 1})
+
+    def test_replace_landmarks_after_key_change(self):
+        first = self.crop_from_saliency('crop-a', 3)
+
+        # Landmarks other services stored for the same position, and landmarks of another position and hit
+        foreign = [self.mapping(relative_bearing=10.0), self.mapping()]
+        others = [self.mapping(position='left'), self.mapping(hit_id=2)]
+        LandmarkStore.insert_landmarks(self.session, foreign + others)
+        self.session.commit()
+
+        # A re-run under another key replaces only the landmarks of the first run
+        stale = self.crop_from_saliency('crop-b', 2)
+
+        self.assertEqual(first, [])
+        self.assertEqual(sorted(stale), sorted(MaskSegmentations.landmark_ids(1, 'front', 'crop-a', 3)))
+        self.assertEqual(LandmarkStore.stored_ids(self.session, 1, 'front'),
+                         set(MaskSegmentations.landmark_ids(1, 'front', 'crop-b', 2) +
+                             [m['landmark_id'] for m in foreign]))
+        self.assertEqual(len(self.stored_ids()), 6)
+
+    def test_replace_landmarks_with_fewer(self):
+        self.crop_from_saliency('crop-a', 3)
+        foreign = self.mapping()
+        LandmarkStore.insert_landmarks(self.session, [foreign])
+        self.session.commit()
+
+        # A re-run under the same key that keeps fewer regions, then one that finds none
+        self.assertEqual(self.crop_from_saliency('crop-a', 1),
+                         MaskSegmentations.landmark_ids(1, 'front', 'crop-a', 3)[1:])
+        self.assertEqual(self.session.query(Landmark).get(
+            MaskSegmentations.landmark_ids(1, 'front', 'crop-a', 1)[0]).get_rect(),
+            {'x1': 1, 'x2': 2, 'y1': 0, 'y2': 1})
+
+        self.assertEqual(len(self.crop_from_saliency('crop-a', 0)), 1)
+        self.assertEqual(self.stored_ids(), [foreign['landmark_id']])
+
+    def test_load_for_scoring(self):
+        wanted = [self.mapping(rect={'x1': 1, 'x2': 2, 'y1': 3, 'y2': 4}, relative_bearing=10.0,
+                               visual_saliency_score=0.5, status='UNKNOWN'),
+                  self.mapping(relative_bearing=20.0, status='UNKNOWN')]
+        others = [self.mapping(position='left'), self.mapping(hit_id=2)]
+        LandmarkStore.insert_landmarks(self.session, wanted + others)
+        self.session.commit()
+
+        landmarks = LandmarkStore.load_for_scoring(self.session, 1, 'front')
+
+        self.assertEqual(sorted(str(landmark.landmark_id) for landmark in landmarks),
+                         sorted(m['landmark_id'] for m in wanted))
+
+        loaded = set(LandmarkStore.rect_columns() + ['landmark_id', 'relative_bearing'])
+        for landmark in landmarks:
+            state = inspect(landmark)
+            self.assertEqual(set(c.key for c in inspect(Landmark).column_attrs) - state.unloaded, loaded)
+
+        by_bearing = dict((landmark.relative_bearing, landmark) for landmark in landmarks)
+        self.assertEqual(by_bearing[10.0].get_rect(), {'x1': 1, 'x2': 2, 'y1': 3, 'y2': 4})
+        self.assertIsNone(by_bearing[20.0].get_rect())
+
+    def test_load_side_values(self):
+        ids = [str(uuid.uuid4()) for _ in range(LandmarkStore.CHUNK + 2)]
+        self.session.bulk_insert_mappings(Degradations.LandmarkDegradation, [
+            {'landmark_id': i, 'task': task, 'level': 'minimal'} for i in ids[1:] for task in ('score', 'crop')])
+        self.session.commit()
+        del self.statements[:]
+
+        levels = LandmarkStore.load_side_values(self.session, Degradations.LandmarkDegradation.level, ids,
+                                                Degradations.LandmarkDegradation.task == 'score')
+
+        self.assertEqual(sorted(levels), sorted(ids[1:]))
+        self.assertEqual(set(levels.values()), set(['minimal']))
+        self.assertEqual([verb for verb, _ in self.statements], ['SELECT', 'SELECT'])
+
+
+if __name__ == '__main__':
+    unittest.main()
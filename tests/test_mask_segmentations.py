@@ -0,0 +1,148 @@
+import unittest
+import uuid
+import boto3
+from moto import mock_s3
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import testutil
+from pythoncore import Constants
+from pythoncore.Model.Landmark import Landmark
+import Deadline
+import Degradations
+import ImageEncoder
+import LandmarkStore
+import MaskSegmentations
+import ScoreFingerprints
+import ScoreTask
+
+'''
+MaskSegmentations' replacement of a position's mask landmarks, against an in-memory SQLite database.
+'''
+
+
+class MaskSegmentationsTest(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Landmark.__table__.create(engine)
+        LandmarkStore.SideTable.metadata.create_all(engine)
+
+        self.session = sessionmaker(bind=engine)()
+        self.addCleanup(self.session.close)
+
+    def segment(self, key, count, hit_id=1, position='front'):
+        """
+        Stores the landmarks of a mask run over the segmentation `key`, as MaskTask does. Returns the deleted ids.
+        """
+        stale = MaskSegmentations.replace(self.session, hit_id, position, key, count)
+        LandmarkStore.insert_landmarks(self.session, [
+            LandmarkStore.landmark_mapping(landmark_id=landmark_id, hit_id=hit_id, position=position)
+            for landmark_id in MaskSegmentations.landmark_ids(hit_id, position, key, count)
+        ], skip_existing=True)
+        self.session.commit()
+
+        return stale
+
+    def stored_ids(self, hit_id=1, position='front'):
+        return LandmarkStore.stored_ids(self.session, hit_id, position)
+
+    def test_retry_keeps_landmarks(self):
+        self.assertEqual(self.segment('mask-a', 3), [])
+        first = self.stored_ids()
+
+        self.assertEqual(self.segment('mask-a', 3), [])
+        self.assertEqual(self.stored_ids(), first)
+        self.assertEqual(len(first), 3)
+
+    def test_changed_map_replaces_landmarks(self):
+        self.segment('mask-a', 3)
+        first = self.stored_ids()
+
+        # A landmark another service stored, and the mask landmarks of another position and hit
+        other = str(uuid.uuid4())
+        LandmarkStore.insert_landmarks(self.session, [
+            LandmarkStore.landmark_mapping(landmark_id=other, hit_id=1, position='front', relative_bearing=10.0)
+        ])
+        self.segment('mask-a', 2, position='left')
+        self.segment('mask-a', 2, hit_id=2)
+        Degradations.store(self.session, 'score', dict((i, Deadline.REDUCED) for i in first))
+        self.session.commit()
+
+        stale = self.segment('mask-b', 2)
+
+        self.assertEqual(sorted(stale), sorted(first))
+        self.assertEqual(self.stored_ids(), set(MaskSegmentations.landmark_ids(1, 'front', 'mask-b', 2) + [other]))
+        self.assertEqual(len(self.stored_ids(position='left')), 2)
+        self.assertEqual(len(self.stored_ids(hit_id=2)), 2)
+        self.assertEqual(Degradations.load(self.session, 'score', list(first)), {})
+
+        # The replacement is recorded, so the next change replaces it in turn
+        self.assertEqual(sorted(self.segment('mask-c', 1)),
+                         sorted(MaskSegmentations.landmark_ids(1, 'front', 'mask-b', 2)))
+        self.assertEqual(self.stored_ids(), set(MaskSegmentations.landmark_ids(1, 'front', 'mask-c', 1) + [other]))
+
+    def test_unrecorded_segmentation_is_kept(self):
+        # Landmarks of a mask run from before segmentations were recorded
+        earlier = MaskSegmentations.landmark_ids(1, 'front', 'mask-a', 2)
+        LandmarkStore.insert_landmarks(self.session, [
+            LandmarkStore.landmark_mapping(landmark_id=landmark_id, hit_id=1, position='front')
+            for landmark_id in earlier
+        ])
+        self.session.commit()
+
+        self.assertEqual(self.segment('mask-b', 1), [])
+        self.assertEqual(len(self.stored_ids()), 3)
+
+    def test_returning_segmentation_is_rescored(self):
+        rect = {'x1': 1, 'x2': 2, 'y1': 3, 'y2': 4}
+
+        def mask(key):
+            MaskSegmentations.replace(self.session, 1, 'front', key, 2)
+            LandmarkStore.insert_landmarks(self.session, [
+                LandmarkStore.landmark_mapping(rect=rect, landmark_id=landmark_id, hit_id=1, position='front')
+                for landmark_id in MaskSegmentations.landmark_ids(1, 'front', key, 2)
+            ], skip_existing=True)
+            self.session.commit()
+
+        def needs_score():
+            landmarks = LandmarkStore.load_for_scoring(self.session, 1, 'front')
+            stored = ScoreFingerprints.load(self.session, [landmark.landmark_id for landmark in landmarks])
+            return [not ScoreTask.ScoreTask._unchanged('etag', landmark, stored) for landmark in landmarks]
+
+        # Mask, then an incremental score, which fingerprints the landmarks
+        mask('mask-a')
+        ScoreFingerprints.store(self.session, dict(
+            (landmark_id, ScoreFingerprints.fingerprint('etag', rect))
+            for landmark_id in MaskSegmentations.landmark_ids(1, 'front', 'mask-a', 2)))
+        self.session.commit()
+        self.assertEqual(needs_score(), [False, False])
+
+        # The segmentation changes and comes back: its landmarks are recreated unscored, so they are scored again
+        mask('mask-b')
+        mask('mask-a')
+
+        self.assertEqual(needs_score(), [True, True])
+
+    def test_stale_images_are_deleted(self):
+        mock = mock_s3()
+        mock.start()
+        self.addCleanup(mock.stop)
+
+        client = boto3.client('s3', region_name='us-east-1')
+        buckets = [Constants.S3_BUCKETS[bucket] for bucket in MaskSegmentations.LANDMARK_IMAGES]
+        kept = MaskSegmentations.landmark_ids(1, 'front', 'mask-b', 1)
+
+        self.segment('mask-a', 3)
+        for bucket in buckets:
+            client.create_bucket(Bucket=bucket)
+            for landmark_id in MaskSegmentations.landmark_ids(1, 'front', 'mask-a', 3) + kept:
+                client.put_object(Bucket=bucket, Key=ImageEncoder.s3_key(landmark_id), Body=b'png')
+
+        MaskSegmentations.delete_images(self.segment('mask-b', 1))
+
+        for bucket in buckets:
+            keys = [o['Key'] for o in client.list_objects_v2(Bucket=bucket).get('Contents', [])]
+            self.assertEqual(keys, [ImageEncoder.s3_key(landmark_id) for landmark_id in kept])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import glob
+import os
+import unittest
+from sqlalchemy import create_engine, inspect
+import testutil
+import Degradations
+import FusedTask
+import LandmarkStore
+import MaskSegmentations
+import ScoreFingerprints
+
+'''
+The schema migrations, applied in order to an in-memory SQLite database, against the side tables LandmarkStore declares.
+'''
+
+MIGRATIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'migrations')
+
+
+def statements(path):
+    with open(path) as f:
+        sql = '\n'.join(line for line in f.read().splitlines() if not line.strip().startswith('--'))
+
+    return [statement.strip() for statement in sql.split(';') if statement.strip()]
+
+
+class MigrationsTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+
+        for path in sorted(glob.glob(os.path.join(MIGRATIONS, '*.sql'))):
+            for statement in statements(path):
+                self.engine.execute(statement)
+
+        self.inspector = inspect(self.engine)
+
+        # The side tables, declared by the modules imported above
+        self.tables = LandmarkStore.SideTable.metadata.sorted_tables
+
+    def test_tables(self):
+        self.assertEqual(sorted(self.inspector.get_table_names()), sorted(table.name for table in self.tables))
+
+    def test_tables_match_models(self):
+        for table in self.tables:
+            columns = dict((c['name'], c) for c in self.inspector.get_columns(table.name))
+
+            self.assertEqual(sorted(columns), sorted(c.name for c in table.columns), table.name)
+            self.assertEqual(sorted(self.inspector.get_pk_constraint(table.name)['constrained_columns']),
+                             sorted(c.name for c in table.primary_key.columns), table.name)
+
+            for column in table.columns:
+                migrated = columns[column.name]
+                self.assertEqual(migrated['nullable'], column.nullable, (table.name, column.name))
+                self.assertEqual(str(migrated['type']), column.type.compile(dialect=self.engine.dialect),
+                                 (table.name, column.name))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import unittest
+import numpy as np
+import testutil
+import OptimisticSearch
+from pythoncore import Constants
+
+'''
+BearingIndex's vectorized lookup, against a per-bearing search of the salient boxes.
+'''
+
+WIDTH = 640
+HEIGHT = 480
+
+BOXES = [
+    {'x1': 10, 'y1': 100, 'x2': 80, 'y2': 300},
+    {'x1': 50, 'y1': 0, 'x2': 200, 'y2': 240},
+    {'x1': 150, 'y1': 200, 'x2': 260, 'y2': 260},
+    {'x1': 300, 'y1': 10, 'x2': 301, 'y2': 20},
+    {'x1': 400, 'y1': 0, 'x2': 639, 'y2': 480},
+    {'x1': 580, 'y1': 50, 'x2': 700, 'y2': 150}
+]
+
+# Every degree and half degree past both edges of a frame and of a panorama, and bearings that have no longitude
+BEARINGS = list(np.arange(-200.0, 200.5, 0.5)) + [-45.0, 44.9, 45.0, 180.0, -180.0, None, float('nan'),
+                                                   float('inf'), float('-inf')]
+
+
+def search(boxes, deg, panorama):
+    """
+    Returns the salient box at bearing `deg` by testing every box, as the search did before BearingIndex.
+    """
+    if deg is None or not np.isfinite(deg):
+        return None
+
+    if panorama:
+        longitude = int(((deg + 180.0) % 360.0) * (WIDTH / 360.0)) % WIDTH
+    else:
+        adjusted_deg = int(deg + Constants.STREETVIEW_FOV / 2)
+        longitude = max(min(int(adjusted_deg * (WIDTH / Constants.STREETVIEW_FOV)), WIDTH - 1), 0)
+
+    # A panorama box crossing the wrap also covers the columns from 0
+    intersected = [b for b in boxes if b['x1'] < longitude < b['x2'] or
+                   panorama and b['x2'] >= WIDTH and b['x1'] - WIDTH < longitude < b['x2'] - WIDTH]
+    intersected.sort(key=lambda b: abs(b['y2'] - b['y1'] - HEIGHT / 2.0))
+
+    return intersected[0] if intersected else None
+
+
+class BearingIndexTest(unittest.TestCase):
+    def check(self, panorama):
+        index = OptimisticSearch.BearingIndex(BOXES, WIDTH, HEIGHT, panorama)
+        expected = [search(BOXES, deg, panorama) for deg in BEARINGS]
+
+        self.assertEqual(index.lookup_many(BEARINGS), expected)
+        self.assertEqual([index.lookup(deg) for deg in BEARINGS], expected)
+
+        # The bearings reach columns without a box, and every box but the one with no column strictly inside it
+        self.assertIn(None, expected[:-4])
+        self.assertEqual(set(BOXES.index(box) for box in expected if box is not None), set([0, 1, 2, 4, 5]))
+
+    def test_frame(self):
+        # Bearings beyond the frame's edges clamp to its edge columns
+        self.check(panorama=False)
+
+        index = OptimisticSearch.BearingIndex(BOXES, WIDTH, HEIGHT)
+        self.assertEqual(index.lookup_many([-90.0, 90.0]), [None, BOXES[5]])
+
+    def test_panorama(self):
+        # Bearings wrap around, and the box crossing the wrap is found on both sides of it
+        self.check(panorama=True)
+
+        index = OptimisticSearch.BearingIndex(BOXES, WIDTH, HEIGHT, panorama=True)
+        self.assertEqual(index.lookup_many([-179.0, 179.0]), [BOXES[5], BOXES[5]])
+
+    def test_missing_bearings(self):
+        # A missing bearing used to become column 512 (INT64_MIN % WIDTH) of a panorama, where there is a box
+        index = OptimisticSearch.BearingIndex(BOXES, WIDTH, HEIGHT, panorama=True)
+
+        self.assertEqual(index.lookup_many([None, float('nan'), 108.0]), [None, None, BOXES[4]])
+        self.assertEqual(index.lookup_many([]), [])
+
+    def test_intervals_against_brute_force(self):
+        # Many overlapping boxes, with ties in rank, and boxes crossing the panorama's wrap
+        rng = np.random.RandomState(0)
+        boxes = []
+        for _ in range(200):
+            x1 = int(rng.randint(0, WIDTH))
+            y1 = int(rng.randint(0, HEIGHT - 10))
+            boxes.append({'x1': x1, 'x2': x1 + int(rng.randint(0, 150)), 'y1': y1, 'y2': y1 + int(rng.randint(1, 8))})
+
+        for panorama in (False, True):
+            index = OptimisticSearch.BearingIndex(boxes, WIDTH, HEIGHT, panorama)
+
+            # Each break resolves to the first box in ranked order that spans it
+            ranked = sorted(boxes, key=lambda b: abs(b['y2'] - b['y1'] - HEIGHT / 2.0))
+            spans = []
+            for b in ranked:
+                spans.append((b['x1'], b['x2'], b))
+                if panorama and b['x2'] >= WIDTH:
+                    spans.append((b['x1'] - WIDTH, b['x2'] - WIDTH, b))
+
+            expected = [next((b for x1, x2, b in spans if x1 < start < x2), None) for start in index._breaks]
+
+            self.assertEqual(index._boxes, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+import numpy as np
+import testutil
+import SaliencyScorer
+
+'''
+SaliencyScorer's integral-image scores, against summing each rect's slice of the saliency map.
+'''
+
+HEIGHT = 30
+WIDTH = 40
+
+# (x1, y1, x2, y2)
+RECTS = [
+    (3, 4, 10, 12),         # inside
+    (0, 0, WIDTH, HEIGHT),  # the whole map
+    (7, 8, 8, 9),           # one pixel
+    (35, 25, 50, 45),       # clipped at the right and bottom edges
+    (0, 20, 100, 100),      # clipped, spanning the full width
+    (50, 40, 60, 50),       # past the map
+    (5, 5, 5, 10),          # empty: no width
+    (5, 5, 10, 5),          # empty: no height
+    (10, 12, 3, 4),         # inverted
+    (10, 4, 3, 12),         # inverted along x only
+]
+
+MAPS = {
+    'uint8': np.random.RandomState(0).randint(0, 256, (HEIGHT, WIDTH)).astype(np.uint8),
+    'float': np.random.RandomState(1).rand(HEIGHT, WIDTH),
+}
+
+
+def reference(sm, rect):
+    x1, y1, x2, y2 = rect
+    return np.sum(sm[y1:y2, x1:x2]) / float(np.sum(sm))
+
+
+class SaliencyScorerTest(unittest.TestCase):
+    def test_score(self):
+        for dtype in sorted(MAPS):
+            sm = MAPS[dtype]
+            scorer = SaliencyScorer.SaliencyScorer(sm)
+
+            for x1, y1, x2, y2 in RECTS:
+                self.assertAlmostEqual(scorer.score({'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2}),
+                                       reference(sm, (x1, y1, x2, y2)), delta=1e-12, msg=(dtype, (x1, y1, x2, y2)))
+
+    def test_scores(self):
+        for dtype in sorted(MAPS):
+            sm = MAPS[dtype]
+            scores = SaliencyScorer.SaliencyScorer(sm).scores(np.array(RECTS))
+
+            for rect, score in zip(RECTS, scores):
+                self.assertAlmostEqual(score, reference(sm, rect), delta=1e-12, msg=(dtype, rect))
+
+    def test_missing_rects_score_zero(self):
+        scorer = SaliencyScorer.SaliencyScorer(MAPS['uint8'])
+        rects = SaliencyScorer.rects_array([None, {'x1': 3, 'y1': 4, 'x2': 10, 'y2': 12}, None])
+        scores = scorer.scores(rects)
+
+        self.assertEqual(len(scores), 3)
+        self.assertEqual(scores[0], 0.0)
+        self.assertAlmostEqual(scores[1], reference(MAPS['uint8'], RECTS[0]))
+        self.assertEqual(scores[2], 0.0)
+
+    def test_negative_bounds_clip_to_the_map(self):
+        # Unlike a slice, which would count negative bounds from the far edge
+        sm = MAPS['uint8']
+        scorer = SaliencyScorer.SaliencyScorer(sm)
+
+        self.assertAlmostEqual(scorer.scores(np.array([(-5, -5, 10, 12)]))[0], reference(sm, (0, 0, 10, 12)))
+        self.assertEqual(scorer.scores(np.array([(-10, 0, -2, HEIGHT)]))[0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+import threading
+import time
+import unittest
+import testutil
+import ActivityPoller
+import Scheduler
+
+'''
+Scheduler's slot allocation, and its slot and CPU accounting for acquire(), start() and release().
+'''
+
+
+def scheduler(activities, cpu_budget=4.0, max_concurrency=10, interval=3600):
+    return Scheduler.Scheduler([Scheduler.Activity(*a) for a in activities], cpu_budget, max_concurrency, interval)
+
+
+def slots(s):
+    return [s.stats()[a.name]['slots'] for a in s.activities]
+
+
+class FailingStepFunctions(object):
+    """
+    Step Functions client whose every poll fails.
+    """
+    def __init__(self):
+        self.polls = 0
+
+    def get_activity_task(self, activityArn, workerName):
+        self.polls += 1
+        raise IOError('poll failed')
+
+
+class StubCloudWatch(object):
+    def get_metric_statistics(self, **kwargs):
+        return {'Datapoints': []}
+
+
+class AllocateTest(unittest.TestCase):
+    def test_even_split_at_start(self):
+        self.assertEqual(slots(scheduler([('a', 1.0, 1, 10), ('b', 1.0, 1, 10)])), [5, 5])
+
+    def test_minimums(self):
+        s = scheduler([('a', 1.0, 2, 3), ('b', 1.0, 1, 10), ('c', 1.0, 1, 1)], max_concurrency=8)
+
+        # Without demand, every activity keeps only its minimum
+        self.assertEqual(s._allocate([0, 0, 0]), [2, 1, 1])
+
+    def test_minimums_raise_total_slots(self):
+        s = scheduler([('a', 1.0, 3, 10), ('b', 1.0, 2, 10)], max_concurrency=2)
+
+        self.assertEqual(s.max_concurrency, 5)
+        self.assertEqual(slots(s), [3, 2])
+
+    def test_proportional_split(self):
+        s = scheduler([('a', 1.0, 1, 10), ('b', 1.0, 1, 10)])
+
+        # The 8 spare slots go 3:1
+        self.assertEqual(s._allocate([3.0, 1.0]), [7, 3])
+        self.assertEqual(s._allocate([1.0, 0]), [9, 1])
+
+    def test_max_slots_cap(self):
+        s = scheduler([('a', 1.0, 2, 3), ('b', 1.0, 1, 10), ('c', 1.0, 1, 1)], max_concurrency=8)
+
+        # a and c are capped, so b gets the slots their demand would take
+        self.assertEqual(s._allocate([10.0, 1.0, 5.0]), [3, 4, 1])
+        self.assertEqual(s.max_slots('a'), 3)
+        self.assertEqual(s.max_slots('b'), 8)
+
+    def test_rebalance_by_backlog(self):
+        s = scheduler([('a', 1.0, 1, 10), ('b', 1.0, 1, 10)], interval=0)
+        s.set_backlog('a', 6)
+        s.set_backlog('b', 2)
+
+        s.acquire('b')
+        s.release('b')
+
+        self.assertEqual(slots(s), [7, 3])
+
+
+class AccountingTest(unittest.TestCase):
+    def acquire_in_thread(self, s, name):
+        """
+        Calls acquire(name) on a thread, and returns an Event set once it returns.
+        """
+        acquired = threading.Event()
+
+        def run():
+            s.acquire(name)
+            acquired.set()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+        return acquired
+
+    def test_claims_hold_no_cpu(self):
+        s = scheduler([('a', 1.0, 2, 2), ('b', 1.0, 1, 1)], cpu_budget=1.0, max_concurrency=3)
+
+        # Polls of both activities claim slots, even though the budget has room for one task only
+        for name in ('a', 'a', 'b'):
+            s.acquire(name)
+
+        stats = s.stats()
+        self.assertEqual([stats['a']['claimed'], stats['b']['claimed']], [2, 1])
+        self.assertEqual([stats['a']['running'], stats['b']['running']], [0, 0])
+        self.assertEqual(s._cpu_in_use, 0.0)
+
+        # Polls that found no task free their slots only
+        s.release('a')
+        s.release('b')
+
+        stats = s.stats()
+        self.assertEqual([stats['a']['claimed'], stats['b']['claimed']], [1, 0])
+        self.assertEqual(stats['a']['completed'], 0)
+
+    def test_slots_limit_claims(self):
+        s = scheduler([('a', 0.5, 1, 1)], cpu_budget=4.0, max_concurrency=1)
+        s.acquire('a')
+
+        acquired = self.acquire_in_thread(s, 'a')
+        self.assertFalse(acquired.wait(0.1))
+
+        s.release('a')
+        self.assertTrue(acquired.wait(5))
+
+    def test_running_tasks_limit_claims(self):
+        s = scheduler([('a', 1.0, 2, 2), ('b', 1.0, 1, 1)], cpu_budget=1.0, max_concurrency=3)
+
+        s.acquire('a')
+        s.start('a')
+        started = time.time()
+        self.assertEqual(s._cpu_in_use, 1.0)
+        self.assertEqual(s.stats()['a']['running'], 1)
+
+        # The running task fills the budget, so no activity can claim a slot until it is done
+        acquired = self.acquire_in_thread(s, 'b')
+        self.assertFalse(acquired.wait(0.1))
+
+        s.release('a', started)
+        self.assertTrue(acquired.wait(5))
+
+        stats = s.stats()
+        self.assertEqual([stats['a']['claimed'], stats['a']['running'], stats['a']['completed']], [0, 0, 1])
+        self.assertEqual(stats['b']['claimed'], 1)
+        self.assertEqual(s._cpu_in_use, 0.0)
+
+    def test_latency(self):
+        s = scheduler([('a', 1.0, 1, 1)])
+
+        for seconds in (10.0, 20.0):
+            s.acquire('a')
+            s.start('a')
+            s.release('a', time.time() - seconds)
+
+        # The first task sets the average, later ones move it by LATENCY_SMOOTHING
+        self.assertAlmostEqual(s.stats()['a']['latency'], 10.0 + Scheduler.LATENCY_SMOOTHING * 10.0, places=1)
+        self.assertEqual(s.stats()['a']['completed'], 2)
+
+    def test_failed_polls_release_their_slots(self):
+        s = scheduler([('a', 1.0, 2, 2)], cpu_budget=1.0, max_concurrency=2)
+        sfn = FailingStepFunctions()
+        poller = ActivityPoller.ActivityPoller(s, [('a', 'arn', None)], client=sfn, cloudwatch=StubCloudWatch())
+        poller.backoff = 0.01
+
+        thread = threading.Thread(target=poller.start)
+        thread.daemon = True
+        thread.start()
+
+        end = time.time() + 5
+        while sfn.polls < 10 and time.time() < end:
+            time.sleep(0.01)
+
+        poller.stop()
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertGreaterEqual(sfn.polls, 10)
+        self.assertEqual([s.stats()['a'][k] for k in ('claimed', 'running', 'completed')], [0, 0, 0])
+        self.assertEqual(s._cpu_in_use, 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+import numpy as np
+import testutil
+from pythoncore import Constants
+import Deadline
+import SaliencyScorer
+import ScoreTask
+
+'''
+ScoreTask.score_landmarks, the search and scoring ScoreTask, FusedTask and the backfill share, on a synthetic map.
+'''
+
+WIDTH = 640
+HEIGHT = 480
+
+STORED = {'x1': 10, 'y1': 10, 'x2': 60, 'y2': 60}
+SALIENT = {'x1': 290, 'y1': 90, 'x2': 410, 'y2': 210}
+NEW = {'x1': 300, 'y1': 100, 'x2': 320, 'y2': 120}
+
+# The bearing of column 350 of a frame, within SALIENT
+BEARING = (350.5 / WIDTH - 0.5) * Constants.STREETVIEW_FOV
+
+
+class StubLandmark(object):
+    def __init__(self, landmark_id, rect=None, relative_bearing=None):
+        self.landmark_id = landmark_id
+        self.rect = rect
+        self.relative_bearing = relative_bearing
+
+    def get_rect(self):
+        return self.rect
+
+
+class ScoreLandmarksTest(unittest.TestCase):
+    def setUp(self):
+        sm = np.zeros((HEIGHT, WIDTH), np.uint8)
+        sm[100:200, 300:400] = 255
+        self.scorer = SaliencyScorer.SaliencyScorer(sm)
+
+        # A stored rect, one found at its bearing, and one without a bearing
+        self.landmarks = [StubLandmark('a', STORED), StubLandmark('b', relative_bearing=BEARING), StubLandmark('c')]
+        self.searched = []
+
+    def search_boxes(self, level):
+        self.searched.append(level)
+        return [SALIENT]
+
+    def score(self, level):
+        budget = Deadline.Budget('score', seconds=0)
+        rects, scores, updates = ScoreTask.score_landmarks(self.scorer, self.landmarks, (WIDTH, HEIGHT),
+                                                           self.search_boxes, level=level, budget=budget,
+                                                           new_rects=[NEW])
+
+        # Scores follow the rects, the landmarks' then the new ones
+        expected = self.scorer.scores(SaliencyScorer.rects_array(rects))
+        self.assertEqual(scores, [float(s) for s in expected])
+        self.assertEqual([u['landmark_id'] for u in updates], ['a', 'b', 'c'])
+        self.assertEqual([u['visual_saliency_score'] for u in updates], scores[:3])
+
+        return rects, updates, budget.levels
+
+    def test_unbounded_landmarks_are_searched(self):
+        rects, updates, levels = self.score(Deadline.REDUCED)
+
+        self.assertEqual(self.searched, [Deadline.REDUCED])
+        self.assertEqual(rects, [STORED, SALIENT, None, NEW])
+        self.assertGreater(updates[1]['visual_saliency_score'], 0)
+
+        # Only the found rect is written back, and only the searched landmarks are recorded
+        self.assertEqual(len(updates[0]), 2)
+        self.assertGreater(len(updates[1]), 2)
+        self.assertEqual(len(updates[2]), 2)
+        self.assertEqual(levels, {'b': Deadline.REDUCED, 'c': Deadline.REDUCED})
+
+    def test_minimal_output_skips_the_search(self):
+        rects, updates, levels = self.score(Deadline.MINIMAL)
+
+        self.assertEqual(self.searched, [])
+        self.assertEqual(rects, [STORED, None, None, NEW])
+        self.assertEqual(levels, {'b': Deadline.MINIMAL, 'c': Deadline.MINIMAL})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,22 @@
+import os
+import sys
+
+'''
+Shared setup of the tests.
+
+    conda env create -f environment.yml
+    pip install -r tests/requirements.txt
+    python -m pytest tests
+
+The tests run in the worker's environment (environment.yml, plus pythoncore as the Dockerfile installs it), with its
+boto3 and botocore versions, which tests/requirements.txt pins moto to match. AWS is mocked with moto, and the database
+is an in-memory SQLite; the tests need no AWS credentials or network.
+'''
+
+# Tests import the worker modules the same way the worker does (flat, from the app directory)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'matrixmaster'))
+
+# moto only intercepts signed requests, so boto needs some credentials; make sure they are never real ones
+for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SECURITY_TOKEN', 'AWS_SESSION_TOKEN'):
+    os.environ[name] = 'testing'
+os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'